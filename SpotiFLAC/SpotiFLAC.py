@@ -3,13 +3,34 @@ import re
 import time
 import argparse
 import asyncio
+import itertools
+import json
+import queue
+import shutil
+import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass, field
 
-from SpotiFLAC.getMetadata import get_filtered_data, parse_uri, SpotifyInvalidUrlException
+from SpotiFLAC.getMetadata import iter_spotify_pages, get_tracks_by_ids, parse_uri, SpotifyInvalidUrlException
+from SpotiFLAC.trackStore import Track, TrackStore
+from SpotiFLAC.journal import DownloadJournal
+from SpotiFLAC.leaseQueue import POLL_INTERVAL, Heartbeat
+from SpotiFLAC.adaptiveLimit import HOSTS, LimitGroup, SlotTimeout, is_overload
+from SpotiFLAC.albumIndex import AlbumIndex
+from SpotiFLAC import bandwidth, deadline
+from SpotiFLAC.bandwidth import Bandwidth, parse_rate, parse_service_rate
+from SpotiFLAC.libraryStore import LibraryStore, LINK_MODES
+from SpotiFLAC.lookahead import LOOKAHEAD, Lookahead, Resolution, url_expiry
+from SpotiFLAC.negativeCache import NegativeCache, TrackUnavailable, track_key
+from SpotiFLAC.serviceRanker import ServiceRanker, StatsStore
+from SpotiFLAC.postProcess import PostProcessor, cpu_workers
+from SpotiFLAC.coverCache import CACHE_DIR, CoverCache
 from SpotiFLAC.tidalDL import TidalDownloader
 from SpotiFLAC.deezerDL import DeezerDownloader
 from SpotiFLAC.qobuzDL import QobuzDownloader
 from SpotiFLAC.amazonDL import AmazonDownloader
+from SpotiFLAC import transfer
 
 
 @dataclass
@@ -24,28 +45,22 @@ class Config:
     is_album: bool = False
     is_playlist: bool = False
     is_single_track: bool = False
+    is_discography: bool = False
     album_or_playlist_name: str = ""
-    tracks: list = field(default_factory=list)
+    tracks: TrackStore = field(default_factory=TrackStore)
     worker: object = None
     loop: int = 3600
     start_time: float = 0.0
     end_time: float = 0.0
+    total_tracks: int = 0
+    concurrency: int = 1
+    journal: DownloadJournal = None
+    retry_failed: bool = False
 
 
-@dataclass
-class Track:
-    external_urls: str
-    title: str
-    artists: str
-    album: str
-    album_artist: str # NOVO CAMPO
-    track_number: int
-    duration_ms: int
-    id: str
-    isrc: str = ""
-    release_date: str = ""
-    cover_url: str = ""
-    downloaded: bool = False
+# Spotify pages fetched ahead of the download scheduler
+PAGE_PREFETCH = 2
+SERVICES = ("tidal", "deezer", "qobuz", "amazon")
 
 
 # --- FUNÇÕES AUXILIARES ---
@@ -69,53 +84,171 @@ def extract_cover_art(data, key_primary="images", key_secondary="album"):
             
     return ""
 
-def format_artists(artists_list):
-    if isinstance(artists_list, list):
-        return ", ".join([a.get("name", "Unknown") if isinstance(a, dict) else str(a) for a in artists_list])
-    return str(artists_list) if artists_list else "Unknown Artist"
 
+def prefetch(iterable, maxsize=2):
+    # Runs the iterable on a background thread, at most `maxsize` items ahead of the consumer.
+    # A consumer that stops early (error, Ctrl-C, closing the generator) stops the producer too,
+    # instead of leaving it blocked on a full queue with the iterable's session pinned.
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(e)
+        finally:
+            put(done)
+            close = getattr(iterable, "close", None)
+            if close:
+                close()
+
+    threading.Thread(target=producer, daemon=True).start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def fetch_tracks(config):
+    url = config.url
+    if not url:
+        print('Warning: Please enter a Spotify URL.')
+        return iter(())
+
+    job = config.journal.get_job(url) if config.journal else None
+    if config.retry_failed:
+        if not job:
+            print(f"Nothing to retry: no journaled run for {url}")
+            return iter(())
+        return replay_tracks(config, job, ("failed",))
+    if job and job["listed"] and not job["finished"]:
+        # Interrupted after the whole track list was journaled: resume without asking Spotify again
+        print("Resuming interrupted download from the journal...")
+        return replay_tracks(config, job, ("pending", "failed"))
 
-def get_metadata(url):
     try:
-        metadata = get_filtered_data(url)
-        if "error" in metadata:
-            print("Error fetching metadata:", metadata["error"])
-        else:
-            print("Metadata fetched successfully.")
-            return metadata
+        print('Just a moment. Fetching metadata...')
+        pages = prefetch(iter_spotify_pages(url), PAGE_PREFETCH)
+        header, items = next(pages)
+    except StopIteration:
+        print("Error: Empty metadata received.")
+        return iter(())
     except SpotifyInvalidUrlException as e:
         print("Invalid URL:", str(e))
+        return iter(())
     except Exception as e:
         print("An error occurred while fetching metadata:", str(e))
+        return iter(())
+
+    print("Metadata fetched successfully.")
+    on_metadata_fetched(config, header)
+    return stream_tracks(config, itertools.chain([(header, items)], pages))
+
+
+def lease_tracks(config, owner, since, poll=POLL_INTERVAL):
+    # --worker: the job's tracks come from the journal shared with the other workers. Whoever
+    # gets the listing lease fetches the track list into it (the others wait for that), then
+    # every worker claims tracks one at a time as its scheduler has room for them.
+    journal = config.journal
+    if not journal:
+        print("Warning: no shared journal in the output directory; downloading this job alone.")
+        return fetch_tracks(config)
+    listed_here = False
+    while True:
+        if not config.retry_failed and not listed_here and journal.claim_listing(config.url, owner):
+            listed_here = True
+            try:
+                for _ in fetch_tracks(config):
+                    pass
+            except Exception as e:
+                print(f"Error listing {config.url}: {e}")
+            finally:
+                journal.release_listing(config.url, owner)
+        job = journal.get_job(config.url)
+        if job and job["listed"] and (listed_here or config.retry_failed or not job["finished"]):
+            break
+        if listed_here or config.retry_failed:
+            print(f"Nothing to download for {config.url}: the job could not be listed")
+            return iter(())
+        print("Waiting for another worker to list the job...")
+        time.sleep(poll)
+    restore_job_metadata(config, job)
+    return leased_tracks(config, owner, since, poll)
+
+
+def leased_tracks(config, owner, since, poll=POLL_INTERVAL):
+    # Ends once nothing is left to claim and no other live worker still holds a track, so a
+    # worker that dies mid-track has it picked up here when its lease runs out
+    journal = config.journal
+    while True:
+        entries = journal.claim_tracks(config.url, owner, since, pending=not config.retry_failed)
+        for entry in entries:
+            yield config.tracks.setdefault(Track.from_dict(json.loads(entry["meta"])))
+        if entries:
+            continue
+        state = journal.lease_state(config.url, owner)
+        if state["listed"] and not state["held"]:
+            return
+        time.sleep(poll)
 
 
-def fetch_tracks(url):
-    if not url:
-        print('Warning: Please enter a Spotify URL.')
-        return
+def replay_tracks(config, job, statuses):
+    restore_job_metadata(config, job)
+    entries = config.journal.entries(config.url, statuses)
+    print(f"{len(entries)} tracks to {'retry' if statuses == ('failed',) else 'resume'} from the journal.")
+    return (config.tracks.setdefault(Track.from_dict(json.loads(e["meta"]))) for e in entries)
+
+
+def restore_job_metadata(config, job):
+    config.album_or_playlist_name = job["name"]
+    config.total_tracks = job["total"]
+    config.is_single_track = job["kind"] == "track"
+    config.is_album = job["kind"] == "album"
+    config.is_playlist = job["kind"] in ("playlist", "discography")
+    config.is_discography = job["kind"] == "discography"
 
-    try:
-        print('Just a moment. Fetching metadata...')
-        metadata = get_metadata(url)
-        if metadata:
-            on_metadata_fetched(metadata)
-        else:
-            print("Error: Empty metadata received.")
-    except Exception as e:
-        print(f'Error: Failed to start metadata fetch: {str(e)}')
 
+def job_kind(config):
+    if config.is_discography: return "discography"
+    if config.is_album: return "album"
+    if config.is_playlist: return "playlist"
+    return "track"
 
-def on_metadata_fetched(metadata):
+
+def on_metadata_fetched(config, metadata):
     try:
         url_info = parse_uri(config.url)
 
         if url_info["type"] == "track":
-            data = metadata.get("track", metadata)
-            handle_track_metadata(data)
+            handle_track_metadata(config, metadata)
         elif url_info["type"] == "album":
-            handle_album_metadata(metadata)
+            handle_album_metadata(config, metadata)
         elif url_info["type"] == "playlist":
-            handle_playlist_metadata(metadata)
+            handle_playlist_metadata(config, metadata)
+        elif url_info["type"] in ("artist", "artist_discography"):
+            handle_artist_metadata(config, metadata)
+
+        if config.journal:
+            config.journal.start_job(config.url, config.album_or_playlist_name, job_kind(config), config.total_tracks)
 
     except Exception as e:
         import traceback
@@ -123,191 +256,109 @@ def on_metadata_fetched(metadata):
         print(f'Error parsing metadata: {str(e)}')
 
 
-def handle_track_metadata(track_data):
-    track_id = track_data.get("id")
-    if not track_id and "external_urls" in track_data:
-        ext = track_data["external_urls"]
-        if isinstance(ext, dict): track_id = ext.get("spotify", "").split("/")[-1]
-        elif isinstance(ext, str): track_id = ext.split("/")[-1]
-
-    if not track_id:
-        print("[!] Skipping track without ID")
-        return
-
-    cover = extract_cover_art(track_data)
-    if cover:
-        print(f"[DEBUG] Cover found for track: {cover[:30]}...")
-
-    artist_names = format_artists(track_data.get("artists", []))
-    
-    # Tenta pegar o artista do álbum. Se falhar, usa o artista da faixa.
-    album_obj = track_data.get("album", {})
-    if isinstance(album_obj, dict) and album_obj.get("artists"):
-        album_artist = format_artists(album_obj.get("artists"))
-    else:
-        album_artist = artist_names
-
-    track = Track(
-        external_urls=f"https://open.spotify.com/track/{track_id}",
-        title=track_data.get("name", "Unknown Title"),
-        artists=artist_names,
-        album=track_data.get("album_name", track_data.get("album", {}).get("name", "Unknown Album")),
-        album_artist=album_artist,
-        track_number=track_data.get("track_number", 1),
-        duration_ms=track_data.get("duration_ms", 0),
-        id=track_id,
-        isrc=track_data.get("external_ids", {}).get("isrc", "") or track_data.get("isrc", ""),
-        release_date=track_data.get("album", {}).get("release_date", "") or track_data.get("release_date", ""),
-        cover_url=cover 
-    )
-
-    config.tracks = [track]
+def handle_track_metadata(config, track_data):
     config.is_single_track = True
     config.is_album = config.is_playlist = False
-    config.album_or_playlist_name = f"{config.tracks[0].title} - {config.tracks[0].artists}"
+    config.total_tracks = 1
+    artists = ", ".join(a.get("name") or "Unknown Artist" for a in track_data.get("artists", []))
+    config.album_or_playlist_name = f"{track_data.get('name', 'Unknown Title')} - {artists}"
 
 
-def handle_album_metadata(album_data):
-    config.album_or_playlist_name = album_data.get("album_info", {}).get("name", album_data.get("name", "Unknown Album"))
-    
-    # Data de lançamento do álbum
-    album_release_date = album_data.get("album_info", {}).get("release_date", album_data.get("release_date", ""))
-    
-    # Artista do Álbum (Geralmente no topo do objeto album)
-    raw_album_artists = album_data.get("album_info", {}).get("artists", [])
-    if not raw_album_artists:
-         raw_album_artists = album_data.get("artists", [])
-    
-    # Se raw_album_artists for string (já formatada), usa direto, senão formata
-    if isinstance(raw_album_artists, str):
-        main_album_artist = raw_album_artists
-    else:
-        main_album_artist = format_artists(raw_album_artists)
-
-    album_cover = extract_cover_art(album_data.get("album_info", album_data))
-    
-    tracks_raw = album_data.get("track_list", album_data.get("tracks", {}).get("items", []))
-
-    for track in tracks_raw:
-        track_id = track.get("id")
-        if not track_id and "external_urls" in track:
-            ext = track["external_urls"]
-            if isinstance(ext, dict): track_id = ext.get("spotify", "").split("/")[-1]
-            elif isinstance(ext, str): track_id = ext.split("/")[-1]
-
-        if not track_id or any(t.id == track_id for t in config.tracks):
-            continue
-
-        track_cover = extract_cover_art(track)
-        if not track_cover:
-            track_cover = album_cover
-
-        artist_names = format_artists(track.get("artists", []))
-
-        config.tracks.append(Track(
-            external_urls=f"https://open.spotify.com/track/{track_id}",
-            title=track.get("name", "Unknown Title"),
-            artists=artist_names,
-            album=config.album_or_playlist_name,
-            album_artist=main_album_artist, # Usa o artista do álbum extraído acima
-            track_number=track.get("track_number", 0),
-            duration_ms=track.get("duration_ms", 0),
-            id=track_id,
-            isrc=track.get("isrc", ""), 
-            release_date=album_release_date,
-            cover_url=track_cover
-        ))
-
+def handle_album_metadata(config, album_data):
+    config.album_or_playlist_name = album_data.get("name", "Unknown Album")
+    config.total_tracks = album_data.get("total_tracks", 0)
     config.is_album = True
     config.is_playlist = config.is_single_track = False
 
 
-def handle_playlist_metadata(playlist_data):
-    info = playlist_data.get("playlist_info", playlist_data)
-    config.album_or_playlist_name = info.get("name", "Unknown Playlist")
-    
-    playlist_cover = extract_cover_art(info)
-    
-    tracks_raw = playlist_data.get("track_list", [])
-    if not tracks_raw and "tracks" in playlist_data:
-        tracks_raw = playlist_data["tracks"].get("items", [])
-
-    for item in tracks_raw:
-        track = item.get("track", item)
-        if not track: continue 
-        
-        track_id = track.get("id")
-        if not track_id and "external_urls" in track:
-            ext = track["external_urls"]
-            if isinstance(ext, dict): track_id = ext.get("spotify", "").split("/")[-1]
-            elif isinstance(ext, str): track_id = ext.split("/")[-1]
-            
-        if not track_id or any(t.id == track_id for t in config.tracks):
-            continue
-        
-        track_cover = extract_cover_art(track)
-        if not track_cover:
-            track_cover = playlist_cover
-        
-        artist_names = format_artists(track.get("artists", []))
-        
-        # Pega album artist e release date do objeto album aninhado na track
-        alb = track.get("album", {})
-        album_name = alb.get("name", track.get("album_name", "Unknown Album"))
-        
-        if alb.get("artists"):
-            album_artist = format_artists(alb.get("artists"))
-        else:
-            album_artist = artist_names # Fallback
-
-        release_date = alb.get("release_date", "")
-
-        config.tracks.append(Track(
-            external_urls=f"https://open.spotify.com/track/{track_id}",
-            title=track.get("name", "Unknown Title"),
-            artists=artist_names,
-            album=album_name,
-            album_artist=album_artist,
-            track_number=track.get("track_number", len(config.tracks) + 1),
-            duration_ms=track.get("duration_ms", 0),
-            id=track_id,
-            isrc=track.get("isrc", ""),
-            release_date=release_date,
-            cover_url=track_cover
-        ))
-
+def handle_playlist_metadata(config, playlist_data):
+    config.album_or_playlist_name = playlist_data.get("name", "Unknown Playlist")
+    config.total_tracks = playlist_data.get("tracks", {}).get("total", 0)
     config.is_playlist = True
     config.is_album = config.is_single_track = False
 
 
-def download_tracks(indices):
-    if not config.tracks:
-        print("No tracks found to download.")
-        return
-
-    raw_outpath = config.output_dir
-    outpath = os.path.normpath(raw_outpath)
-    if not os.path.exists(outpath):
-        print('Warning: Invalid output directory. Please check if the folder exists.')
-        return
-
-    tracks_to_download = config.tracks if config.is_single_track else [config.tracks[i] for i in indices]
+def handle_artist_metadata(config, artist_data):
+    # A discography downloads like a playlist, so the artist/album subfolder options apply
+    config.album_or_playlist_name = artist_data.get("name", "Unknown Artist")
+    config.total_tracks = 0
+    config.is_playlist = config.is_discography = True
+    config.is_album = config.is_single_track = False
 
-    if config.is_album or config.is_playlist:
-        name = config.album_or_playlist_name.strip()
-        folder_name = re.sub(r'[<>:"/\\|?*]', '_', name)
-        outpath = os.path.join(outpath, folder_name)
-        os.makedirs(outpath, exist_ok=True)
 
+def tracks_from_page(config, header, items):
+    if config.is_album:
+        # Album track objects carry no ISRC; fetch the full objects 50 at a time for the new ids only
+        new_ids = [t["id"] for t in items if t.get("id") and t["id"] not in config.tracks]
+        if new_ids and header.get("_token"):
+            full_tracks = {t["id"]: t for t in get_tracks_by_ids(new_ids, header["_token"])}
+            items = [full_tracks.get(t.get("id"), t) for t in items]
+        return [Track.from_api(item, album=header) for item in items]
+
+    if config.is_discography:
+        return [Track.from_api(item) for item in items]
+
+    fallback_cover = extract_cover_art(header) if config.is_playlist else ""
+    return [Track.from_api(item, fallback_cover=fallback_cover) for item in items]
+
+
+def stream_tracks(config, pages):
+    # Yields each track once per run as soon as its page is in. A track another job is still
+    # downloading comes back as the shared stored object.
+    # A discography also skips recordings (same ISRC) already taken from an earlier release.
+    # Each page is journaled before its tracks are handed out, so a crash never loses a listed track.
+    seen = set()
+    seen_isrcs = set()
+    for header, items in pages:
+        page = []
+        for track in tracks_from_page(config, header, items):
+            if not track or track.id in seen:
+                continue
+            if config.is_discography and track.isrc:
+                if track.isrc in seen_isrcs:
+                    continue
+                seen_isrcs.add(track.isrc)
+            seen.add(track.id)
+            if not track.track_number:
+                track.track_number = len(seen)
+            page.append((len(seen), track))
+        if config.journal and page:
+            config.journal.add_tracks(config.url, page)
+        for _, track in page:
+            yield config.tracks.setdefault(track)
+    if config.journal:
+        config.journal.mark_listed(config.url)
+
+
+def download_tracks(config, tracks, scheduler):
     try:
-        start_download_worker(tracks_to_download, outpath)
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        print(f"Error starting download: {str(e)}")
+        raw_outpath = config.output_dir
+        outpath = os.path.normpath(raw_outpath)
+        if not os.path.exists(outpath):
+            print('Warning: Invalid output directory. Please check if the folder exists.')
+            return None
+
+        if config.is_album or config.is_playlist:
+            name = config.album_or_playlist_name.strip()
+            folder_name = re.sub(r'[<>:"/\\|?*]', '_', name)
+            outpath = os.path.join(outpath, folder_name)
+            os.makedirs(outpath, exist_ok=True)
 
-
-def start_download_worker(tracks_to_download, outpath):
+        try:
+            return start_download_worker(config, tracks, outpath, scheduler)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(f"Error starting download: {str(e)}")
+            return None
+    finally:
+        # Stops a metadata stream the worker didn't consume to the end (and its prefetch thread)
+        close = getattr(tracks, "close", None)
+        if close:
+            close()
+
+
+def start_download_worker(config, tracks_to_download, outpath, scheduler):
     config.worker = DownloadWorker(
         tracks_to_download,
         outpath,
@@ -320,11 +371,17 @@ def start_download_worker(tracks_to_download, outpath):
         config.use_artist_subfolders,
         config.use_album_subfolders,
         config.service,
+        config.total_tracks,
+        scheduler,
+        config.journal,
+        config.url,
+        config.retry_failed,
     )
-    config.worker.run()
+    config.worker.submit_all()
+    return config.worker
 
 
-def on_download_finished(success, message, failed_tracks, total_elapsed=None):
+def on_download_finished(success, message, failed_tracks, total_elapsed=None, timed_out=None):
     if success:
         print(f"\n=======================================")
         print(f"\nStatus: {message}")
@@ -333,18 +390,108 @@ def on_download_finished(success, message, failed_tracks, total_elapsed=None):
             for title, artists, error in failed_tracks:
                 print(f"• {title} - {artists}")
                 print(f"  Error: {error}\n")
+        if timed_out:
+            print("\nTimed out (will be retried on the next run):")
+            for title, artists, error in timed_out:
+                print(f"• {title} - {artists}")
+                print(f"  {error}\n")
     else:
         print(f"Error: {message}")
 
     if total_elapsed is not None:
         print(f"\nElapsed time for this download loop: {format_seconds(total_elapsed)}")
 
-    if config.loop is not None and config.loop > 0:
-        print(f"\nDownload starting again in: {format_minutes(config.loop)}")
-        print(f"\n=======================================")
-        time.sleep(config.loop * 60)
-        fetch_tracks(config.url)
-        download_tracks(range(len(config.tracks)))
+
+def format_limits(limits):
+    return ", ".join(f"{key} {l['limit']}/{l['ceiling']}" + (f" (cut {l['cuts']}x)" if l["cuts"] else "")
+                     for key, l in limits.items())
+
+
+def print_limits(scheduler):
+    # Where the adaptive concurrency limits stand; hosts only once they have been throttled
+    services = scheduler.limits.summary()
+    if services and (scheduler.max_concurrency > scheduler.concurrency or any(l["cuts"] for l in services.values())):
+        print(f"\nConcurrency per service: {format_limits(services)}")
+    hosts = {host: l for host, l in HOSTS.summary().items() if l["cuts"]}
+    if hosts:
+        print(f"Throttled hosts: {format_limits(hosts)}")
+
+
+def run_jobs(jobs, loop=None, concurrency=1, amazon_stream_decrypt=False, store=None, cache_dir=CACHE_DIR,
+             lookahead=LOOKAHEAD, strict_order=False, track_timeout=deadline.TRACK_BUDGET, max_concurrency=None,
+             rate_limit=None, service_rates=None, max_host_connections=0, shared_queue=False):
+    # All jobs share one scheduler: one pool of download slots, one set of service downloaders
+    # (sessions, tokens) and one track store for cross-job dedupe. With `shared_queue` this
+    # process is one of several workers taking tracks from the output directory's journal.
+    scheduler = DownloadScheduler(concurrency, amazon_stream_decrypt, store, cache_dir, lookahead, strict_order,
+                                  track_timeout, max_concurrency, rate_limit, service_rates, max_host_connections)
+    heartbeat = Heartbeat() if shared_queue else None
+    if heartbeat:
+        print(f"Worker {heartbeat.owner} sharing the journal with other workers")
+        heartbeat.start()
+    finished = False
+    try:
+        while True:
+            scheduler.start_pass()
+            start = time.perf_counter()
+            since = time.time()
+            workers = []
+            for job in jobs:
+                job.tracks = scheduler.tracks
+                job.journal = job.journal or open_journal(job.output_dir, shared=shared_queue)
+                if heartbeat and job.journal:
+                    heartbeat.watch(job.journal)
+                    tracks = lease_tracks(job, heartbeat.owner, since)
+                else:
+                    tracks = fetch_tracks(job)
+                worker = download_tracks(job, tracks, scheduler)
+                if worker:
+                    workers.append(worker)
+
+            for worker in workers:
+                worker.wait()
+                if len(jobs) > 1:
+                    print(f"\n[{worker.album_or_playlist_name}]", end="")
+                worker.finish()
+
+            if len(jobs) > 1:
+                print(f"\nElapsed time for all {len(jobs)} jobs: {format_seconds(time.perf_counter() - start)}")
+            print_limits(scheduler)
+
+            if loop is None or loop <= 0:
+                break
+            print(f"\nDownload starting again in: {format_minutes(loop)}")
+            print(f"\n=======================================")
+            time.sleep(loop * 60)
+        finished = True
+    finally:
+        # Only a normal exit drains the queue; on Ctrl-C just the running tracks finish
+        scheduler.shutdown(cancel=not finished)
+        if heartbeat:
+            heartbeat.stop()
+
+
+def run_job(job, scheduler):
+    # Runs one job to completion on a scheduler that outlives it (daemon mode)
+    job.tracks = scheduler.tracks
+    job.journal = job.journal or open_journal(job.output_dir)
+    worker = download_tracks(job, fetch_tracks(job), scheduler)
+    if worker:
+        worker.wait()
+        worker.finish()
+    return worker
+
+
+def open_journal(output_dir, shared=False):
+    # One journal per output directory, shared by every job writing there (and, with `shared`,
+    # by every worker process using that directory)
+    if not os.path.isdir(output_dir):
+        return None
+    try:
+        return DownloadJournal.for_output_dir(output_dir, shared)
+    except Exception as e:
+        print(f"Warning: download journal unavailable ({e}); progress will not be resumable.")
+        return None
 
 
 def update_progress(message):
@@ -368,6 +515,13 @@ def format_minutes(minutes):
         return f"{days} days {hours} hours {mins} minutes"
 
 
+def temp_format(svc, track):
+    # Filename format a backend writes the track under before it is renamed into place. Unique per
+    # track and service, so concurrent tracks in one folder never share a file, and stable across
+    # runs.
+    return f"{{title}} [{svc} {track.id}]"
+
+
 def format_seconds(seconds: float) -> str:
     seconds = int(round(seconds))
     days, rem = divmod(seconds, 86400)
@@ -422,10 +576,136 @@ def format_custom_filename(template: str, track, position: int = 1) -> str:
     return re.sub(r'\s+', ' ', result).strip()
 
 
+def service_overloaded(error):
+    # Throttling, network trouble and attempts that ran out of time; a missing track is neither
+    return is_overload(error) or isinstance(error, deadline.DeadlineExceeded)
+
+
+class DownloadScheduler:
+    def __init__(self, concurrency=1, amazon_stream_decrypt=False, store=None, cache_dir=CACHE_DIR, lookahead=LOOKAHEAD,
+                 strict_order=False, track_budget=deadline.TRACK_BUDGET, max_concurrency=None,
+                 rate_limit=None, service_rates=None, max_host_connections=0):
+        self.concurrency = max(1, concurrency)
+        # Ceiling the per-service limits may grow to from `concurrency`
+        self.max_concurrency = max(self.concurrency, max_concurrency or 0)
+        self.amazon_stream_decrypt = amazon_stream_decrypt
+        # Optional LibraryStore: one copy per ISRC, linked into every folder that lists it
+        self.store = store
+        # Persistent caches live under cache_dir; None (--no-cache) keeps them in memory only
+        self.cache_dir = os.path.expanduser(cache_dir) if cache_dir else None
+        self.covers = CoverCache(os.path.join(self.cache_dir, "covers") if self.cache_dir else None)
+        # Up to `max_concurrency` tracks transfer at once; a track whose transfer is done hands its
+        # network slot over to the ffmpeg/tagging stage, so the pool has threads for both and the
+        # CPU stage's bounded queue is the backpressure. No more than `max_concurrency` transfers
+        # finish together, so the CPU stage is sized from that rather than from the core count.
+        self.post = PostProcessor(min(cpu_workers(), self.max_concurrency), self.max_concurrency)
+        self.post.network = threading.BoundedSemaphore(self.max_concurrency)
+        self.pool = ThreadPoolExecutor(max_workers=self.max_concurrency + self.post.capacity)
+        # Queued plus running tracks across all jobs: one ready track per transfer slot, the
+        # transfers and the CPU stage. Keeps memory bounded by the window.
+        self.window = threading.BoundedSemaphore(2 * self.max_concurrency + self.post.capacity)
+        # Tracks per service at once: starts at `concurrency`, grows by one while attempts succeed
+        # and halves on throttling, network errors or attempts that run out of time
+        self.limits = LimitGroup(self.concurrency, self.max_concurrency, service_overloaded)
+        # Bytes per second in total and per service, and open streams per host (None/0: no limit),
+        # for this scheduler's downloaders only
+        self.bandwidth = Bandwidth()
+        self.bandwidth.configure(rate_limit, service_rates, max_host_connections)
+        self.tracks = TrackStore()
+        # Service ids and stream URLs for the next `lookahead` tracks, resolved while others transfer
+        self.lookahead = Lookahead(lookahead, workers=self.concurrency)
+        # Service track lists of recent albums, so an album's tracks resolve from one listing
+        self.albums = AlbumIndex()
+        # Tracks known to be missing on a service, skipped there until their recheck time; with
+        # --no-cache they are only remembered for this process
+        self.misses = NegativeCache.open_default(self.cache_dir) if self.cache_dir else NegativeCache(":memory:")
+        # Per-track service order from observed success rate and latency (--strict-order: as given),
+        # with the history of earlier runs from the cache directory
+        stats = StatsStore.open_default(self.cache_dir) if self.cache_dir and not strict_order else None
+        self.ranker = ServiceRanker(strict_order, stats)
+        # Seconds one track may take across all its service attempts (0: no limit)
+        self.track_budget = track_budget
+        self.lock = threading.Lock()
+        self.claims = {}
+        self.downloaders = {}
+
+    def start_pass(self):
+        # Tracks that failed in the previous --loop pass get a fresh attempt
+        with self.lock:
+            self.claims.clear()
+
+    def forget_tracks(self):
+        # Drops what finished jobs left behind (known tracks, claims), so a scheduler that lives as
+        # long as the daemon stays small; only called while no job is running
+        with self.lock:
+            self.claims.clear()
+            self.tracks = TrackStore()
+
+    def submit(self, fn, *args):
+        self.window.acquire()
+        try:
+            future = self.pool.submit(fn, *args)
+        except BaseException:
+            self.window.release()
+            raise
+        future.add_done_callback(lambda _: self.window.release())
+        return future
+
+    def claim(self, track_id):
+        # First caller owns the download and gets (future, True); later callers, e.g. the same
+        # track in another playlist, get (future, False) and wait for the owner's file instead.
+        with self.lock:
+            future = self.claims.get(track_id)
+            if future is not None and (not future.done() or self._usable(future.result())):
+                return future, False
+            future = Future()
+            self.claims[track_id] = future
+            return future, True
+
+    @staticmethod
+    def _usable(path):
+        # A failed claim, or one whose file was moved away since, does not block a new attempt
+        return bool(path) and os.path.exists(path)
+
+    def get_downloader(self, svc):
+        with self.lock:
+            downloader = self.downloaders.get(svc)
+            if downloader is None:
+                if svc == "deezer": downloader = DeezerDownloader()
+                elif svc == "qobuz": downloader = QobuzDownloader()
+                elif svc == "amazon":
+                    downloader = AmazonDownloader()
+                    downloader.stream_decrypt = self.amazon_stream_decrypt
+                else: downloader = TidalDownloader()
+                downloader.set_progress_callback(progress_update)
+                downloader.post = self.post
+                downloader.session.bandwidth = self.bandwidth
+                downloader.covers = self.covers
+                self.downloaders[svc] = downloader
+            return downloader
+
+    def shutdown(self, cancel=False):
+        # cancel (Ctrl-C): the tracks already running finish, queued ones are dropped. A dropped
+        # future still runs its done-callbacks, which release its window permit; it never took
+        # a claim, as claims are taken by running tracks, which resolve them on the way out.
+        self.pool.shutdown(wait=not cancel, cancel_futures=cancel)
+        self.post.shutdown()
+        self.covers.close()
+        self.lookahead.shutdown()
+        if self.misses:
+            self.misses.close()
+
+
+def progress_update(current, total):
+    if total <= 0:
+        update_progress("Processing metadata...")
+
+
 class DownloadWorker:
     def __init__(self, tracks, outpath, is_single_track=False, is_album=False, is_playlist=False,
                  album_or_playlist_name='', filename_format='{title} - {artist}', use_track_numbers=True,
-                 use_artist_subfolders=False, use_album_subfolders=False, services=["tidal"]):
+                 use_artist_subfolders=False, use_album_subfolders=False, services=["tidal"],
+                 total_tracks=0, scheduler=None, journal=None, job_key="", recheck=False):
         super().__init__()
         self.tracks = tracks
         self.outpath = outpath
@@ -438,7 +718,19 @@ class DownloadWorker:
         self.use_artist_subfolders = use_artist_subfolders
         self.use_album_subfolders = use_album_subfolders
         self.services = services
+        self.total_tracks = total_tracks
+        self.scheduler = scheduler or DownloadScheduler()
+        self.journal = journal
+        self.job_key = job_key
+        # Try every service again, even ones the negative cache says the track isn't on
+        self.recheck = recheck
         self.failed_tracks = []
+        self.timed_out = []
+        self.pending = 0
+        self.scheduled = 0
+        self.done = threading.Condition()
+        self.start = 0.0
+        self.elapsed = None
 
     def get_formatted_filename(self, track, position=1):
         if self.filename_format in ["title_artist", "artist_title", "title_only"]:
@@ -451,169 +743,516 @@ class DownloadWorker:
             return re.sub(r'[<>:"/\\|?*]', lambda m: "'" if m.group() == '"' else '_', filename)
         return format_custom_filename(self.filename_format, track, position)
 
-    def run(self):
-        try:
-            total_tracks = len(self.tracks)
-            start = time.perf_counter()
-
-            def progress_update(current, total):
-                if total <= 0:
-                    update_progress("Processing metadata...")
+    def target(self, track, i):
+        # (journal entry, position, folder, file path) the track is downloaded to
+        entry = self.journal.get(self.job_key, track.id) if self.journal else None
+        if entry:
+            i = max(entry["position"] - 1, 0)
+
+        track_outpath = self.outpath
+        if self.is_playlist:
+            if self.use_artist_subfolders:
+                artist_folder = re.sub(r'[<>:"/\\|?*]', '_', track.artists.split(", ")[0])
+                track_outpath = os.path.join(track_outpath, artist_folder)
+            if self.use_album_subfolders:
+                album_folder = re.sub(r'[<>:"/\\|?*]', '_', track.album)
+                track_outpath = os.path.join(track_outpath, album_folder)
+
+        new_filepath = os.path.join(track_outpath, self.get_formatted_filename(track, i + 1))
+        return entry, i, track_outpath, new_filepath
+
+    def needs_transfer(self, track, i):
+        # Cheap pre-check for the lookahead: False when download_track would skip or link the track
+        entry, i, _, new_filepath = self.target(track, i)
+        if entry and entry["status"] == "done" and entry["path"] and os.path.exists(entry["path"]):
+            return False
+        if os.path.exists(new_filepath) and os.path.getsize(new_filepath) > 0:
+            return False
+        store = self.scheduler.store if track.isrc else None
+        return not (store and store.find(track.isrc))
+
+    def speculate(self, track):
+        # Runs on the lookahead pool: the id and stream URL on the service the track will try first
+        entry = self.journal.get(self.job_key, track.id) if self.journal else None
+        resolved = entry["resolved"] if entry else {}
+        misses, key = self.miss_cache(), track_key(track)
+        svc = next((s for s in self.service_order(track) if not (misses and misses.blocked(key, s))), None)
+        if svc is None or (svc in ("tidal", "deezer", "qobuz") and not track.isrc):
+            return None
+        downloader = self.scheduler.get_downloader(svc)
+        resolved_id, info = resolved.get(svc), None
+        if not resolved_id:
+            resolved_id, info = self.resolve(svc, downloader, track)
+        if not resolved_id:
+            return None
+        stream = self.stream_url(svc, downloader, resolved_id)
+        url = stream[0] if isinstance(stream, tuple) else stream
+        return Resolution(svc, resolved_id, info, stream, url_expiry(url))
+
+    def download_track(self, track, i, total_tracks):
+        key = (id(self), i)
+        entry, i, track_outpath, new_filepath = self.target(track, i)
+        # Journaled as done: trust it instead of re-checking the folder or any service
+        if entry and entry["status"] == "done" and entry["path"] and os.path.exists(entry["path"]):
+            update_progress(f"Already downloaded (journal): {os.path.basename(entry['path'])}")
+            track.downloaded = True
+            return
+
+        update_progress(f"[{i + 1}/{total_tracks or '?'}] Starting download: {track.title} - {track.artists}")
+
+        if self.is_playlist:
+            os.makedirs(track_outpath, exist_ok=True)
+        new_filename = os.path.basename(new_filepath)
+
+        store = self.scheduler.store if track.isrc else None
+        if os.path.exists(new_filepath) and os.path.getsize(new_filepath) > 0:
+            update_progress(f"File already exists: {new_filename}. Skipping download.")
+            track.downloaded = True
+            if store:
+                # Files from before the store existed become available to every other folder
+                store.adopt(new_filepath, track.isrc)
+            self.journal_done(track, "existing", new_filepath)
+            return
+
+        stored = store.find(track.isrc) if store else None
+        if stored:
+            store.link(stored, new_filepath)
+            update_progress(f"Linked from library store: {new_filename}")
+            track.downloaded = True
+            self.journal_done(track, "store", new_filepath)
+            return
+
+        # With a store, the same recording on another release (other track id, same ISRC) is shared too
+        claim, owner = self.scheduler.claim(track.isrc if store else track.id)
+        if not owner:
+            self.copy_claimed(track, claim, new_filepath)
+            return
 
-            for i, track in enumerate(self.tracks):
-                if track.downloaded: continue
-
-                update_progress(f"[{i + 1}/{total_tracks}] Starting download: {track.title} - {track.artists}")
-
-                track_outpath = self.outpath
-                if self.is_playlist:
-                    if self.use_artist_subfolders:
-                        artist_folder = re.sub(r'[<>:"/\\|?*]', '_', track.artists.split(", ")[0])
-                        track_outpath = os.path.join(track_outpath, artist_folder)
-                    if self.use_album_subfolders:
-                        album_folder = re.sub(r'[<>:"/\\|?*]', '_', track.album)
-                        track_outpath = os.path.join(track_outpath, album_folder)
-                    os.makedirs(track_outpath, exist_ok=True)
-
-                new_filename = self.get_formatted_filename(track, i + 1)
-                new_filepath = os.path.join(track_outpath, new_filename)
+        try:
+            resolved = entry["resolved"] if entry else {}
+            ahead = self.scheduler.lookahead.take(key)
+            with deadline.budget(self.scheduler.track_budget):
+                self.download_with_services(track, i, track_outpath, new_filepath, resolved, ahead)
+            if store and track.downloaded:
+                store.adopt(new_filepath, track.isrc)
+        finally:
+            claim.set_result(new_filepath if track.downloaded else None)
+
+    def copy_claimed(self, track, claim, new_filepath):
+        # Same track already resolved by another job in this process: reuse its file
+        source = claim.result()
+        if not source or not os.path.exists(source):
+            self.track_failed(track, "Download failed in another job")
+            return
+        store = self.scheduler.store if track.isrc else None
+        stored = store.find(track.isrc) if store else None
+        if stored:
+            store.link(stored, new_filepath)
+        elif source != new_filepath:
+            shutil.copyfile(source, new_filepath)
+        update_progress(f"Reused download from another job: {os.path.basename(new_filepath)}")
+        track.downloaded = True
+        self.journal_done(track, "copy", new_filepath)
+
+    def service_order(self, track):
+        return self.scheduler.ranker.order(track, self.services)
+
+    def miss_cache(self):
+        return None if self.recheck else self.scheduler.misses
+
+    def journal_done(self, track, svc, path):
+        if self.journal:
+            self.journal.record_done(self.job_key, track.id, svc, path)
+
+    def track_failed(self, track, error, timed_out=False):
+        if timed_out:
+            self.timed_out.append((track.title, track.artists, error))
+            update_progress("[T] Ran out of time")
+        else:
+            self.failed_tracks.append((track.title, track.artists, error))
+            update_progress(f"[X] Failed all services")
+        if self.journal:
+            self.journal.record_failed(self.job_key, track.id, error)
+
+    def resolve(self, svc, downloader, track):
+        # Returns (service id worth journaling, full lookup result for the download right after)
+        if svc == "amazon":
+            return downloader.get_amazon_url_from_spotify(track.id), None
+        search = lambda: self.lookup(svc, downloader, track)
+        if self.is_album:
+            # One lookup anchors the album on the service; its track list resolves the others
+            info = self.scheduler.albums.resolve(svc, self.job_key, track.isrc, search,
+                                                 lambda found: self.album_tracks(svc, downloader, found))
+        else:
+            info = self.scheduler.albums.find(svc, track.isrc) or search()
+        return info.get("id"), info
+
+    def lookup(self, svc, downloader, track):
+        if svc == "tidal":
+            return downloader.search_track_by_metadata_with_isrc(f"{track.title} {track.artists}", "", track.isrc, 0)
+        if svc == "deezer":
+            return downloader.find_track_by_isrc(track.isrc)
+        if svc == "qobuz":
+            return downloader._search_by_isrc(track.isrc)
+        raise Exception(f"Unknown service: {svc}")
+
+    def album_tracks(self, svc, downloader, info):
+        album = info.get("album") or {}
+        if not album.get("id"):
+            return []
+        if svc == "deezer":
+            return downloader.get_album_tracks(album)
+        return downloader.get_album_tracks(album["id"])
+
+    def stream_url(self, svc, downloader, resolved_id):
+        # What each backend needs to start the transfer; these expire, unlike the ids above
+        if svc == "tidal":
+            return downloader.get_download_url(resolved_id, "LOSSLESS")
+        if svc == "deezer":
+            return downloader.get_flac_url(resolved_id)
+        if svc == "qobuz":
+            return downloader.get_download_url(resolved_id, "6", True)
+        if svc == "amazon":
+            return downloader.get_stream_info(resolved_id)
+        raise Exception(f"Unknown service: {svc}")
+
+    def download_with_services(self, track, i, track_outpath, new_filepath, resolved=None, ahead=None):
+        resolved = resolved or {}
+        download_success = False
+        last_error = None
+        timed_out = False
+        misses, key, skipped = self.miss_cache(), track_key(track), []
+        order = self.service_order(track)
+        blocked = {svc: misses.blocked(key, svc) if misses else None for svc in order}
+        track_deadline = deadline.current()
+
+        for n, svc in enumerate(order):
+            miss = blocked[svc]
+            if miss:
+                skipped.append(f"{svc}: {miss['reason']}")
+                update_progress(f"[-] Skipping {svc}: not available last time ({miss['reason']}), "
+                                f"rechecking in {format_seconds(miss['retry_at'] - time.time())}")
+                continue
+            if track_deadline is not None and track_deadline.expired:
+                timed_out = True
+                last_error = f"Timed out: no time left to try {svc}"
+                update_progress(f"[T] Track time budget used up before {svc}")
+                break
+            update_progress(f"Trying service: {svc}")
+
+            downloader = self.scheduler.get_downloader(svc)
+            # This attempt may use its share of the remaining budget; the rest stays for fallbacks
+            fallbacks = sum(1 for later in order[n + 1:] if not blocked[later])
+            share = deadline.attempt_budget(track_deadline.remaining(), fallbacks) if track_deadline else None
+            attempt = None
+            # Set once the attempt is admitted: waiting for a slot says nothing about the service
+            started = None
+
+            try:
+                # A slot under the service's own limit first, so a throttled service queues its
+                # tracks without holding network slots the other services could use. Reaching the
+                # CPU stage hands the network slot back for good.
+                with deadline.budget(share) as attempt, bandwidth.service(svc) as throttle, \
+                        self.scheduler.limits.slot(svc, attempt.remaining() if attempt else None), \
+                        self.scheduler.post.network_slot():
+                    started = time.perf_counter()
+                    if svc in ("tidal", "deezer", "qobuz") and not track.isrc:
+                        raise Exception(f"No ISRC for {svc.capitalize()}")
+
+                    # Ids resolved by an earlier, interrupted run come from the journal, ids and stream
+                    # URLs resolved while earlier tracks were transferring from the lookahead
+                    resolved_id, info, stream = resolved.get(svc), None, None
+                    if ahead is not None and ahead.svc == svc:
+                        resolved_id, info, stream = ahead.id, ahead.info, ahead.fresh_stream()
+                    if not resolved_id:
+                        resolved_id, info = self.resolve(svc, downloader, track)
+                    if self.journal and resolved_id and resolved_id != resolved.get(svc):
+                        self.journal.set_resolved(self.job_key, track.id, svc, resolved_id)
 
-                if os.path.exists(new_filepath) and os.path.getsize(new_filepath) > 0:
-                    update_progress(f"File already exists: {new_filename}. Skipping download.")
-                    track.downloaded = True
+                    try:
+                        downloaded_file = self.fetch(svc, downloader, track, i, track_outpath, resolved_id, info, stream)
+                    except Exception as e:
+                        if stream is None or attempt is not None and attempt.expired:
+                            raise
+                        # Prefetched URL went stale in a way its expiry didn't show: ask for a new one
+                        update_progress(f"[!] Prefetched {svc} URL failed ({e}), requesting a new one")
+                        downloaded_file = self.fetch(svc, downloader, track, i, track_outpath, resolved_id, info, None)
+
+                    if downloaded_file and os.path.exists(downloaded_file):
+                        if downloaded_file != new_filepath:
+                            try:
+                                if os.path.exists(new_filepath): os.remove(new_filepath)
+                                os.rename(downloaded_file, new_filepath)
+                            except OSError as e:
+                                update_progress(f"[!] Rename failed: {e}")
+                        update_progress(f"Successfully downloaded using: {svc}")
+                        track.downloaded = True
+                        download_success = True
+                        self.journal_done(track, svc, new_filepath if os.path.exists(new_filepath) else downloaded_file)
+                        # Partials an earlier service left for this track will never be resumed now
+                        transfer.discard_partials(track_outpath, track.id)
+                        if self.scheduler.misses:
+                            self.scheduler.misses.clear(key, svc)
+                        self.scheduler.ranker.record(track, svc, True, time.perf_counter() - started - throttle.seconds)
+                        break
+                    else:
+                        raise Exception("File missing after download")
+
+            except Exception as e:
+                if started is None or isinstance(e, SlotTimeout):
+                    # Waited too long for one of our own slots: says nothing about the service
+                    timed_out = timed_out or (attempt is not None and attempt.expired)
+                    last_error = f"No free slot for {svc}: {e}"
+                    update_progress(f"[T] {svc} skipped, {e}")
                     continue
+                # Timed from admission, so time spent waiting for a slot or held back by the
+                # bandwidth limits isn't counted against the service
+                elapsed = time.perf_counter() - started
+                self.scheduler.ranker.record(track, svc, False, elapsed - throttle.seconds)
+                if isinstance(e, deadline.DeadlineExceeded) or (attempt is not None and attempt.expired):
+                    # Ran out of its share of the budget: not evidence the track is missing there
+                    timed_out = True
+                    last_error = f"Timed out on {svc} after {format_seconds(elapsed)}: {e}"
+                    update_progress(f"[T] {svc} ran out of time after {format_seconds(elapsed)}")
+                    continue
+                last_error = str(e)
+                update_progress(f"[X] {svc} failed: {e}")
+                if self.scheduler.misses and isinstance(e, TrackUnavailable):
+                    ttl = self.scheduler.misses.record(key, svc, last_error)
+                    update_progress(f"    not trying {svc} again for this track for {format_seconds(ttl)}")
+                continue
+
+        if not download_success:
+            if last_error is None and skipped:
+                last_error = "Not available on any service (cached): " + "; ".join(skipped)
+            self.track_failed(track, last_error, timed_out)
+
+    def fetch(self, svc, downloader, track, i, track_outpath, resolved_id, info, stream):
+        # One backend download; `stream` is a prefetched stream URL (None: the backend gets one)
+        # --- TIDAL ---
+        if svc == "tidal":
+            result = downloader.download(
+                query=f"{track.title} {track.artists}",
+                isrc=track.isrc,
+                output_dir=track_outpath,
+                quality="LOSSLESS",
+                track_info=info,
+                track_id=resolved_id,
+                download_url=stream,
+                filename_format=temp_format(svc, track),
+            )
+            if isinstance(result, str) and os.path.exists(result): return result
+            elif isinstance(result, dict) and result.get("success") is False: raise Exception(result.get("error"))
+            else: raise Exception("Tidal download failed (unknown result)")
+
+        # --- DEEZER ---
+        elif svc == "deezer":
+            downloaded_file = asyncio.run(downloader.download_by_isrc(
+                track.isrc, track_outpath, track_data=info, track_id=resolved_id, flac_url=stream,
+                filename_format=temp_format(svc, track)))
+            if not downloaded_file: raise Exception("Deezer download failed")
+            return downloaded_file
+
+        # --- QOBUZ ---
+        elif svc == "qobuz":
+            return downloader.download_by_isrc(
+                isrc=track.isrc,
+                output_dir=track_outpath,
+                quality="6",
+                filename_format=temp_format(svc, track),
+                include_track_number=False,
+                position=track.track_number or i + 1,
+                spotify_track_name=track.title,
+                spotify_artist_name=track.artists,
+                spotify_album_name=track.album,
+                spotify_album_artist=track.album_artist,
+                spotify_release_date=track.release_date, 
+                use_album_track_number=self.use_track_numbers,
+                spotify_cover_url=track.cover_url,
+                qobuz_track=info,
+                qobuz_track_id=resolved_id,
+                download_url=stream,
+            )
+
+        # --- AMAZON ---
+        elif svc == "amazon":
+            return downloader.download_by_spotify_id(
+                spotify_track_id=track.id,
+                amazon_url=resolved_id,
+                stream_info=stream,
+                output_dir=track_outpath,
+                filename_format=temp_format(svc, track),
+                include_track_number=self.use_track_numbers,
+                position=track.track_number or i + 1,
+                spotify_track_name=track.title,
+                spotify_artist_name=track.artists,
+                spotify_album_name=track.album,
+                spotify_album_artist=track.album_artist, 
+                spotify_release_date=track.release_date, 
+                use_album_track_number=self.use_track_numbers,
+                spotify_cover_url=track.cover_url
+            )
+        return None
+
+    def _track_done(self, future, track, key):
+        self.scheduler.lookahead.discard(key)
+        self.scheduler.tracks.finish(track)
+        error = None if future.cancelled() else future.exception()
+        if error is not None:
+            self.failed_tracks.append((track.title, track.artists, str(error)))
+            update_progress(f"[X] {track.title} - {track.artists}: {error}")
+            if self.journal:
+                # Also hands its lease back when other workers share the journal
+                self.journal.record_failed(self.job_key, track.id, str(error))
+        with self.done:
+            self.pending -= 1
+            if not self.pending:
+                self.elapsed = time.perf_counter() - self.start
+            self.done.notify_all()
+
+    def submit_all(self):
+        # Tracks are pulled lazily from the metadata stream and handed to the shared scheduler,
+        # which blocks once its window is full, so downloads start on the first page and only
+        # the window's Track objects are held, not the whole playlist's.
+        total_tracks = self.total_tracks or (len(self.tracks) if hasattr(self.tracks, "__len__") else 0)
+        self.start = time.perf_counter()
+        lookahead = self.scheduler.lookahead
+        for i, track in enumerate(self.tracks):
+            key = (id(self), i)
+            # Resolution starts now and is bounded by the lookahead window; the transfer picks it up
+            if lookahead.window and self.needs_transfer(track, i):
+                lookahead.schedule(key, self.speculate, track)
+            with self.done:
+                self.pending += 1
+            self.scheduled += 1
+            future = self.scheduler.submit(self.download_track, track, i, total_tracks)
+            future.add_done_callback(lambda f, t=track, k=key: self._track_done(f, t, k))
+
+    def wait(self):
+        with self.done:
+            while self.pending:
+                self.done.wait()
+
+    def finish(self):
+        if self.journal:
+            self.journal.finish_job(self.job_key)
+        if not self.scheduled:
+            print("No tracks found to download.")
+            return
+        on_download_finished(True, "Download completed!", self.failed_tracks, self.elapsed, self.timed_out)
 
-                download_success = False
-                last_error = None
-
-                for svc in self.services:
-                    update_progress(f"Trying service: {svc}")
-                    
-                    if svc == "tidal": downloader = TidalDownloader()
-                    elif svc == "deezer": downloader = DeezerDownloader()
-                    elif svc == "qobuz": downloader = QobuzDownloader()
-                    elif svc == "amazon": downloader = AmazonDownloader()
-                    else: downloader = TidalDownloader()
-
-                    downloader.set_progress_callback(progress_update)
+    def run(self):
+        try:
+            self.submit_all()
+            self.wait()
+            self.finish()
+        except Exception as e:
+            on_download_finished(False, str(e), self.failed_tracks)
 
-                    try:
-                        downloaded_file = None
-                        
-                        # --- TIDAL ---
-                        if svc == "tidal":
-                            if not track.isrc: raise Exception("No ISRC for Tidal")
-                            result = downloader.download(
-                                query=f"{track.title} {track.artists}",
-                                isrc=track.isrc,
-                                output_dir=track_outpath,
-                                quality="LOSSLESS",
-                            )
-                            if isinstance(result, str) and os.path.exists(result): downloaded_file = result
-                            elif isinstance(result, dict) and result.get("success") is False: raise Exception(result.get("error"))
-                            else: raise Exception("Tidal download failed (unknown result)")
-
-                        # --- DEEZER ---
-                        elif svc == "deezer":
-                            if not track.isrc: raise Exception("No ISRC for Deezer")
-                            ok = asyncio.run(downloader.download_by_isrc(track.isrc, track_outpath))
-                            if not ok: raise Exception("Deezer download failed")
-                            import glob
-                            flac_files = glob.glob(os.path.join(track_outpath, "*.flac"))
-                            if flac_files: downloaded_file = max(flac_files, key=os.path.getctime)
-
-                        # --- QOBUZ ---
-                        elif svc == "qobuz":
-                            if not track.isrc: raise Exception("No ISRC for Qobuz")
-                            downloaded_file = downloader.download_by_isrc(
-                                isrc=track.isrc,
-                                output_dir=track_outpath,
-                                quality="6",
-                                filename_format=self.filename_format.replace("{title}", "temp_qobuz").replace("{artist}", "temp"),
-                                include_track_number=False,
-                                position=track.track_number or i + 1,
-                                spotify_track_name=track.title,
-                                spotify_artist_name=track.artists,
-                                spotify_album_name=track.album,
-                                spotify_album_artist=track.album_artist,
-                                spotify_release_date=track.release_date, 
-                                use_album_track_number=self.use_track_numbers,
-                                spotify_cover_url=track.cover_url
-                            )
-
-                        # --- AMAZON ---
-                        elif svc == "amazon":
-                            downloaded_file = downloader.download_by_spotify_id(
-                                spotify_track_id=track.id,
-                                output_dir=track_outpath,
-                                filename_format="temp_amazon",
-                                include_track_number=self.use_track_numbers,
-                                position=track.track_number or i + 1,
-                                spotify_track_name=track.title,
-                                spotify_artist_name=track.artists,
-                                spotify_album_name=track.album,
-                                spotify_album_artist=track.album_artist, 
-                                spotify_release_date=track.release_date, 
-                                use_album_track_number=self.use_track_numbers,
-                                spotify_cover_url=track.cover_url
-                            )
-
-                        if downloaded_file and os.path.exists(downloaded_file):
-                            if downloaded_file != new_filepath:
-                                try:
-                                    if os.path.exists(new_filepath): os.remove(new_filepath)
-                                    os.rename(downloaded_file, new_filepath)
-                                except OSError as e:
-                                    update_progress(f"[!] Rename failed: {e}")
-                            update_progress(f"Successfully downloaded using: {svc}")
-                            track.downloaded = True
-                            download_success = True
-                            break
-                        else:
-                            raise Exception("File missing after download")
 
-                    except Exception as e:
-                        last_error = str(e)
-                        update_progress(f"[X] {svc} failed: {e}")
-                        continue
+def read_urls(urls, urls_file=None):
+    # "-" as a URL or as --urls-file reads URLs from stdin; blank lines and # comments are skipped
+    lines = []
+    for url in urls:
+        if url == "-":
+            lines.extend(sys.stdin.read().splitlines())
+        else:
+            lines.append(url)
+    if urls_file:
+        if urls_file == "-":
+            lines.extend(sys.stdin.read().splitlines())
+        else:
+            with open(urls_file, encoding="utf-8") as f:
+                lines.extend(f.read().splitlines())
 
-                if not download_success:
-                    self.failed_tracks.append((track.title, track.artists, last_error))
-                    update_progress(f"[X] Failed all services")
+    result = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith("#") and line not in result:
+            result.append(line)
+    return result
 
-            total_elapsed = time.perf_counter() - start
-            on_download_finished(True, "Download completed!", self.failed_tracks, total_elapsed)
 
-        except Exception as e:
-            on_download_finished(False, str(e), self.failed_tracks)
+def service_rate(value):
+    # --service-rate SERVICE=RATE, for one of the services --service takes
+    try:
+        svc, rate = parse_service_rate(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    if svc not in SERVICES:
+        raise argparse.ArgumentTypeError(f"unknown service {svc!r} (choose from {', '.join(SERVICES)})")
+    return svc, rate
+
+
+def add_download_arguments(parser):
+    # Options that shape the download scheduler; shared by the CLI, launcher.py and the daemon
+    parser.add_argument("--service", choices=SERVICES, nargs="+", default=["tidal"], help="One or more services to try in order")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of tracks to download at once")
+    parser.add_argument("--amazon-stream-decrypt", action="store_true", help="Decrypt Amazon tracks while downloading instead of from a temporary file")
+    parser.add_argument("--store", help="Keep each recording once in this directory (by ISRC) and link it into the output folders")
+    parser.add_argument("--link-mode", choices=LINK_MODES, default="hardlink", help="How --store files appear in the output folders")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="Directory for the persistent caches (default: %(default)s)")
+    parser.add_argument("--no-cache", dest="cache_dir", action="store_const", const=None, help="Don't read or write the persistent caches")
+    parser.add_argument("--lookahead", type=int, default=LOOKAHEAD, help="Upcoming tracks to resolve (service id and stream URL) while others download; 0 disables")
+    parser.add_argument("--strict-order", action="store_true", help="Always try --service in the given order instead of the services that have worked best so far")
+    parser.add_argument("--track-timeout", type=float, default=deadline.TRACK_BUDGET, help="Seconds one track may take across all services before it is given up for this run; 0 disables")
+    parser.add_argument("--max-concurrency", type=int, help="Let each service's concurrency grow up to this while downloads succeed (default: --concurrency)")
+    parser.add_argument("--rate-limit", type=parse_rate, help="Total download rate in bytes per second, e.g. 500K or 10M")
+    parser.add_argument("--service-rate", type=service_rate, nargs="+", metavar="SERVICE=RATE", help="Download rate per service, e.g. tidal=5M qobuz=2M")
+    parser.add_argument("--max-host-connections", type=int, default=0, help="Open download streams per host at most (0: no limit)")
 
 
 def parse_args():
+    from SpotiFLAC.daemon import add_daemon_arguments
+
     parser = argparse.ArgumentParser()
-    parser.add_argument("url", help="Spotify URL")
+    parser.add_argument("url", nargs="*", help="One or more Spotify URLs, or - to read them from stdin")
     parser.add_argument("output_dir", help="Output directory")
-    parser.add_argument("--service", choices=["tidal", "deezer", "qobuz", "amazon"], nargs="+", default=["tidal"])
+    parser.add_argument("--urls-file", help="File with one Spotify URL per line (- for stdin)")
+    add_download_arguments(parser)
     parser.add_argument("--filename-format", default="{title} - {artist}")
     parser.add_argument("--use-track-numbers", action="store_true")
     parser.add_argument("--use-artist-subfolders", action="store_true")
     parser.add_argument("--use-album-subfolders", action="store_true")
     parser.add_argument("--loop", type=int, help="Loop delay in minutes")
-    return parser.parse_args()
-
-
-def SpotiFLAC(url, output_dir, services=["tidal"], filename_format="{title} - {artist}", use_track_numbers=False, use_artist_subfolders=False, use_album_subfolders=False, loop=None):
-    global config
-    config = Config(url, output_dir, services, filename_format, use_track_numbers, use_artist_subfolders, use_album_subfolders, False, False, False, "", [], None, loop)
+    parser.add_argument("--retry-failed", action="store_true", help="Only retry the tracks that failed in the journaled run of each URL")
+    parser.add_argument("--worker", action="store_true", help="Share the work with other SpotiFLAC workers using the same output directory (e.g. on a shared filesystem); without URLs, work on the unfinished jobs already there")
+    parser.add_argument("--daemon", action="store_true", help="Stay up and take jobs over a local HTTP API instead of downloading URLs")
+    add_daemon_arguments(parser)
+    args = parser.parse_args()
+    args.url = read_urls(args.url, args.urls_file)
+    if not args.url and not args.daemon and not args.worker:
+        parser.error("no Spotify URL given")
+    return args
+
+
+def SpotiFLAC(url, output_dir, services=["tidal"], filename_format="{title} - {artist}", use_track_numbers=False, use_artist_subfolders=False, use_album_subfolders=False, loop=None, concurrency=1, retry_failed=False, amazon_stream_decrypt=False, store_dir=None, link_mode="hardlink", cache_dir=CACHE_DIR, lookahead=LOOKAHEAD, strict_order=False, track_timeout=deadline.TRACK_BUDGET, max_concurrency=None, rate_limit=None, service_rates=None, max_host_connections=0, worker=False):
+    urls = [url] if isinstance(url, str) else list(url or [])
+    if worker and not urls:
+        # A worker started without URLs joins whatever the other workers haven't finished
+        journal = open_journal(output_dir, shared=True)
+        urls = journal.unfinished_jobs() if journal else []
+        if not urls:
+            print("No unfinished jobs in the shared journal.")
+            return
+    jobs = [
+        Config(u, output_dir, services, filename_format, use_track_numbers, use_artist_subfolders, use_album_subfolders, loop=loop, concurrency=concurrency, retry_failed=retry_failed)
+        for u in urls
+    ]
     try:
-        fetch_tracks(config.url)
-        download_tracks(range(len(config.tracks)))
+        store = LibraryStore(store_dir, link_mode) if store_dir else None
+        run_jobs(jobs, loop, concurrency, amazon_stream_decrypt, store, cache_dir, lookahead, strict_order, track_timeout, max_concurrency, rate_limit, service_rates, max_host_connections, worker)
     except KeyboardInterrupt:
         print("\nDownload stopped by user.")
 
 
 def main():
     args = parse_args()
-    SpotiFLAC(args.url, args.output_dir, args.service, args.filename_format, args.use_track_numbers, args.use_artist_subfolders, args.use_album_subfolders, args.loop)
+    if args.daemon:
+        from SpotiFLAC.daemon import run_daemon
+        run_daemon(args)
+        return
+    SpotiFLAC(args.url, args.output_dir, args.service, args.filename_format, args.use_track_numbers, args.use_artist_subfolders, args.use_album_subfolders, args.loop, args.concurrency, args.retry_failed, args.amazon_stream_decrypt, args.store, args.link_mode, args.cache_dir, args.lookahead, args.strict_order, args.track_timeout, args.max_concurrency, args.rate_limit, dict(args.service_rate or []), args.max_host_connections, args.worker)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,167 @@
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+import requests
+import urllib3
+
+# Additive increase: one more slot after a full limit's worth of successes with the limit in use
+INCREASE = 1.0
+# Multiplicative decrease on throttling, errors or a latency spike
+DECREASE = 0.5
+# An average response time this many times the host's usual one counts as congestion
+LATENCY_FACTOR = 3.0
+# Weight of the newest response in the latency average, and how fast the usual latency may rise
+LATENCY_ALPHA = 0.2
+BASELINE_DRIFT = 0.01
+# In-flight requests per host: where every host starts and the most it may reach
+HOST_LIMIT = 4
+HOST_LIMIT_MAX = 16
+# Statuses that mean the server wants fewer requests
+THROTTLE_STATUS = frozenset({429, 500, 502, 503, 504})
+
+# Backends report HTTP failures as text ("Status 503", "Jumo HTTP 429")
+_STATUS_TEXT = re.compile(r"\b(?:HTTP|[Ss]tatus)\s*(\d{3})\b")
+
+
+class SlotTimeout(TimeoutError):
+    # No slot came free under our own limit in time; says nothing about the other side
+    pass
+
+
+def is_overload(error: BaseException) -> bool:
+    # Errors that say the other side is overloaded or unreachable, rather than "not found"
+    if isinstance(error, SlotTimeout):
+        return False
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, urllib3.exceptions.ProtocolError,
+                          ConnectionError, TimeoutError)):
+        return True
+    response = getattr(error, "response", None)
+    if response is not None and getattr(response, "status_code", None) in THROTTLE_STATUS:
+        return True
+    match = _STATUS_TEXT.search(str(error))
+    return bool(match) and int(match.group(1)) in THROTTLE_STATUS
+
+
+class Permit:
+    # One slot held by a request; the holder reports the response before giving it back
+    def __init__(self, epoch: int, saturated: bool):
+        self.epoch = epoch
+        self.saturated = saturated
+        self.throttled = False
+        self.latency: Optional[float] = None
+
+    def response(self, status: int, latency: Optional[float] = None) -> None:
+        self.throttled = status in THROTTLE_STATUS
+        self.latency = latency
+
+
+class AIMDLimit:
+    # Concurrency limit that grows by one per round of successes and halves on congestion.
+    # Only requests started since the last cut can cut again, so one burst of failures from
+    # requests that were all in flight together halves the limit once, not once per request.
+    def __init__(self, initial: int, ceiling: int, track_latency: bool = False):
+        self.ceiling = max(1, ceiling)
+        self.limit = float(min(max(1, initial), self.ceiling))
+        self.track_latency = track_latency
+        self.in_flight = 0
+        self.successes = 0
+        self.cuts = 0
+        self.epoch = 0
+        self.latency: Optional[float] = None
+        self.baseline: Optional[float] = None
+        self.cond = threading.Condition()
+
+    def acquire(self, timeout: Optional[float] = None) -> Optional[Permit]:
+        # None if no slot came free within `timeout` seconds
+        end = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                left = None if end is None else end - time.monotonic()
+                if left is not None and left <= 0:
+                    return None
+                self.cond.wait(left)
+            self.in_flight += 1
+            return Permit(self.epoch, self.in_flight >= int(self.limit))
+
+    def release(self, permit: Permit, ok: Optional[bool]) -> None:
+        # ok: True succeeded, False congested, None neither (e.g. the track isn't there)
+        with self.cond:
+            self.in_flight -= 1
+            if ok and permit.latency is not None and self.track_latency and self._slower(permit.latency):
+                ok = False
+            if ok is False or permit.throttled:
+                self._cut(permit)
+            elif ok and permit.saturated:
+                self._grow()
+            self.cond.notify_all()
+
+    def _slower(self, latency: float) -> bool:
+        # Latency average against the usual latency, which follows drops at once and rises slowly
+        if self.latency is None:
+            self.latency = self.baseline = latency
+            return False
+        self.latency += LATENCY_ALPHA * (latency - self.latency)
+        self.baseline = min(self.latency, self.baseline + BASELINE_DRIFT * (self.latency - self.baseline))
+        return self.latency > LATENCY_FACTOR * max(self.baseline, 0.05)
+
+    def _cut(self, permit: Permit) -> None:
+        if permit.epoch != self.epoch:
+            return
+        self.epoch += 1
+        self.cuts += 1
+        self.successes = 0
+        self.limit = max(1.0, self.limit * DECREASE)
+
+    def _grow(self) -> None:
+        self.successes += 1
+        if self.successes >= int(self.limit):
+            self.successes = 0
+            self.limit = min(float(self.ceiling), self.limit + INCREASE)
+
+
+class LimitGroup:
+    # One AIMDLimit per key (service, host), created on first use. `congested` decides which
+    # exceptions raised while holding a slot count against the limit.
+    def __init__(self, initial: int, ceiling: int, congested: Callable[[BaseException], bool] = is_overload,
+                 track_latency: bool = False):
+        self.initial = initial
+        self.ceiling = ceiling
+        self.congested = congested
+        self.track_latency = track_latency
+        self.limits: Dict[str, AIMDLimit] = {}
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> AIMDLimit:
+        with self.lock:
+            limit = self.limits.get(key)
+            if limit is None:
+                limit = self.limits[key] = AIMDLimit(self.initial, self.ceiling, self.track_latency)
+            return limit
+
+    @contextmanager
+    def slot(self, key: str, timeout: Optional[float] = None):
+        limit = self.get(key)
+        permit = limit.acquire(timeout)
+        if permit is None:
+            raise SlotTimeout(f"no free slot for {key} (limit {int(limit.limit)})")
+        try:
+            yield permit
+        except BaseException as e:
+            limit.release(permit, False if self.congested(e) else None)
+            raise
+        limit.release(permit, True)
+
+    def summary(self) -> Dict[str, Dict]:
+        with self.lock:
+            limits = dict(self.limits)
+        return {
+            key: {"limit": int(l.limit), "ceiling": l.ceiling, "in_flight": l.in_flight, "cuts": l.cuts}
+            for key, l in sorted(limits.items())
+        }
+
+
+# Every backend session shares these, so parallel tracks, lookahead and segments to one host add up
+HOSTS = LimitGroup(HOST_LIMIT, HOST_LIMIT_MAX, track_latency=True)
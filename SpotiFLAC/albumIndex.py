@@ -0,0 +1,79 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, Hashable, List, Optional
+
+# Album track lists kept per process (each a few KB of track info)
+MAX_ALBUMS = 64
+
+
+def _isrc(value: Optional[str]) -> str:
+    return (value or "").strip().upper()
+
+
+class AlbumIndex:
+    # Service track info by ISRC, filled one album at a time. The first track of an album is
+    # looked up as usual; the album's track list then answers every other track of it locally.
+    def __init__(self, max_albums: int = MAX_ALBUMS):
+        self.max_albums = max_albums
+        self.albums: "OrderedDict[Hashable, Dict[str, Dict]]" = OrderedDict()
+        self.loading: Dict[Hashable, Future] = {}
+        self.lock = threading.Lock()
+
+    def find(self, svc: str, isrc: str) -> Optional[Dict]:
+        isrc = _isrc(isrc)
+        if not isrc:
+            return None
+        with self.lock:
+            for (album_svc, _), tracks in reversed(self.albums.items()):
+                if album_svc == svc and isrc in tracks:
+                    return tracks[isrc]
+        return None
+
+    def _add(self, key: Hashable, listing: List[Dict]) -> None:
+        tracks = {_isrc(t.get("isrc")): t for t in listing if _isrc(t.get("isrc"))}
+        with self.lock:
+            self.albums[key] = tracks
+            self.albums.move_to_end(key)
+            while len(self.albums) > self.max_albums:
+                self.albums.popitem(last=False)
+
+    def resolve(self, svc: str, album: Hashable, isrc: str, search: Callable[[], Dict],
+                album_tracks: Callable[[Dict], List[Dict]]) -> Dict:
+        # Track info for `isrc` on `svc`. `album` names the source album (e.g. the Spotify album
+        # URL); `search` is the per-track lookup and `album_tracks` lists the album its result is on.
+        key = (svc, album)
+        while True:
+            known = self.find(svc, isrc)
+            if known is not None:
+                return known
+            with self.lock:
+                if key in self.albums:
+                    # Album listed, but this track isn't on it (bonus track, other release)
+                    return search()
+                future = self.loading.get(key)
+                owner = future is None
+                if owner:
+                    future = self.loading[key] = Future()
+            if not owner:
+                future.result()
+                continue
+
+            try:
+                info = search()
+            except BaseException:
+                # Not found on this service: let the next track of the album try to anchor it
+                with self.lock:
+                    self.loading.pop(key, None)
+                future.set_result(None)
+                raise
+            try:
+                listing = album_tracks(info)
+            except Exception as e:
+                print(f"Warning: could not list the {svc} album ({e}); resolving its tracks one by one")
+                listing = []
+            self._add(key, listing or [info])
+            with self.lock:
+                self.loading.pop(key, None)
+            future.set_result(None)
+            return info
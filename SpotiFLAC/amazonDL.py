@@ -1,15 +1,18 @@
 import base64
-import json
+import io
+import itertools
 import os
 import re
 import subprocess
-from typing import Callable, Dict
+import threading
+from typing import Callable
 from urllib.parse import quote
 
-import requests
-from mutagen.flac import FLAC, Picture
-from mutagen.id3 import PictureType
-from mutagen.mp4 import MP4, MP4Cover
+from SpotiFLAC import tagging, transfer
+from SpotiFLAC.coverCache import COVERS
+from SpotiFLAC.deadline import DeadlineSession
+from SpotiFLAC.negativeCache import TrackUnavailable
+from SpotiFLAC.postProcess import INLINE
 
 class ProgressCallback:
     def __call__(self, current: int, total: int) -> None:
@@ -34,14 +37,111 @@ def safe_int(value) -> int:
     except (ValueError, TypeError):
         return 0
 
+# ffprobe codec names for the MP4 sample entry types Amazon serves
+MP4_CODECS = {b"fLaC": "flac", b"mp4a": "aac", b"alac": "alac", b"Opus": "opus", b"ec-3": "eac3", b"ac-3": "ac3"}
+# Containers walked on the way to moov/trak/mdia/minf/stbl/stsd
+MP4_CONTAINERS = {b"moov", b"trak", b"mdia", b"minf", b"stbl"}
+
+def _iter_boxes(f, start: int, end: int):
+    # Yields (type, payload_start, box_end) for each box between start and end, reading headers only
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size = int.from_bytes(header[:4], "big")
+        box_type = header[4:]
+        payload = pos + 8
+        if size == 1:
+            size = int.from_bytes(f.read(8), "big")
+            payload += 8
+        elif size == 0:
+            size = end - pos
+        if size < payload - pos:
+            return
+        yield box_type, payload, min(pos + size, end)
+        pos += size
+
+def _sample_entry_codec(f, entry_type: bytes, payload: int, end: int):
+    if entry_type not in (b"enca", b"encv"):
+        return MP4_CODECS.get(entry_type)
+    # Encrypted entry: the real format is in sinf/frma after the AudioSampleEntry fields
+    f.seek(payload + 8)
+    version = int.from_bytes(f.read(2), "big")
+    children = payload + 28 + {1: 16, 2: 36}.get(version, 0)
+    for box_type, box_payload, box_end in _iter_boxes(f, children, end):
+        if box_type == b"sinf":
+            for inner, inner_payload, _ in _iter_boxes(f, box_payload, box_end):
+                if inner == b"frma":
+                    f.seek(inner_payload)
+                    return MP4_CODECS.get(f.read(4))
+    return None
+
+def _sniff_codec(f, start: int, end: int):
+    for box_type, payload, box_end in _iter_boxes(f, start, end):
+        if box_type == b"stsd":
+            # full box header (4) + entry count (4), then the sample entries
+            for entry, entry_payload, entry_end in _iter_boxes(f, payload + 8, box_end):
+                codec = _sample_entry_codec(f, entry, entry_payload, entry_end)
+                if codec:
+                    return codec
+        elif box_type in MP4_CONTAINERS:
+            codec = _sniff_codec(f, payload, box_end)
+            if codec:
+                return codec
+    return None
+
+def sniff_mp4_codec(filepath: str):
+    # Codec of the first audio track from the stsd sample entry, or None if the layout is not recognised
+    try:
+        with open(filepath, "rb") as f:
+            return _sniff_codec(f, 0, os.fstat(f.fileno()).st_size)
+    except OSError:
+        return None
+
+# How much of the stream may be buffered while looking for moov before streaming gives up
+STREAM_HEAD_LIMIT = 16 * 1024 * 1024
+
+def read_mp4_head(chunks):
+    # Buffers top-level boxes from the chunk iterator up to and including moov.
+    # Returns (head, codec); codec is None when moov is not at the front (it comes after mdat,
+    # or not within STREAM_HEAD_LIMIT), in which case ffmpeg can't read the stream from a pipe.
+    head = bytearray()
+    pos = 0
+    for chunk in chunks:
+        head += chunk
+        while pos + 8 <= len(head):
+            size = int.from_bytes(head[pos:pos + 4], "big")
+            box_type = bytes(head[pos + 4:pos + 8])
+            if size == 1:
+                if pos + 16 > len(head):
+                    break
+                size = int.from_bytes(head[pos + 8:pos + 16], "big")
+            if box_type == b"mdat" or size < 8:
+                return head, None
+            if pos + size > len(head):
+                break
+            if box_type == b"moov":
+                return head, _sniff_codec(io.BytesIO(bytes(head)), pos, pos + size) or "m4a"
+            pos += size
+        if len(head) > STREAM_HEAD_LIMIT:
+            return head, None
+    return head, None
+
 class AmazonDownloader:
     def __init__(self, timeout: float = 120.0):
-        self.session = requests.Session()
-        self.session.timeout = timeout
+        self.session = DeadlineSession(timeout)
         self.session.headers.update({
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/144.0.0.0 Safari/537.36"
         })
         self.progress_callback: Callable[[int, int], None] = ProgressCallback()
+        # ffmpeg and tagging stage; the scheduler swaps in its shared PostProcessor
+        self.post = INLINE
+        # Album art shared across downloaders, so an album's cover is fetched once
+        self.covers = COVERS
+        # Pipe the encrypted stream straight into ffmpeg instead of writing it to disk first
+        self.stream_decrypt = False
 
     def set_progress_callback(self, callback: Callable[[int, int], None]) -> None:
         self.progress_callback = callback
@@ -58,7 +158,7 @@ class AmazonDownloader:
             
             links = data.get("linksByPlatform", {})
             if "amazonMusic" not in links:
-                raise Exception("Amazon Music link not found")
+                raise TrackUnavailable("Amazon Music link not found")
             
             amazon_url = links["amazonMusic"]["url"]
 
@@ -71,10 +171,15 @@ class AmazonDownloader:
             
             print(f"Found Amazon URL: {amazon_url}")
             return amazon_url
+        except TrackUnavailable:
+            raise
         except Exception as e:
             raise Exception(f"Error resolving Amazon URL: {e}")
 
     def _get_codec(self, filepath: str) -> str:
+        codec = sniff_mp4_codec(filepath)
+        if codec:
+            return codec
         try:
             cmd = [
                 get_ffprobe_path(), "-v", "quiet", "-select_streams", "a:0",
@@ -91,12 +196,16 @@ class AmazonDownloader:
         except:
             return "m4a"
 
-    def download_from_afkar_xyz(self, amazon_url: str, output_dir: str) -> str:
+    @staticmethod
+    def get_asin(amazon_url: str) -> str:
         asin_match = re.search(r'(B[0-9A-Z]{9})', amazon_url)
         if not asin_match:
             raise Exception(f"Failed to extract ASIN from: {amazon_url}")
-        asin = asin_match.group(1)
+        return asin_match.group(1)
 
+    def get_stream_info(self, amazon_url: str):
+        # (stream URL, decryption key or None) for an Amazon track URL
+        asin = self.get_asin(amazon_url)
         api_url = f"https://amazon.afkarxyz.fun/api/track/{asin}"
         print(f"Fetching from Amazon API (ASIN: {asin})...")
         
@@ -106,32 +215,43 @@ class AmazonDownloader:
 
         data = resp.json()
         stream_url = data.get("streamUrl")
-        decryption_key = data.get("decryptionKey")
-
         if not stream_url:
             raise Exception("No stream URL found in API response")
+        return stream_url, data.get("decryptionKey")
 
-        temp_file = os.path.join(output_dir, f"{asin}.enc")
+    def download_from_afkar_xyz(self, amazon_url: str, output_dir: str, stream_info=None, temp_name: str = "") -> str:
+        asin = self.get_asin(amazon_url)
+        # Several Spotify tracks can map to one ASIN; the caller's name keeps their files apart
+        stem = f"{asin}_{temp_name}" if temp_name else asin
+        # A (stream URL, key) pair prefetched by the caller skips the API round trip
+        stream_url, decryption_key = stream_info or self.get_stream_info(amazon_url)
+
+        temp_file = os.path.join(output_dir, f"{stem}.enc")
         print(f"Downloading track...")
         
-        with self.session.get(stream_url, stream=True) as r:
-            r.raise_for_status()
-            total = int(r.headers.get("Content-Length") or 0)
-            downloaded = 0
-            with open(temp_file, "wb") as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-                        downloaded += len(chunk)
-                        if self.progress_callback:
-                            self.progress_callback(downloaded, total)
+        if decryption_key and self.stream_decrypt:
+            with transfer.open_stream(self.session, stream_url) as r:
+                total = transfer.content_length(r)
+                chunks = transfer.iter_chunks(r)
+                head, codec = read_mp4_head(chunks)
+                if codec:
+                    return self._stream_decrypt(head, chunks, total, codec, decryption_key, output_dir, stem)
+                print("moov is not at the start of the stream, decrypting from a temporary file")
+                with open(temp_file, "wb") as f:
+                    done = transfer.write_chunks(itertools.chain([head], chunks), f, total, self.progress_callback)
+                if total and done < total:
+                    os.remove(temp_file)
+                    raise transfer.TransferIncomplete(f"got {done} of {total} bytes")
+        else:
+            stats = transfer.download(self.session, stream_url, temp_file, self.progress_callback)
+            print(f"\nDownloaded {stats}")
         print()
 
         if decryption_key:
             print("Decrypting file...")
             codec = self._get_codec(temp_file)
             ext = ".flac" if codec == "flac" else ".m4a"
-            decrypted_path = os.path.join(output_dir, f"{asin}{ext}")
+            decrypted_path = os.path.join(output_dir, f"{stem}{ext}")
 
             cmd = [
                 get_ffmpeg_path(), "-y",
@@ -140,13 +260,8 @@ class AmazonDownloader:
                 "-c", "copy",
                 decrypted_path
             ]
-            
-            si = None
-            if os.name == 'nt':
-                si = subprocess.STARTUPINFO()
-                si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
 
-            result = subprocess.run(cmd, capture_output=True, startupinfo=si)
+            result = self.post.ffmpeg(cmd)
             if result.returncode != 0:
                 os.remove(temp_file)
                 raise Exception(f"Decryption failed: {result.stderr.decode()}")
@@ -154,25 +269,86 @@ class AmazonDownloader:
             os.remove(temp_file)
             return decrypted_path
         
-        final_path = os.path.join(output_dir, f"{asin}.m4a")
+        final_path = os.path.join(output_dir, f"{stem}.m4a")
         if os.path.exists(final_path):
              os.remove(final_path)
         os.rename(temp_file, final_path)
         return final_path
 
+    def _stream_decrypt(self, head, chunks, total, codec, decryption_key, output_dir, stem) -> str:
+        # Decrypts while downloading: the encrypted bytes only ever pass through ffmpeg's stdin
+        ext = ".flac" if codec == "flac" else ".m4a"
+        decrypted_path = os.path.join(output_dir, f"{stem}{ext}")
+        cmd = [
+            get_ffmpeg_path(), "-y", "-v", "error",
+            "-decryption_key", decryption_key.strip(),
+            "-i", "pipe:0",
+            "-c", "copy",
+            decrypted_path
+        ]
+        si = None
+        if os.name == 'nt':
+            si = subprocess.STARTUPINFO()
+            si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+
+        print("Downloading and decrypting...")
+        with self.post.cpu_slot():
+            return self._pipe_decrypt(cmd, si, head, chunks, total, decrypted_path)
+
+    def _pipe_decrypt(self, cmd, si, head, chunks, total, decrypted_path) -> str:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE, startupinfo=si)
+        # Drain stderr on the side so a chatty ffmpeg can't fill the pipe and stall the writes
+        stderr = []
+        drain = threading.Thread(target=lambda: stderr.append(proc.stderr.read()), daemon=True)
+        drain.start()
+        done = 0
+        try:
+            done = transfer.write_chunks(itertools.chain([head], chunks), proc.stdin, total, self.progress_callback)
+        except BrokenPipeError:
+            pass
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            drain.join()
+            if os.path.exists(decrypted_path):
+                os.remove(decrypted_path)
+            raise
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        proc.wait()
+        drain.join()
+        print()
+        if proc.returncode != 0:
+            if os.path.exists(decrypted_path):
+                os.remove(decrypted_path)
+            raise Exception(f"Decryption failed: {b''.join(stderr).decode(errors='replace')}")
+        if total and done < total:
+            # ffmpeg exits cleanly on a stream that just stops, so a short transfer is caught here
+            if os.path.exists(decrypted_path):
+                os.remove(decrypted_path)
+            raise transfer.TransferIncomplete(f"got {done} of {total} bytes")
+        return decrypted_path
+
     def download_by_url(self, amazon_url: str, output_dir: str, quality: str, filename_format: str, 
                         playlist_name: str, playlist_owner: str, include_track_number: bool, position: int, 
                         spotify_track_name: str, spotify_artist_name: str, spotify_album_name: str, 
                         spotify_album_artist: str, spotify_release_date: str, spotify_cover_url: str, 
                         spotify_track_number: int, spotify_disc_number: int, spotify_total_tracks: int, 
                         embed_max_quality_cover: bool, spotify_total_discs: int, spotify_copyright: str, 
-                        spotify_publisher: str, spotify_url: str, use_album_track_number: bool = False):
+                        spotify_publisher: str, spotify_url: str, use_album_track_number: bool = False,
+                        stream_info=None, temp_name: str = ""):
         
         os.makedirs(output_dir, exist_ok=True)
 
         print(f"Using Amazon URL: {amazon_url}")
         
-        file_path = self.download_from_afkar_xyz(amazon_url, output_dir)
+        # Cover downloads alongside the audio and is joined before tagging
+        cover = self.covers.prefetch(spotify_cover_url, self.session)
+        file_path = self.download_from_afkar_xyz(amazon_url, output_dir, stream_info, temp_name)
         
         safe_title = sanitize_filename(spotify_track_name)
         safe_artist = sanitize_filename(spotify_artist_name)
@@ -220,26 +396,25 @@ class AmazonDownloader:
         os.replace(file_path, new_path)
         print(f"Renamed to: {new_name + ext}")
 
-        self.embed_metadata(new_path, spotify_track_name, spotify_artist_name, spotify_album_name, 
-                            spotify_album_artist, spotify_release_date, spotify_track_number, 
-                            spotify_total_tracks, spotify_disc_number, spotify_total_discs, 
-                            spotify_cover_url, spotify_copyright, spotify_publisher, spotify_url)
+        # Joined here, on the network side, so the tagging stage only does CPU/disk work
+        cover_data = cover.result()
+        self.post.run(self.embed_metadata, new_path, spotify_track_name, spotify_artist_name, spotify_album_name,
+                      spotify_album_artist, spotify_release_date, spotify_track_number,
+                      spotify_total_tracks, spotify_disc_number, spotify_total_discs,
+                      spotify_cover_url, spotify_copyright, spotify_publisher, spotify_url, cover_data)
 
         print("Done\n✓ Downloaded successfully from Amazon Music")
         return new_path
 
+    def download_cover(self, cover_url):
+        return self.covers.get(cover_url, self.session)
+
     def embed_metadata(self, filepath, title, artist, album, album_artist, date, track_num, total_tracks, 
-                       disc_num, total_discs, cover_url, copyright, publisher, url):
+                       disc_num, total_discs, cover_url, copyright, publisher, url, cover_data=None):
         print("Embedding metadata and cover art...")
         try:
-            cover_data = None
-            if cover_url:
-                try: 
-                    resp = self.session.get(cover_url, timeout=15)
-                    if resp.status_code == 200:
-                        cover_data = resp.content
-                except Exception as e:
-                    print(f"Warning: Could not download cover: {e}")
+            if cover_data is None:
+                cover_data = self.download_cover(cover_url)
 
             t_num = safe_int(track_num)
             t_total = safe_int(total_tracks)
@@ -249,60 +424,32 @@ class AmazonDownloader:
             if t_num == 0: t_num = 1
             if d_num == 0: d_num = 1
 
+            tags = {
+                "TITLE": title,
+                "ARTIST": artist,
+                "ALBUM": album,
+                "ALBUMARTIST": album_artist,
+                "DATE": date,
+                "TRACKNUMBER": t_num,
+                "TRACKTOTAL": t_total,
+                "DISCNUMBER": d_num,
+                "DISCTOTAL": d_total,
+                "COPYRIGHT": copyright,
+            }
             if filepath.endswith(".flac"):
-                audio = FLAC(filepath)
-                audio.delete()
-                
-                audio["TITLE"] = title
-                audio["ARTIST"] = artist
-                audio["ALBUM"] = album
-                audio["ALBUMARTIST"] = album_artist
-                audio["DATE"] = date
-                audio["TRACKNUMBER"] = str(t_num)
-                audio["TRACKTOTAL"] = str(t_total)
-                audio["DISCNUMBER"] = str(d_num)
-                audio["DISCTOTAL"] = str(d_total)
-                if copyright: audio["COPYRIGHT"] = copyright
-                if publisher: audio["ORGANIZATION"] = publisher
-                if url: audio["URL"] = url
-                audio["DESCRIPTION"] = "https://github.com/afkarxyz/SpotiFLAC"
-
-                if cover_data:
-                    pic = Picture()
-                    pic.data = cover_data
-                    pic.type = PictureType.COVER_FRONT
-                    pic.mime = "image/jpeg"
-                    audio.add_picture(pic)
-                audio.save()
-
-            elif filepath.endswith(".m4a"):
-                try:
-                    audio = MP4(filepath)
-                except:
-                    audio = MP4(filepath)
-                
-                audio.delete()
-                
-                audio["\xa9nam"] = title
-                audio["\xa9ART"] = artist
-                audio["\xa9alb"] = album
-                audio["aART"] = album_artist
-                audio["\xa9day"] = date
-                audio["trkn"] = [(t_num, t_total)]
-                audio["disk"] = [(d_num, d_total)]
-                if copyright: audio["cprt"] = copyright
-                
-                if cover_data:
-                    audio["covr"] = [MP4Cover(cover_data, imageformat=MP4Cover.FORMAT_JPEG)]
-                audio.save()
-                
+                tags.update({"ORGANIZATION": publisher, "URL": url,
+                             "DESCRIPTION": "https://github.com/afkarxyz/SpotiFLAC"})
+            if filepath.endswith((".flac", ".m4a")):
+                tagging.write_tags(filepath, tags, cover_data)
+
             print("Metadata embedded successfully")
 
         except Exception as e:
             print(f"Warning: Failed to embed metadata: {e}")
 
-    def download_by_spotify_id(self, spotify_track_id, **kwargs):
-        amazon_url = self.get_amazon_url_from_spotify(spotify_track_id)
+    def download_by_spotify_id(self, spotify_track_id, amazon_url=None, stream_info=None, **kwargs):
+        if not amazon_url:
+            amazon_url = self.get_amazon_url_from_spotify(spotify_track_id)
         
         default_kwargs = {
             "output_dir": ".", "quality": "LOSSLESS", "filename_format": "{title} - {artist}",
@@ -319,4 +466,4 @@ class AmazonDownloader:
             if key in default_kwargs:
                 default_kwargs[key] = kwargs[key]
 
-        return self.download_by_url(amazon_url, **default_kwargs)
\ No newline at end of file
+        return self.download_by_url(amazon_url, stream_info=stream_info, temp_name=spotify_track_id, **default_kwargs)
\ No newline at end of file
@@ -0,0 +1,186 @@
+import re
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Dict, Optional, Union
+from urllib.parse import urlparse
+
+from SpotiFLAC import deadline
+
+# A bucket holds this many seconds of its rate, so short bursts go through unthrottled
+BURST_SECONDS = 1.0
+# Longest single sleep, so a throttled stream still notices its track deadline
+MAX_SLEEP = 0.5
+
+_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+_local = threading.local()
+
+Rate = Union[float, int, str, None]
+
+
+def parse_rate(value: Rate) -> Optional[float]:
+    # Bytes per second from 2000000, "500K", "2.5M" or "1G" (also "10MB/s"); None/0: unlimited
+    if value is None or isinstance(value, (int, float)):
+        return float(value) if value else None
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kmg]?)(?:i?b)?(?:/s)?\s*", value.lower())
+    if not match:
+        raise ValueError(f"invalid rate: {value!r} (e.g. 500K, 10M)")
+    return float(match.group(1)) * _UNITS[match.group(2)] or None
+
+
+def parse_service_rate(value: str):
+    # "tidal=5M" -> ("tidal", 5242880.0), for argparse
+    service, sep, rate = value.partition("=")
+    if not sep or not service:
+        raise ValueError(f"invalid service rate: {value!r} (e.g. tidal=5M)")
+    return service.strip().lower(), parse_rate(rate)
+
+
+class Throttle:
+    # Wall time the transfers of one service attempt were held back by the limits; parallel
+    # segments held back together count once
+    def __init__(self):
+        self.seconds = 0.0
+        self.waiting = 0
+        self.since = 0.0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def held(self):
+        with self.lock:
+            if not self.waiting:
+                self.since = time.monotonic()
+            self.waiting += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.waiting -= 1
+                if not self.waiting:
+                    self.seconds += time.monotonic() - self.since
+
+
+def current_service() -> Optional[str]:
+    return getattr(_local, "service", None)
+
+
+def current_throttle() -> Optional[Throttle]:
+    return getattr(_local, "throttle", None)
+
+
+@contextmanager
+def service(name: Optional[str], throttle: Optional[Throttle] = None):
+    # Transfers in the block count against `name`'s rate as well as the total; yields the
+    # Throttle that adds up how long they had to wait for the limits
+    previous = current_service(), current_throttle()
+    _local.service, _local.throttle = name, throttle or Throttle()
+    try:
+        yield _local.throttle
+    finally:
+        _local.service, _local.throttle = previous
+
+
+def bind(fn: Callable) -> Callable:
+    # Carries the calling thread's service (and its Throttle) into fn when it runs on another thread
+    name, throttle = current_service(), current_throttle()
+
+    def run(*args, **kwargs):
+        with service(name, throttle):
+            return fn(*args, **kwargs)
+    return run
+
+
+def _held():
+    throttle = current_throttle()
+    return throttle.held() if throttle else nullcontext()
+
+
+class TokenBucket:
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.capacity = max(rate * BURST_SECONDS, 1.0)
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, n: int) -> float:
+        # Takes n bytes' worth of tokens, going into debt if there aren't enough, and returns how
+        # long the caller has to wait; callers queue up behind each other's debt in order
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class Bandwidth:
+    # Rate limits for the transfers of every session it is attached to: one total, optional ones
+    # per service, and a cap on open streams per host. Unconfigured, every check is a no-op.
+    def __init__(self):
+        self.total: Optional[TokenBucket] = None
+        self.services: Dict[str, TokenBucket] = {}
+        self.host_connections = 0
+        self.open: Dict[str, int] = {}
+        self.cond = threading.Condition()
+
+    def configure(self, rate: Rate = None, service_rates: Optional[Dict[str, Rate]] = None,
+                  host_connections: int = 0) -> None:
+        total = parse_rate(rate)
+        rates = {svc: parse_rate(r) for svc, r in (service_rates or {}).items()}
+        with self.cond:
+            self.total = TokenBucket(total) if total else None
+            self.services = {svc: TokenBucket(r) for svc, r in rates.items() if r}
+            self.host_connections = max(0, host_connections or 0)
+            self.cond.notify_all()
+
+    def consume(self, n: int) -> None:
+        # Called with every chunk read: sleeps until the chunk fits under the rates that apply
+        buckets = [self.total, self.services.get(current_service())]
+        wait = max([bucket.reserve(n) for bucket in buckets if bucket is not None], default=0.0)
+        if wait <= 0:
+            return
+        end = time.monotonic() + wait
+        with _held():
+            while wait > 0:
+                deadline.check()
+                time.sleep(min(wait, MAX_SLEEP))
+                wait = end - time.monotonic()
+
+    def connect(self, url: str) -> Callable[[], None]:
+        # Waits for a free stream slot on url's host and returns the call that gives it back
+        host = urlparse(url).hostname or ""
+        track_deadline = deadline.current()
+        with self.cond:
+            if self.host_connections and self.open.get(host, 0) >= self.host_connections:
+                with _held():
+                    while self.host_connections and self.open.get(host, 0) >= self.host_connections:
+                        if track_deadline is not None:
+                            track_deadline.check()
+                        self.cond.wait(min(track_deadline.remaining(), MAX_SLEEP) if track_deadline else None)
+            self.open[host] = self.open.get(host, 0) + 1
+        released = []
+
+        def release() -> None:
+            with self.cond:
+                if released:
+                    return
+                released.append(True)
+                self.open[host] -= 1
+                if not self.open[host]:
+                    del self.open[host]
+                self.cond.notify_all()
+        return release
+
+    def summary(self) -> Dict:
+        with self.cond:
+            return {
+                "rate": self.total.rate if self.total else None,
+                "service_rates": {svc: bucket.rate for svc, bucket in self.services.items()},
+                "host_connections": self.host_connections or None,
+                "open_connections": dict(self.open),
+            }
+
+
+# For sessions without limits of their own (standalone downloaders); never configured
+UNLIMITED = Bandwidth()
@@ -0,0 +1,173 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional
+
+import requests
+
+# Covers kept in memory; a 1280px JPEG is a few hundred KB, so this holds roughly the last 100 albums
+MEMORY_BYTES = 48 * 1024 * 1024
+# Covers kept on disk; past this the least recently used files (by mtime, which a hit refreshes)
+# are removed until the cache is back under DISK_LOW_WATER of it
+DISK_BYTES = 512 * 1024 * 1024
+DISK_LOW_WATER = 0.9
+# Background cover fetches running alongside the audio transfers
+PREFETCH_WORKERS = 4
+# Root of the persistent caches (--cache-dir)
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+                         "spotiflac")
+DEFAULT_DIR = os.path.join(CACHE_DIR, "covers")
+
+
+class CoverCache:
+    # Cover art by URL (URLs embed the album's image id, so every track of an album shares one
+    # entry): LRU in memory, then on disk, then one fetch no matter how many tracks ask at once.
+    def __init__(self, directory: Optional[str] = DEFAULT_DIR, memory_bytes: int = MEMORY_BYTES,
+                 disk_bytes: int = DISK_BYTES):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        # Bytes on disk, counted on the first write and kept up to date after that
+        self.disk_size: Optional[int] = None
+        self.disk_lock = threading.Lock()
+        self.items: "OrderedDict[str, bytes]" = OrderedDict()
+        self.size = 0
+        self.inflight: Dict[str, Future] = {}
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        self._pool: Optional[ThreadPoolExecutor] = None
+
+    def _disk_path(self, url: str) -> Optional[str]:
+        if not self.directory:
+            return None
+        return os.path.join(self.directory, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".img")
+
+    def _remember(self, url: str, data: bytes) -> None:
+        with self.lock:
+            if url in self.items:
+                return
+            self.items[url] = data
+            self.size += len(data)
+            while self.size > self.memory_bytes and len(self.items) > 1:
+                _, old = self.items.popitem(last=False)
+                self.size -= len(old)
+
+    def _read_disk(self, url: str) -> Optional[bytes]:
+        path = self._disk_path(url)
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                data = f.read() or None
+            # Marks the file as recently used for eviction (atime is often not updated)
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    def _disk_files(self):
+        # (mtime, size, path) of every cached cover
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".img"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files
+
+    def _evict_disk(self, added: int) -> None:
+        with self.disk_lock:
+            if self.disk_size is None:
+                self.disk_size = sum(size for _, size, _ in self._disk_files())
+            else:
+                self.disk_size += added
+            if self.disk_size <= self.disk_bytes:
+                return
+            # Rescanned, so files other processes added or removed are counted too
+            files = sorted(self._disk_files())
+            self.disk_size = sum(size for _, size, _ in files)
+            for _, size, path in files:
+                if self.disk_size <= self.disk_bytes * DISK_LOW_WATER:
+                    break
+                try:
+                    os.remove(path)
+                    self.disk_size -= size
+                except OSError:
+                    pass
+
+    def _write_disk(self, url: str, data: bytes) -> None:
+        path = self._disk_path(url)
+        if not path:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+            self._evict_disk(len(data))
+        except OSError:
+            pass
+
+    def _fetch(self, url: str, session: Optional[requests.Session], timeout: float) -> Optional[bytes]:
+        resp = (session or self.session).get(url, timeout=timeout)
+        if resp.status_code != 200 or not resp.content:
+            return None
+        self._write_disk(url, resp.content)
+        return resp.content
+
+    def get(self, url: str, session: Optional[requests.Session] = None, timeout: float = 15) -> Optional[bytes]:
+        # Cover bytes, or None if it can't be fetched (failures are not cached)
+        if not url:
+            return None
+        with self.lock:
+            data = self.items.get(url)
+            if data is not None:
+                self.items.move_to_end(url)
+                return data
+            future = self.inflight.get(url)
+            owner = future is None
+            if owner:
+                future = self.inflight[url] = Future()
+        if not owner:
+            return future.result()
+
+        data = None
+        try:
+            data = self._read_disk(url) or self._fetch(url, session, timeout)
+        except Exception as e:
+            print(f"Warning: Could not download cover: {e}")
+        finally:
+            if data:
+                self._remember(url, data)
+            with self.lock:
+                self.inflight.pop(url, None)
+            future.set_result(data)
+        return data
+
+    def prefetch(self, url: str, session: Optional[requests.Session] = None) -> Future:
+        # Starts get() in the background; call .result() on the returned future when tagging.
+        # The future resolves to None on failure, it never raises.
+        if not url:
+            future = Future()
+            future.set_result(None)
+            return future
+        with self.lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(PREFETCH_WORKERS, thread_name_prefix="cover")
+        return self._pool.submit(self.get, url, session)
+
+    def close(self) -> None:
+        # Lets running prefetches finish; a later prefetch() starts a new pool
+        with self.lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+
+
+# Default for downloaders used on their own; a DownloadScheduler gives its downloaders its own
+COVERS = CoverCache()
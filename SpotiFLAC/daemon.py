@@ -0,0 +1,380 @@
+import argparse
+import itertools
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+from SpotiFLAC.SpotiFLAC import SERVICES, Config, DownloadScheduler, add_download_arguments, run_job
+from SpotiFLAC.adaptiveLimit import HOSTS
+from SpotiFLAC.libraryStore import LibraryStore
+from SpotiFLAC import deadline
+from SpotiFLAC.coverCache import CACHE_DIR
+from SpotiFLAC.lookahead import LOOKAHEAD
+
+DEFAULT_LISTEN = "127.0.0.1:8765"
+# Finished jobs kept for GET /jobs; older ones are dropped so a watch-driven daemon stays small
+KEEP_FINISHED_JOBS = 500
+JOB_FIELDS = ("url", "output_dir", "services", "filename_format", "use_track_numbers",
+              "use_artist_subfolders", "use_album_subfolders")
+
+
+@dataclass
+class DaemonJob:
+    url: str
+    output_dir: str
+    services: List[str] = field(default_factory=lambda: ["tidal"])
+    filename_format: str = "{title} - {artist}"
+    use_track_numbers: bool = False
+    use_artist_subfolders: bool = False
+    use_album_subfolders: bool = False
+    priority: int = 0
+    watch_id: str = ""
+    id: str = field(default_factory=lambda: uuid.uuid4().hex[:12])
+    status: str = "queued"
+    name: str = ""
+    tracks: int = 0
+    failed: List[Dict] = field(default_factory=list)
+    timed_out: List[Dict] = field(default_factory=list)
+    error: str = ""
+    created: float = field(default_factory=time.time)
+    started: float = 0.0
+    finished: float = 0.0
+
+
+@dataclass
+class Watch:
+    url: str
+    output_dir: str
+    interval: int = 60
+    services: List[str] = field(default_factory=lambda: ["tidal"])
+    filename_format: str = "{title} - {artist}"
+    use_track_numbers: bool = False
+    use_artist_subfolders: bool = False
+    use_album_subfolders: bool = False
+    priority: int = 0
+    id: str = field(default_factory=lambda: uuid.uuid4().hex[:12])
+    next_run: float = 0.0
+    last_job: str = ""
+
+
+class SpotiFLACDaemon:
+    # Keeps one DownloadScheduler (pools, tokens, sessions, track store) warm for its whole
+    # lifetime; jobs come in over the local API or from watches and run in priority order.
+    def __init__(self, output_dir: str, services: List[str], concurrency: int = 1, job_workers: int = 2,
+                 state_file: Optional[str] = None, amazon_stream_decrypt: bool = False,
+                 store: Optional[LibraryStore] = None, cache_dir: Optional[str] = CACHE_DIR,
+                 lookahead: int = LOOKAHEAD, strict_order: bool = False,
+                 track_timeout: float = deadline.TRACK_BUDGET, max_concurrency: Optional[int] = None,
+                 rate_limit=None, service_rates: Optional[Dict[str, float]] = None, max_host_connections: int = 0):
+        self.output_dir = output_dir
+        self.services = services
+        self.scheduler = DownloadScheduler(concurrency, amazon_stream_decrypt, store, cache_dir, lookahead,
+                                           strict_order, track_timeout, max_concurrency, rate_limit, service_rates,
+                                           max_host_connections)
+        self.job_workers = max(1, job_workers)
+        self.state_file = state_file
+        self.jobs: Dict[str, DaemonJob] = {}
+        self.watches: Dict[str, Watch] = {}
+        self.queue: "queue.PriorityQueue" = queue.PriorityQueue()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self._seq = itertools.count()
+        self._load_state()
+
+    # --- jobs ---
+
+    def submit(self, payload: Dict, watch_id: str = "") -> DaemonJob:
+        job = DaemonJob(**self._job_options(payload), priority=int(payload.get("priority", 0)), watch_id=watch_id)
+        with self.lock:
+            self._prune_jobs()
+            self.jobs[job.id] = job
+        # Higher priority first, then first come first served
+        self.queue.put((-job.priority, next(self._seq), job.id))
+        print(f"[daemon] queued job {job.id} (priority {job.priority}): {job.url}")
+        return job
+
+    def _prune_jobs(self) -> None:
+        finished = [j for j in self.jobs.values() if j.status in ("done", "failed", "cancelled")]
+        for job in sorted(finished, key=lambda j: j.finished or j.created)[:-KEEP_FINISHED_JOBS or None]:
+            del self.jobs[job.id]
+
+    def cancel(self, job_id: str) -> bool:
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if not job or job.status != "queued":
+                return False
+            job.status = "cancelled"
+            return True
+
+    def _job_options(self, payload: Dict) -> Dict:
+        if not payload.get("url"):
+            raise ValueError("url is required")
+        options = {key: payload[key] for key in JOB_FIELDS if key in payload}
+        options.setdefault("output_dir", self.output_dir)
+        options.setdefault("services", self.services)
+        if isinstance(options["services"], str):
+            options["services"] = [options["services"]]
+        unknown = [svc for svc in options["services"] if svc not in SERVICES]
+        if not options["services"] or unknown:
+            raise ValueError(f"services must be some of {', '.join(SERVICES)} (got {unknown or 'none'})")
+        return options
+
+    def _job_worker(self) -> None:
+        while not self.stopping.is_set():
+            try:
+                _, _, job_id = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            with self.lock:
+                job = self.jobs.get(job_id)
+                if not job or job.status != "queued":
+                    continue
+                job.status = "running"
+                job.started = time.time()
+            self._run(job)
+            with self.lock:
+                # Once the queue drains, forget the finished jobs' tracks and claims. Jobs are marked
+                # running under the same lock, so none can pick up the old store in between.
+                if not any(j.status in ("queued", "running") for j in self.jobs.values()):
+                    self.scheduler.forget_tracks()
+
+    def _run(self, job: DaemonJob) -> None:
+        config = Config(job.url, job.output_dir, job.services, job.filename_format, job.use_track_numbers,
+                        job.use_artist_subfolders, job.use_album_subfolders,
+                        concurrency=self.scheduler.concurrency)
+        try:
+            os.makedirs(job.output_dir, exist_ok=True)
+            worker = run_job(config, self.scheduler)
+            job.name = config.album_or_playlist_name
+            job.tracks = worker.scheduled if worker else 0
+            job.failed = [{"title": t, "artists": a, "error": e} for t, a, e in (worker.failed_tracks if worker else [])]
+            job.timed_out = [{"title": t, "artists": a, "error": e} for t, a, e in (worker.timed_out if worker else [])]
+            job.status = "done" if worker else "failed"
+            if not worker:
+                job.error = "metadata fetch failed or output directory is invalid"
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+        job.finished = time.time()
+        print(f"[daemon] job {job.id} {job.status}: {job.name or job.url}")
+
+    # --- watches ---
+
+    def add_watch(self, payload: Dict) -> Watch:
+        options = self._job_options(payload)
+        watch = Watch(**options, interval=max(1, int(payload.get("interval", 60))),
+                      priority=int(payload.get("priority", 0)))
+        with self.lock:
+            self.watches[watch.id] = watch
+        self._save_state()
+        return watch
+
+    def remove_watch(self, watch_id: str) -> bool:
+        with self.lock:
+            removed = self.watches.pop(watch_id, None) is not None
+        if removed:
+            self._save_state()
+        return removed
+
+    def _watch_loop(self) -> None:
+        while not self.stopping.wait(5):
+            now = time.time()
+            with self.lock:
+                due = [w for w in self.watches.values() if w.next_run <= now]
+            for watch in due:
+                last = self.jobs.get(watch.last_job)
+                # One pass per watch at a time; a slow run just pushes the next one back
+                if last and last.status in ("queued", "running"):
+                    continue
+                payload = {key: getattr(watch, key) for key in JOB_FIELDS}
+                payload["priority"] = watch.priority
+                watch.last_job = self.submit(payload, watch_id=watch.id).id
+                watch.next_run = now + watch.interval * 60
+            if due:
+                self._save_state()
+
+    def _load_state(self) -> None:
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, encoding="utf-8") as f:
+                state = json.load(f)
+            for data in state.get("watches", []):
+                watch = Watch(**data)
+                self.watches[watch.id] = watch
+            print(f"[daemon] loaded {len(self.watches)} watches from {self.state_file}")
+        except Exception as e:
+            print(f"[daemon] could not load state: {e}")
+
+    def _save_state(self) -> None:
+        if not self.state_file:
+            return
+        with self.lock:
+            state = {"watches": [asdict(w) for w in self.watches.values()]}
+        tmp = self.state_file + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp, self.state_file)
+
+    # --- lifecycle ---
+
+    def status(self) -> Dict:
+        with self.lock:
+            counts: Dict[str, int] = {}
+            for job in self.jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return {
+                "jobs": counts,
+                "watches": len(self.watches),
+                "concurrency": self.scheduler.concurrency,
+                "max_concurrency": self.scheduler.max_concurrency,
+                "limits": {"services": self.scheduler.limits.summary(), "hosts": HOSTS.summary()},
+                "bandwidth": self.scheduler.bandwidth.summary(),
+                "post_workers": self.scheduler.post.workers,
+                "lookahead_hits": self.scheduler.lookahead.hits,
+                "lookahead_expired": self.scheduler.lookahead.expired,
+                "services": self.scheduler.ranker.summary(),
+                "job_workers": self.job_workers,
+                "known_tracks": len(self.scheduler.tracks),
+            }
+
+    def start(self) -> None:
+        for _ in range(self.job_workers):
+            threading.Thread(target=self._job_worker, daemon=True).start()
+        threading.Thread(target=self._watch_loop, daemon=True).start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+        self.scheduler.shutdown()
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    daemon: SpotiFLACDaemon = None
+
+    def address_string(self) -> str:
+        # client_address is an empty string on Unix sockets
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def _send(self, code: int, body) -> None:
+        data = json.dumps(body, indent=2).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self) -> Dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}") if length else {}
+
+    def _parts(self) -> List[str]:
+        return [p for p in self.path.split("?")[0].split("/") if p]
+
+    def do_GET(self) -> None:
+        parts = self._parts()
+        d = self.daemon
+        if parts == ["status"]:
+            return self._send(200, d.status())
+        if parts == ["jobs"]:
+            with d.lock:
+                jobs = [asdict(j) for j in d.jobs.values()]
+            return self._send(200, jobs)
+        if len(parts) == 2 and parts[0] == "jobs":
+            job = d.jobs.get(parts[1])
+            return self._send(200, asdict(job)) if job else self._send(404, {"error": "no such job"})
+        if parts == ["watches"]:
+            with d.lock:
+                watches = [asdict(w) for w in d.watches.values()]
+            return self._send(200, watches)
+        self._send(404, {"error": "not found"})
+
+    def do_POST(self) -> None:
+        parts = self._parts()
+        try:
+            payload = self._body()
+            if parts == ["jobs"]:
+                return self._send(201, asdict(self.daemon.submit(payload)))
+            if parts == ["watches"]:
+                return self._send(201, asdict(self.daemon.add_watch(payload)))
+        except (ValueError, TypeError) as e:
+            return self._send(400, {"error": str(e)})
+        self._send(404, {"error": "not found"})
+
+    def do_DELETE(self) -> None:
+        parts = self._parts()
+        if len(parts) == 2 and parts[0] == "jobs":
+            ok = self.daemon.cancel(parts[1])
+            return self._send(200 if ok else 409, {"cancelled": ok})
+        if len(parts) == 2 and parts[0] == "watches":
+            ok = self.daemon.remove_watch(parts[1])
+            return self._send(200 if ok else 404, {"removed": ok})
+        self._send(404, {"error": "not found"})
+
+
+if hasattr(socketserver, "UnixStreamServer"):
+    class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+def serve(daemon: SpotiFLACDaemon, listen: str = DEFAULT_LISTEN, socket_path: Optional[str] = None) -> None:
+    handler = type("Handler", (_RequestHandler,), {"daemon": daemon})
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, handler)
+        where = socket_path
+    else:
+        host, _, port = listen.rpartition(":")
+        server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), handler)
+        where = f"http://{host or '127.0.0.1'}:{port}"
+
+    daemon.start()
+    print(f"[daemon] listening on {where}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n[daemon] stopping...")
+    finally:
+        server.server_close()
+        daemon.stop()
+
+
+def add_daemon_arguments(parser: argparse.ArgumentParser) -> None:
+    # Shared by `python -m SpotiFLAC.daemon` and --daemon in the CLI and launcher
+    parser.add_argument("--listen", default=DEFAULT_LISTEN, help="host:port for the daemon's HTTP API")
+    parser.add_argument("--socket", help="Serve the daemon's API on this Unix socket instead of TCP")
+    parser.add_argument("--job-workers", type=int, default=2, help="Number of daemon jobs to run at once")
+    parser.add_argument("--state-file", help="JSON file that keeps the daemon's watches across restarts")
+
+
+def run_daemon(args: argparse.Namespace) -> None:
+    # args comes from any parser that used add_download_arguments and add_daemon_arguments
+    store = LibraryStore(args.store, args.link_mode) if args.store else None
+    daemon = SpotiFLACDaemon(args.output_dir, args.service, args.concurrency, args.job_workers, args.state_file,
+                             args.amazon_stream_decrypt, store, args.cache_dir, args.lookahead, args.strict_order,
+                             args.track_timeout, args.max_concurrency, args.rate_limit, dict(args.service_rate or []),
+                             args.max_host_connections)
+    serve(daemon, args.listen, args.socket)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run SpotiFLAC as a long-lived service with a local job API")
+    parser.add_argument("output_dir", help="Default output directory for jobs")
+    add_download_arguments(parser)
+    add_daemon_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    run_daemon(parse_args())
+
+
+if __name__ == "__main__":
+    main()
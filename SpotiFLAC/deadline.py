@@ -0,0 +1,187 @@
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+
+from SpotiFLAC.adaptiveLimit import HOSTS, SlotTimeout
+
+# Wall-clock budget for one track across all its service attempts (0/None: unlimited)
+TRACK_BUDGET = 900.0
+# Each fallback service still to come keeps this share of what the current attempt may use
+FALLBACK_SHARE = 0.5
+# Per-request timeout for sessions whose callers don't pass one
+DEFAULT_TIMEOUT = 60.0
+
+_local = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    def __init__(self, seconds: float, parent: Optional["Deadline"] = None):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+        if parent is not None:
+            self.expires = min(self.expires, parent.expires)
+
+    def remaining(self) -> float:
+        return self.expires - time.monotonic()
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def check(self) -> None:
+        if self.expired:
+            raise DeadlineExceeded(f"time budget of {self.seconds:.0f}s used up")
+
+
+def current() -> Optional[Deadline]:
+    return getattr(_local, "deadline", None)
+
+
+def check() -> None:
+    deadline = current()
+    if deadline is not None:
+        deadline.check()
+
+
+@contextmanager
+def budget(seconds: Optional[float]):
+    # Runs the block under a deadline `seconds` from now, never later than the enclosing one
+    parent = current()
+    if not seconds or seconds <= 0:
+        yield parent
+        return
+    _local.deadline = Deadline(seconds, parent)
+    try:
+        yield _local.deadline
+    finally:
+        _local.deadline = parent
+
+
+def bind(fn: Callable) -> Callable:
+    # Carries the calling thread's deadline into fn when it runs on another thread
+    deadline = current()
+
+    def run(*args, **kwargs):
+        previous = current()
+        _local.deadline = deadline
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.deadline = previous
+    return run
+
+
+class Watchdog:
+    # One thread for every cancel_on_expiry block in the process, so a transfer made of many
+    # small reads (DASH segments, ranges) doesn't start a timer thread per read
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.entries: Dict[int, Tuple[float, Callable[[], None]]] = {}
+        self.ids = itertools.count()
+        self.thread: Optional[threading.Thread] = None
+
+    def watch(self, expires: float, cancel: Callable[[], None]) -> int:
+        with self.cond:
+            token = next(self.ids)
+            self.entries[token] = (expires, cancel)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="deadline-watchdog", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+            return token
+
+    def unwatch(self, token: int) -> None:
+        with self.cond:
+            self.entries.pop(token, None)
+
+    def _run(self) -> None:
+        while True:
+            with self.cond:
+                now = time.monotonic()
+                due = [token for token, (expires, _) in self.entries.items() if expires <= now]
+                if not due:
+                    soonest = min((expires for expires, _ in self.entries.values()), default=None)
+                    self.cond.wait(None if soonest is None else soonest - now)
+                    continue
+                cancels = [self.entries.pop(token)[1] for token in due]
+            for cancel in cancels:
+                try:
+                    cancel()
+                except Exception:
+                    pass
+
+
+WATCHDOG = Watchdog()
+
+
+@contextmanager
+def cancel_on_expiry(cancel: Callable[[], None]):
+    # Calls cancel() from the watchdog thread if the current deadline passes while the block
+    # runs, e.g. to break a read that a trickling connection keeps from ever timing out
+    deadline = current()
+    if deadline is None:
+        yield
+        return
+    token = WATCHDOG.watch(deadline.expires, cancel)
+    try:
+        yield
+    finally:
+        WATCHDOG.unwatch(token)
+
+
+def attempt_budget(remaining: float, fallbacks: int) -> float:
+    # Part of the track's remaining time one service may use, leaving some for the rest
+    return remaining / (1 + FALLBACK_SHARE * max(fallbacks, 0))
+
+
+def cap_timeout(timeout):
+    # A request timeout no longer than what is left of the current deadline
+    deadline = current()
+    if deadline is None:
+        return timeout
+    left = deadline.remaining()
+    if left <= 0:
+        raise DeadlineExceeded(f"time budget of {deadline.seconds:.0f}s used up")
+    if timeout is None:
+        return left
+    if isinstance(timeout, tuple):
+        return tuple(left if t is None else min(t, left) for t in timeout)
+    return min(timeout, left)
+
+
+class DeadlineSession(requests.Session):
+    # requests.Session whose `timeout` attribute is a real default, whose every request is cut
+    # off by the calling thread's deadline and waits for a slot under its host's adaptive limit
+    def __init__(self, timeout: Optional[float] = DEFAULT_TIMEOUT):
+        super().__init__()
+        self.timeout = timeout
+        # bandwidth.Bandwidth its streamed transfers count against (see transfer.get_stream)
+        self.bandwidth = None
+
+    def request(self, method, url, **kwargs):
+        timeout = kwargs.get("timeout")
+        kwargs["timeout"] = cap_timeout(self.timeout if timeout is None else timeout)
+        deadline = current()
+        try:
+            # Held until the response headers (or, without stream=True, the body) are in
+            with HOSTS.slot(urlparse(url).hostname or "", deadline.remaining() if deadline else None) as permit:
+                resp = super().request(method, url, **kwargs)
+                permit.response(resp.status_code, resp.elapsed.total_seconds())
+        except SlotTimeout:
+            # Waited here for the host slot: a local outcome, not the server's
+            raise
+        except (TimeoutError, requests.Timeout):
+            # A request timeout capped to the deadline ran out
+            if deadline is not None and deadline.expired:
+                raise DeadlineExceeded(f"time budget of {deadline.seconds:.0f}s used up")
+            raise
+        return resp
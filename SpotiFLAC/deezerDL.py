@@ -1,36 +1,47 @@
 import requests
 import asyncio
-from mutagen.flac import FLAC
 import os
 
+from SpotiFLAC import tagging, transfer
+from SpotiFLAC.coverCache import COVERS
+from SpotiFLAC.deadline import DeadlineSession
+from SpotiFLAC.negativeCache import TrackUnavailable
+from SpotiFLAC.postProcess import INLINE
+
 class DeezerDownloader:
     def __init__(self):
-        self.session = requests.Session()
+        self.session = DeadlineSession()
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
         })
         self.progress_callback = None
+        self.post = INLINE
+        self.covers = COVERS
 
     def set_progress_callback(self, callback):
         self.progress_callback = callback
 
     def get_track_by_isrc(self, isrc):
         try:
-            url = f"https://api.deezer.com/2.0/track/isrc:{isrc}"
-            response = self.session.get(url)
-            response.raise_for_status()
-
-            data = response.json()
-
-            if 'error' in data:
-                print(f"Error from Deezer API: {data['error']['message']}")
-                return None
-
-            return data
-        except requests.exceptions.RequestException as e:
+            return self.find_track_by_isrc(isrc)
+        except Exception as e:
             print(f"Error fetching track data: {e}")
             return None
 
+    def find_track_by_isrc(self, isrc):
+        # Like get_track_by_isrc, but tells a track Deezer doesn't have (TrackUnavailable) apart
+        # from network errors and quota or server errors (raised as they are)
+        response = self.session.get(f"https://api.deezer.com/2.0/track/isrc:{isrc}")
+        response.raise_for_status()
+        data = response.json()
+        if 'error' in data:
+            error = data['error']
+            # 800: "no data", the ISRC isn't in the catalogue
+            if error.get('code') == 800:
+                raise TrackUnavailable(f"Track not found on Deezer: {error.get('message', 'no data')}")
+            raise Exception(f"Deezer API error: {error.get('message', error)}")
+        return data
+
     def extract_metadata(self, track_data):
         metadata = {}
 
@@ -40,7 +51,8 @@ class DeezerDownloader:
         metadata['track_position'] = track_data.get('track_position', 1)
         metadata['disk_number'] = track_data.get('disk_number', 1)
         metadata['isrc'] = track_data.get('isrc', '')
-        metadata['release_date'] = track_data.get('release_date', '')
+        # Album track listings carry the date only on the album object
+        metadata['release_date'] = track_data.get('release_date') or track_data.get('album', {}).get('release_date', '')
         metadata['explicit_lyrics'] = track_data.get('explicit_lyrics', False)
 
         if 'artist' in track_data:
@@ -66,72 +78,85 @@ class DeezerDownloader:
 
         return metadata
 
-    def download_cover_art(self, cover_url, filename):
-        if not cover_url:
-            return None
+    def download_cover_art(self, cover_url):
+        return self.covers.get(cover_url, self.session)
 
+    def embed_metadata(self, file_path, metadata, cover_data=None):
         try:
-            response = self.session.get(cover_url)
-            response.raise_for_status()
-
-            cover_path = f"{filename}_cover.jpg"
-            with open(cover_path, 'wb') as f:
-                f.write(response.content)
-
-            return cover_path
-        except Exception as e:
-            print(f"Error downloading cover art: {e}")
-            return None
-
-    def embed_metadata(self, file_path, metadata, cover_path=None):
-        try:
-            audio = FLAC(file_path)
-
-            audio.clear()
-
-            if metadata.get('title'):
-                audio['TITLE'] = metadata['title']
-            if metadata.get('artists'):
-                audio['ARTIST'] = metadata['artists']
-            elif metadata.get('artist'):
-                audio['ARTIST'] = metadata['artist']
-            if metadata.get('album'):
-                audio['ALBUM'] = metadata['album']
-            if metadata.get('release_date'):
-                audio['DATE'] = metadata['release_date']
-            if metadata.get('track_position'):
-                audio['TRACKNUMBER'] = str(metadata['track_position'])
-            if metadata.get('disk_number'):
-                audio['DISCNUMBER'] = str(metadata['disk_number'])
-            if metadata.get('isrc'):
-                audio['ISRC'] = metadata['isrc']
-
-            if cover_path and os.path.exists(cover_path):
-                with open(cover_path, 'rb') as f:
-                    cover_data = f.read()
-
-                from mutagen.flac import Picture
-                picture = Picture()
-                picture.type = 3
-                picture.mime = 'image/jpeg'
-                picture.desc = 'Cover'
-                picture.data = cover_data
-                audio.add_picture(picture)
-
-            audio.save()
+            tags = {
+                'TITLE': metadata.get('title'),
+                'ARTIST': metadata.get('artists') or metadata.get('artist'),
+                'ALBUM': metadata.get('album'),
+                'DATE': metadata.get('release_date'),
+                'TRACKNUMBER': metadata.get('track_position'),
+                'DISCNUMBER': metadata.get('disk_number'),
+                'ISRC': metadata.get('isrc'),
+            }
+            tagging.write_tags(file_path, tags, cover_data)
             print(f"Metadata embedded successfully in {file_path}")
 
         except Exception as e:
             print(f"Error embedding metadata: {e}")
 
-    async def download_by_isrc(self, isrc, output_dir="."):
-        print(f"Fetching track info for ISRC: {isrc}")
+    def get_track_by_id(self, track_id):
+        try:
+            response = self.session.get(f"https://api.deezer.com/track/{track_id}")
+            response.raise_for_status()
+            data = response.json()
+            if 'error' in data:
+                print(f"Error from Deezer API: {data['error']['message']}")
+                return None
+            return data
+        except requests.exceptions.RequestException as e:
+            print(f"Error fetching track data: {e}")
+            return None
+
+    def get_album_tracks(self, album):
+        # `album` is the album object of a track; album track entries don't carry it, so it is
+        # copied into each of them for the tags
+        response = self.session.get(f"https://api.deezer.com/album/{album['id']}/tracks?limit=500")
+        response.raise_for_status()
+        data = response.json()
+        if 'error' in data:
+            raise Exception(data['error'].get('message', 'Deezer API error'))
+        tracks = [dict(item, album=album) for item in data.get('data', [])]
+        print(f"Found {len(tracks)} tracks on Deezer album {album['id']}")
+        return tracks
+
+    def get_flac_url(self, track_id):
+        api_url = f"https://api.deezmate.com/dl/{track_id}"
+        print(f"Requesting download links from: {api_url}")
+        response = self.session.get(api_url)
+        response.raise_for_status()
+        api_data = response.json()
+
+        if not api_data.get('success'):
+            raise Exception("API request failed")
+
+        flac_url = api_data.get('links', {}).get('flac')
+        if not flac_url:
+            raise Exception("No FLAC download link found in API response")
+        return flac_url
+
+    async def download_by_isrc(self, isrc, output_dir=".", track_data=None, track_id=None, flac_url=None,
+                               filename_format=None):
+        if track_data is None and track_id:
+            track_data = self.get_track_by_id(track_id)
+        elif track_data is None:
+            print(f"Fetching track info for ISRC: {isrc}")
+            track_data = self.get_track_by_isrc(isrc)
 
-        track_data = self.get_track_by_isrc(isrc)
         if not track_data:
             print("Failed to get track data from Deezer API")
             return False
 
+        if 'contributors' not in track_data and track_data.get('id'):
+            # Entries from an album listing have no contributors (featured artists) or date;
+            # the full track object has them for the tags
+            full = self.get_track_by_id(track_data['id'])
+            if full:
+                track_data = full
+
         metadata = self.extract_metadata(track_data)
         print(f"Found track: {metadata.get('artists', 'Unknown')} - {metadata.get('title', 'Unknown')}")
 
@@ -142,66 +167,39 @@ class DeezerDownloader:
 
         print(f"Using track ID: {track_id}")
 
-        api_url = f"https://api.deezmate.com/dl/{track_id}"
-        print(f"Requesting download links from: {api_url}")
-
-        try:
-            response = self.session.get(api_url)
-            response.raise_for_status()
-            api_data = response.json()
-
-            if not api_data.get('success'):
-                print("API request failed")
-                return False
-
-            links = api_data.get('links', {})
-            flac_url = links.get('flac')
+        # Cover downloads alongside the audio and is joined before tagging
+        cover = self.covers.prefetch(metadata.get('cover_url'), self.session)
 
-            if not flac_url:
-                print("No FLAC download link found in API response")
+        if not flac_url:
+            try:
+                flac_url = self.get_flac_url(track_id)
+                print(f"Successfully obtained FLAC download URL")
+            except Exception as e:
+                print(f"Error getting download URL from API: {e}")
                 return False
 
-            print(f"Successfully obtained FLAC download URL")
-
-        except Exception as e:
-            print(f"Error getting download URL from API: {e}")
-            return False
-
         print("Downloading FLAC file...")
         try:
-            response = self.session.get(flac_url)
-            response.raise_for_status()
-
             safe_title = "".join(c for c in metadata.get('title', 'Unknown') if c.isalnum() or c in (' ', '-', '_')).rstrip()
             safe_artist = "".join(c for c in metadata.get('artists', 'Unknown') if c.isalnum() or c in (' ', '-', '_')).rstrip()
-            filename = f"{safe_artist} - {safe_title}.flac"
+            if filename_format:
+                filename = filename_format.replace("{title}", safe_title).replace("{artist}", safe_artist) + ".flac"
+            else:
+                filename = f"{safe_artist} - {safe_title}.flac"
             file_path = os.path.join(output_dir, filename)
 
-            with open(file_path, 'wb') as f:
-                f.write(response.content)
-
-            downloaded = len(response.content)
-            print(f"File size: {downloaded} bytes ({downloaded / (1024*1024):.2f} MB)")
-
-            if self.progress_callback:
-                self.progress_callback(downloaded, downloaded)
+            stats = transfer.download(self.session, flac_url, file_path, self.progress_callback)
+            print(f"\nFile size: {stats.bytes} bytes ({stats})")
 
             print(f"Downloaded: {file_path}")
 
-            cover_path = None
-            if metadata.get('cover_url'):
-                print("Downloading cover art...")
-                cover_path = self.download_cover_art(metadata['cover_url'],
-                                                   os.path.join(output_dir, f"{safe_artist} - {safe_title}"))
+            cover_data = cover.result()
 
             print("Embedding metadata...")
-            self.embed_metadata(file_path, metadata, cover_path)
-
-            if cover_path and os.path.exists(cover_path):
-                os.remove(cover_path)
+            self.post.run(self.embed_metadata, file_path, metadata, cover_data)
 
             print(f"Successfully downloaded and tagged: {filename}")
-            return True
+            return file_path
 
         except Exception as e:
             print(f"Error downloading file: {e}")
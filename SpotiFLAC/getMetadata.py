@@ -1,10 +1,13 @@
 from time import sleep
 from urllib.parse import urlparse, parse_qs
 import requests
-import json
 import base64
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from random import randrange
-from typing import Dict, Any, List, Tuple
+from typing import Dict, Any, List
 
 
 def get_random_user_agent():
@@ -19,6 +22,17 @@ album_base_url = 'https://api.spotify.com/v1/albums/{}'
 track_base_url = 'https://api.spotify.com/v1/tracks/{}'
 artist_base_url = 'https://api.spotify.com/v1/artists/{}'
 artist_albums_url = 'https://api.spotify.com/v1/artists/{}/albums'
+several_tracks_url = 'https://api.spotify.com/v1/tracks?ids={}'
+several_albums_url = 'https://api.spotify.com/v1/albums?ids={}'
+
+# Release groups fetched for each discography filter, in the order duplicates are resolved:
+# a recording that is on an album and on a single/compilation is kept from the album.
+DISCOGRAPHY_GROUPS = {
+    "all": ["album", "single", "compilation"],
+    "album": ["album"],
+    "single": ["single"],
+    "compilation": ["compilation"],
+}
 
 headers = {
     'User-Agent': get_random_user_agent(),
@@ -28,6 +42,13 @@ headers = {
 }
 
 
+# One connection pool and one app token for every request in the process, so batch jobs and
+# the download threads share them instead of opening their own.
+session = requests.Session()
+_token_lock = threading.Lock()
+_token_cache = {"accessToken": None, "expires_at": 0.0}
+
+
 class SpotifyInvalidUrlException(Exception):
     pass
 
@@ -79,7 +100,7 @@ def get_json_from_api(api_url, access_token):
     request_headers = headers.copy()
     request_headers['Authorization'] = f'Bearer {access_token}'
 
-    req = requests.get(api_url, headers=request_headers, timeout=10)
+    req = session.get(api_url, headers=request_headers, timeout=10)
 
     if req.status_code == 429:
         seconds = int(req.headers.get("Retry-After", "5")) + 1
@@ -94,6 +115,18 @@ def get_json_from_api(api_url, access_token):
 
 
 def get_access_token():
+    with _token_lock:
+        if _token_cache["accessToken"] and time.time() < _token_cache["expires_at"]:
+            return {"accessToken": _token_cache["accessToken"]}
+        token = _request_access_token()
+        if "accessToken" in token:
+            _token_cache["accessToken"] = token["accessToken"]
+            # refresh a minute early so a token never expires mid-pagination
+            _token_cache["expires_at"] = time.time() + token.pop("expiresIn", 3600) - 60
+        return token
+
+
+def _request_access_token():
     try:
         auth_str = f"{CLIENT_ID}:{CLIENT_SECRET}"
         auth_bytes = auth_str.encode('utf-8')
@@ -109,7 +142,7 @@ def get_access_token():
             'grant_type': 'client_credentials'
         }
 
-        req = requests.post(token_url, headers=token_headers, data=token_data, timeout=10)
+        req = session.post(token_url, headers=token_headers, data=token_data, timeout=10)
 
         if req.status_code != 200:
             print(f"Token request failed: {req.status_code}")
@@ -117,366 +150,146 @@ def get_access_token():
             return {"error": f"Failed to get access token. Status code: {req.status_code}"}
 
         response = req.json()
-        return {"accessToken": response.get("access_token")}
+        return {"accessToken": response.get("access_token"), "expiresIn": response.get("expires_in", 3600)}
 
     except Exception as e:
         return {"error": f"Failed to get access token: {str(e)}"}
 
 
-def fetch_tracks_in_batches(url: str, access_token: str, batch_size: int = 100, delay: float = 1.0) -> Tuple[
-    List[Dict[str, Any]], int]:
-    all_tracks = []
-    current_batch = 0
-
+def get_json_with_retry(api_url, access_token, retries: int = 2):
+    # get_json_from_api sleeps out a 429 and returns None, so just ask again
+    for _ in range(retries + 1):
+        data = get_json_from_api(api_url, access_token)
+        if data is not None:
+            return data
+    return None
+
+
+def get_tracks_by_ids(track_ids: List[str], access_token: str, batch_size: int = 50) -> List[Dict[str, Any]]:
+    tracks = []
+    for start in range(0, len(track_ids), batch_size):
+        batch_url = several_tracks_url.format(",".join(track_ids[start:start + batch_size]))
+        track_data = get_json_with_retry(batch_url, access_token)
+        if track_data:
+            tracks.extend(t for t in track_data.get('tracks', []) if t)
+    return tracks
+
+
+def get_albums_by_ids(album_ids: List[str], access_token: str, batch_size: int = 20) -> List[Dict[str, Any]]:
+    albums = []
+    for start in range(0, len(album_ids), batch_size):
+        batch_url = several_albums_url.format(",".join(album_ids[start:start + batch_size]))
+        album_data = get_json_with_retry(batch_url, access_token)
+        if album_data:
+            albums.extend(a for a in album_data.get('albums', []) if a)
+    return albums
+
+
+def get_artist_release_ids(artist_id: str, access_token: str, discography_type: str = "all",
+                           delay: float = 0.0) -> List[str]:
+    groups = DISCOGRAPHY_GROUPS.get(discography_type, DISCOGRAPHY_GROUPS["all"])
+    releases = []
+    url = f'{artist_albums_url.format(artist_id)}?include_groups={",".join(groups)}&limit=50'
     while url:
-        print(f"Batch : {current_batch}")
-        url_parts = url.split("offset=")
-        if len(url_parts) > 1:
-            offset_part = url_parts[1].split("&")[0]
-            print(f"Offset : {offset_part}")
-        print("-------------")
-
-        track_data = get_json_from_api(url, access_token)
-        if not track_data:
+        page = get_json_with_retry(url, access_token)
+        if not page:
             break
-
-        items = track_data.get('items', [])
-        all_tracks.extend(items)
-        url = track_data.get('next')
-
-        if url and "&locale=" in url:
-            url = url.split("&locale=")[0]
-
+        releases.extend(page.get('items', []))
+        url = page.get('next')
         if url and delay > 0:
             sleep(delay)
 
-        current_batch += 1
-
-    return all_tracks, current_batch
-
-
-def get_raw_spotify_data(spotify_url, batch: bool = False, delay: float = 1.0):
+    # Stable sort keeps Spotify's newest-first order inside each group
+    releases.sort(key=lambda r: groups.index(r.get('album_group')) if r.get('album_group') in groups else len(groups))
+    ids = []
+    for release in releases:
+        if release.get('id') and release['id'] not in ids:
+            ids.append(release['id'])
+    return ids
+
+
+def expand_albums(album_ids: List[str], access_token: str) -> List[Dict[str, Any]]:
+    # One request for up to 20 albums, extra pages only for albums over 50 tracks, then
+    # full track objects (for ISRCs) 50 at a time. Returns tracks in album order.
+    track_ids = []
+    for album in get_albums_by_ids(album_ids, access_token):
+        page = album.get('tracks') or {}
+        while page:
+            track_ids.extend(t['id'] for t in page.get('items', []) if t and t.get('id'))
+            next_url = page.get('next')
+            page = get_json_with_retry(next_url, access_token) if next_url else None
+    return get_tracks_by_ids(track_ids, access_token)
+
+
+def iter_artist_discography(artist_id: str, access_token: str, discography_type: str = "all",
+                            delay: float = 0.0, workers: int = 4):
+    album_ids = get_artist_release_ids(artist_id, access_token, discography_type, delay)
+    print(f"Found {len(album_ids)} releases")
+    batches = deque(album_ids[i:i + 20] for i in range(0, len(album_ids), 20))
+
+    # Expand up to `workers` batches of 20 albums at once, still yielding them in order
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        while batches or pending:
+            while batches and len(pending) < workers:
+                pending.append(pool.submit(expand_albums, batches.popleft(), access_token))
+            yield pending.popleft().result()
+
+
+def iter_spotify_pages(spotify_url, delay: float = 0.0):
+    # Yields (header, items) per page as it arrives. The header is the track/album/playlist/artist
+    # object itself (with "_token" for follow-up lookups); items are that page's raw API items.
+    # Artist pages hold full track objects of up to 20 releases each.
     url_info = parse_uri(spotify_url)
     token = get_access_token()
-
     if "error" in token:
-        return token
-
+        raise SpotifyWebsiteParserException(token["error"])
     access_token = token["accessToken"]
-    raw_data = {}
-
-    if url_info['type'] == "playlist":
-        try:
-            playlist_data = get_json_from_api(
-                playlist_base_url.format(url_info["id"]),
-                access_token
-            )
-            if not playlist_data:
-                return {"error": "Failed to get playlist data"}
-
-            raw_data = playlist_data
-            total_tracks = playlist_data.get('tracks', {}).get('total', 0)
-
-            if batch:
-                tracks_url = f'https://api.spotify.com/v1/playlists/{url_info["id"]}/tracks?limit=100'
-                tracks, num_batches = fetch_tracks_in_batches(tracks_url, access_token, 100, delay)
-                raw_data['tracks']['items'] = tracks
-                raw_data['_batch_count'] = num_batches
-                raw_data['_batch_enabled'] = True
-
-                if len(tracks) < total_tracks:
-                    last_offset = len(tracks)
-                    remaining_tracks = []
-                    while last_offset < total_tracks:
-                        print(f"Batch : {num_batches}")
-                        print(f"Offset : {last_offset}")
-                        print("-------------")
-                        remainder_url = f'https://api.spotify.com/v1/playlists/{url_info["id"]}/tracks?offset={last_offset}&limit=100'
-                        track_data = get_json_from_api(remainder_url, access_token)
-                        if not track_data or not track_data.get('items'):
-                            break
-                        items = track_data.get('items', [])
-                        remaining_tracks.extend(items)
-                        if len(items) < 100:
-                            break
-                        last_offset += len(items)
-                        num_batches += 1
-                        if delay > 0:
-                            sleep(delay)
-                    tracks.extend(remaining_tracks)
-                    raw_data['tracks']['items'] = tracks
-                    raw_data['_batch_count'] = num_batches
-            else:
-                tracks = []
-                tracks_url = f'https://api.spotify.com/v1/playlists/{url_info["id"]}/tracks?limit=100'
-                while tracks_url:
-                    track_data = get_json_from_api(tracks_url, access_token)
-                    if not track_data:
-                        break
-                    tracks.extend(track_data['items'])
-                    tracks_url = track_data.get('next')
-                    if tracks_url and "&locale=" in tracks_url:
-                        tracks_url = tracks_url.split("&locale=")[0]
-                raw_data['tracks']['items'] = tracks
-                raw_data['_batch_enabled'] = False
-        except Exception as e:
-            return {"error": f"Failed to get playlist data: {str(e)}"}
-
-    elif url_info["type"] == "album":
-        try:
-            album_data = get_json_from_api(
-                album_base_url.format(url_info["id"]),
-                access_token
-            )
-            if not album_data:
-                return {"error": "Failed to get album data"}
-
-            album_data['_token'] = access_token
-            raw_data = album_data
-            total_tracks = album_data.get('total_tracks', 0)
-
-            if batch:
-                tracks_url = f'{album_base_url.format(url_info["id"])}/tracks?limit=50'
-                tracks, num_batches = fetch_tracks_in_batches(tracks_url, access_token, 50, delay)
-                raw_data['tracks']['items'] = tracks
-                raw_data['_batch_count'] = num_batches
-                raw_data['_batch_enabled'] = True
-
-                if len(tracks) < total_tracks:
-                    last_offset = len(tracks)
-                    remaining_tracks = []
-                    while last_offset < total_tracks:
-                        print(f"Batch : {num_batches}")
-                        print(f"Offset : {last_offset}")
-                        print("-------------")
-                        remainder_url = f'{album_base_url.format(url_info["id"])}/tracks?offset={last_offset}&limit=50'
-                        track_data = get_json_from_api(remainder_url, access_token)
-                        if not track_data or not track_data.get('items'):
-                            break
-                        items = track_data.get('items', [])
-                        remaining_tracks.extend(items)
-                        if len(items) < 50:
-                            break
-                        last_offset += len(items)
-                        num_batches += 1
-                        if delay > 0:
-                            sleep(delay)
-                    tracks.extend(remaining_tracks)
-                    raw_data['tracks']['items'] = tracks
-                    raw_data['_batch_count'] = num_batches
-            else:
-                tracks = []
-                tracks_url = f'{album_base_url.format(url_info["id"])}/tracks?limit=50'
-                while tracks_url:
-                    track_data = get_json_from_api(tracks_url, access_token)
-                    if not track_data:
-                        break
-                    tracks.extend(track_data['items'])
-                    tracks_url = track_data.get('next')
-                    if tracks_url and "&locale=" in tracks_url:
-                        tracks_url = tracks_url.split("&locale=")[0]
-                raw_data['tracks']['items'] = tracks
-                raw_data['_batch_enabled'] = False
-        except Exception as e:
-            return {"error": f"Failed to get album data: {str(e)}"}
-
-    elif url_info["type"] == "track":
-        try:
-            track_data = get_json_from_api(
-                track_base_url.format(url_info["id"]),
-                access_token
-            )
-            if not track_data:
-                return {"error": "Failed to get track data"}
-            raw_data = track_data
-        except Exception as e:
-            return {"error": f"Failed to get track data: {str(e)}"}
-
-    return raw_data
-
-
-def format_track_data(track_data):
-    artists = []
-    for artist in track_data.get('artists', []):
-        if artist.get('name') is None:
-            artists.append('Unknown Artist')
-        else:
-            artists.append(artist['name'])
-
-    image_url = track_data.get('album', {}).get('images', [{}])[0].get('url', '') if track_data.get('album', {}).get(
-        'images') else ''
-    isrc = track_data.get('external_ids', {}).get('isrc', '')
-
-    return {
-        "track": {
-            "artists": ", ".join(artists),
-            "name": track_data.get('name', ''),
-            "album_name": track_data.get('album', {}).get('name', ''),
-            "duration_ms": track_data.get('duration_ms', 0),
-            "images": image_url,
-            "release_date": track_data.get('album', {}).get('release_date', ''),
-            "track_number": track_data.get('track_number', 0),
-            "external_urls": track_data.get('external_urls', {}).get('spotify', ''),
-            "isrc": isrc
-        }
-    }
 
-
-def format_album_data(album_data):
-    artists = []
-    for artist in album_data.get('artists', []):
-        if artist.get('name') is None:
-            artists.append('Unknown Artist')
-        else:
-            artists.append(artist['name'])
-
-    image_url = album_data.get('images', [{}])[0].get('url', '') if album_data.get('images') else ''
-    track_list = []
-
-    for track in album_data.get('tracks', {}).get('items', []):
-        track_artists = []
-        for artist in track.get('artists', []):
-            if artist.get('name') is None:
-                track_artists.append('Unknown Artist')
-            else:
-                track_artists.append(artist['name'])
-
-        track_id = track.get('id', '')
-        track_isrc = ''
-        if track_id and album_data.get('_token'):
-            try:
-                full_track_data = get_json_from_api(
-                    track_base_url.format(track_id),
-                    album_data.get('_token')
-                )
-                if full_track_data:
-                    track_isrc = full_track_data.get('external_ids', {}).get('isrc', '')
-            except:
-                pass
-
-        track_list.append({
-            "artists": ", ".join(track_artists),
-            "name": track.get('name', ''),
-            "album_name": album_data.get('name', ''),
-            "duration_ms": track.get('duration_ms', 0),
-            "images": image_url,
-            "release_date": album_data.get('release_date', ''),
-            "track_number": track.get('track_number', 0),
-            "external_urls": track.get('external_urls', {}).get('spotify', ''),
-            "isrc": track_isrc
-        })
-
-    album_info = {
-        "total_tracks": album_data.get('total_tracks', 0),
-        "name": album_data.get('name', ''),
-        "release_date": album_data.get('release_date', ''),
-        "artists": ", ".join(artists),
-        "images": image_url
-    }
-
-    if album_data.get('_batch_enabled', False):
-        album_info["batch"] = f"{album_data.get('_batch_count', 1)}"
-
-    return {
-        "album_info": album_info,
-        "track_list": track_list
-    }
-
-
-def format_playlist_data(playlist_data):
-    image_url = playlist_data.get('images', [{}])[0].get('url', '') if playlist_data.get('images') else ''
-    track_list = []
-
-    for item in playlist_data.get('tracks', {}).get('items', []):
-        track = item.get('track', {})
-        if not track:
-            continue
-
-        artists = []
-        for artist in track.get('artists', []):
-            if artist.get('name') is None:
-                artists.append('Unknown Artist')
-            else:
-                artists.append(artist['name'])
-
-        track_image = ''
-        if track.get('album', {}).get('images'):
-            track_image = track.get('album', {}).get('images', [{}])[0].get('url', '')
-
-        track_isrc = track.get('external_ids', {}).get('isrc', '')
-
-        track_list.append({
-            "artists": ", ".join(artists),
-            "name": track.get('name', ''),
-            "album_name": track.get('album', {}).get('name', ''),
-            "duration_ms": track.get('duration_ms', 0),
-            "images": track_image,
-            "release_date": track.get('album', {}).get('release_date', ''),
-            "track_number": track.get('track_number', 0),
-            "external_urls": track.get('external_urls', {}).get('spotify', ''),
-            "isrc": track_isrc
-        })
-
-    playlist_info = {
-        "tracks": {"total": playlist_data.get('tracks', {}).get('total', 0)},
-        "followers": {"total": playlist_data.get('followers', {}).get('total', 0)},
-        "owner": {
-            "display_name": playlist_data.get('owner', {}).get('display_name', ''),
-            "name": playlist_data.get('name', ''),
-            "images": image_url
-        }
-    }
-
-    if playlist_data.get('_batch_enabled', False):
-        playlist_info["batch"] = f"{playlist_data.get('_batch_count', 1)}"
-
-    return {
-        "playlist_info": playlist_info,
-        "track_list": track_list
-    }
-
-
-def process_spotify_data(raw_data, data_type):
-    if not raw_data or "error" in raw_data:
-        return {"error": "Invalid data provided"}
-
-    try:
-        if data_type == "track":
-            return format_track_data(raw_data)
-        elif data_type == "album":
-            return format_album_data(raw_data)
-        elif data_type == "playlist":
-            return format_playlist_data(raw_data)
-        else:
-            print("Invalid data type")
-            return {"error": "Invalid data type"}
-    except Exception as e:
-        print("Error processing data")
-        return {"error": f"Error processing data: {str(e)}"}
-
-
-def get_filtered_data(spotify_url, batch=False, delay=1.0):
-    raw_data = get_raw_spotify_data(spotify_url, batch=batch, delay=delay)
-    if raw_data and "error" not in raw_data:
-        url_info = parse_uri(spotify_url)
-        filtered_data = process_spotify_data(raw_data, url_info['type'])
-        return filtered_data
-    return {"error": "Failed to get raw data"}
+    if url_info["type"] == "track":
+        track_data = get_json_with_retry(track_base_url.format(url_info["id"]), access_token)
+        if not track_data:
+            raise SpotifyWebsiteParserException("Failed to get track data")
+        yield track_data, [track_data]
+        return
+
+    if url_info["type"] in ("artist", "artist_discography"):
+        header = get_json_with_retry(artist_base_url.format(url_info["id"]), access_token)
+        if not header:
+            raise SpotifyWebsiteParserException("Failed to get artist data")
+        header['_token'] = access_token
+        for items in iter_artist_discography(url_info["id"], access_token,
+                                             url_info.get("discography_type", "all"), delay):
+            yield header, items
+        return
+
+    if url_info["type"] == "album":
+        header = get_json_with_retry(album_base_url.format(url_info["id"]), access_token)
+    elif url_info["type"] == "playlist":
+        header = get_json_with_retry(playlist_base_url.format(url_info["id"]), access_token)
+    else:
+        raise SpotifyInvalidUrlException(f"ERROR: {url_info['type']} URLs are not supported")
+    if not header:
+        raise SpotifyWebsiteParserException(f"Failed to get {url_info['type']} data")
+
+    header['_token'] = access_token
+    # The object itself embeds the first page of tracks; follow "next" for the rest
+    page = header.get('tracks') or {}
+    while page:
+        yield header, page.get('items', [])
+        next_url = page.get('next')
+        if not next_url:
+            break
+        if "&locale=" in next_url:
+            next_url = next_url.split("&locale=")[0]
+        if delay > 0:
+            sleep(delay)
+        page = get_json_with_retry(next_url, access_token)
 
 
 if __name__ == '__main__':
     playlist = "https://open.spotify.com/playlist/37i9dQZEVXbNG2KDcFcKOF"
-    album = "https://open.spotify.com/album/6J84szYCnMfzEcvIcfWMFL"
-    song = "https://open.spotify.com/track/7so0lgd0zP2Sbgs2d7a1SZ"
 
     print("Fetching playlist...")
-    filtered_playlist = get_filtered_data(playlist, batch=True, delay=0.1)
-    print(json.dumps(filtered_playlist, indent=2))
-
-    print("\nFetching album...")
-    filtered_album = get_filtered_data(album)
-    print(json.dumps(filtered_album, indent=2))
-
-    print("\nFetching track...")
-    filtered_track = get_filtered_data(song)
-    print(json.dumps(filtered_track, indent=2))
\ No newline at end of file
+    for header, items in iter_spotify_pages(playlist, delay=0.1):
+        print(f"{header.get('name')}: page of {len(items)} tracks")
@@ -0,0 +1,272 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from SpotiFLAC.trackStore import Track
+
+JOURNAL_NAME = ".spotiflac-journal.db"
+# Seconds a worker's claim on a track (or on listing a job) lasts unless its heartbeat renews it
+LEASE_TTL = 120.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    url TEXT PRIMARY KEY,
+    name TEXT NOT NULL DEFAULT '',
+    kind TEXT NOT NULL DEFAULT '',
+    total INTEGER NOT NULL DEFAULT 0,
+    listed INTEGER NOT NULL DEFAULT 0,
+    finished INTEGER NOT NULL DEFAULT 0,
+    updated REAL NOT NULL DEFAULT 0,
+    lease_owner TEXT NOT NULL DEFAULT '',
+    lease_expires REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    job TEXT NOT NULL,
+    track_id TEXT NOT NULL,
+    position INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending',
+    service TEXT NOT NULL DEFAULT '',
+    resolved TEXT NOT NULL DEFAULT '{}',
+    path TEXT NOT NULL DEFAULT '',
+    bytes INTEGER NOT NULL DEFAULT 0,
+    error TEXT NOT NULL DEFAULT '',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    meta TEXT NOT NULL DEFAULT '{}',
+    updated REAL NOT NULL DEFAULT 0,
+    lease_owner TEXT NOT NULL DEFAULT '',
+    lease_expires REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (job, track_id)
+);
+CREATE INDEX IF NOT EXISTS tracks_status ON tracks (job, status);
+"""
+
+# Columns added since the first journal version, created on open when missing
+_LEASE_COLUMNS = (("lease_owner", "TEXT NOT NULL DEFAULT ''"), ("lease_expires", "REAL NOT NULL DEFAULT 0"))
+
+
+class DownloadJournal:
+    # Per-track progress of every job downloading into one output directory, kept in SQLite so
+    # each update is committed as it happens and survives a crash or Ctrl-C.
+    # With `shared`, several worker processes (possibly on other machines, over a shared
+    # filesystem) use it as one work queue: each claims tracks with an expiring lease.
+    _open: Dict[str, "DownloadJournal"] = {}
+    _open_lock = threading.Lock()
+
+    def __init__(self, path: str, shared: bool = False):
+        self.path = path
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        if shared:
+            # WAL needs shared memory, which other machines on a network filesystem don't share;
+            # if a local process still has the file open in WAL it stays that way
+            try:
+                self.conn.execute("PRAGMA journal_mode=DELETE")
+            except sqlite3.OperationalError:
+                pass
+        else:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+        for table in ("jobs", "tracks"):
+            columns = {row["name"] for row in self.conn.execute(f"PRAGMA table_info({table})")}
+            for name, definition in _LEASE_COLUMNS:
+                if name not in columns:
+                    self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS tracks_lease ON tracks (lease_owner)")
+        self.conn.commit()
+
+    @classmethod
+    def for_output_dir(cls, output_dir: str, shared: bool = False) -> "DownloadJournal":
+        path = os.path.abspath(os.path.join(output_dir, JOURNAL_NAME))
+        with cls._open_lock:
+            journal = cls._open.get(path)
+            if journal is None:
+                journal = cls._open[path] = cls(path, shared)
+            return journal
+
+    def _write(self, sql: str, params: Iterable = ()) -> None:
+        with self.lock:
+            self.conn.execute(sql, tuple(params))
+            self.conn.commit()
+
+    # --- jobs ---
+
+    def get_job(self, url: str) -> Optional[Dict]:
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM jobs WHERE url = ?", (url,)).fetchone()
+        return dict(row) if row else None
+
+    def start_job(self, url: str, name: str, kind: str, total: int) -> None:
+        self._write(
+            "INSERT INTO jobs (url, name, kind, total, listed, finished, updated) VALUES (?, ?, ?, ?, 0, 0, ?) "
+            "ON CONFLICT(url) DO UPDATE SET name = excluded.name, kind = excluded.kind, total = excluded.total, "
+            "listed = 0, finished = 0, updated = excluded.updated",
+            (url, name, kind, total, time.time()),
+        )
+
+    def mark_listed(self, url: str) -> None:
+        self._write("UPDATE jobs SET listed = 1, lease_owner = '', lease_expires = 0, updated = ? WHERE url = ?",
+                    (time.time(), url))
+
+    def finish_job(self, url: str) -> None:
+        # Only a job whose whole track list made it into the journal counts as finished; a shared
+        # one only once no worker has any of its tracks left to do
+        sql = "UPDATE jobs SET finished = 1, updated = ? WHERE url = ? AND listed = 1"
+        if self.shared:
+            sql += " AND NOT EXISTS (SELECT 1 FROM tracks WHERE job = ? AND status = 'pending')"
+            self._write(sql, (time.time(), url, url))
+        else:
+            self._write(sql, (time.time(), url))
+
+    def unfinished_jobs(self) -> List[str]:
+        with self.lock:
+            rows = self.conn.execute("SELECT url FROM jobs WHERE finished = 0 ORDER BY updated").fetchall()
+        return [row["url"] for row in rows]
+
+    # --- tracks ---
+
+    def add_tracks(self, url: str, tracks: List[Tuple[int, Track]]) -> None:
+        # New tracks start as pending; tracks already journaled keep their status and resolved ids
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT INTO tracks (job, track_id, position, meta, updated) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(job, track_id) DO UPDATE SET position = excluded.position, meta = excluded.meta",
+                [(url, track.id, position, json.dumps(track.to_dict()), now) for position, track in tracks],
+            )
+            self.conn.commit()
+
+    def get(self, url: str, track_id: str) -> Optional[Dict]:
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM tracks WHERE job = ? AND track_id = ?", (url, track_id)).fetchone()
+        if not row:
+            return None
+        entry = dict(row)
+        entry["resolved"] = json.loads(entry["resolved"] or "{}")
+        return entry
+
+    def entries(self, url: str, statuses: Iterable[str]) -> List[Dict]:
+        statuses = list(statuses)
+        marks = ",".join("?" for _ in statuses)
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT * FROM tracks WHERE job = ? AND status IN ({marks}) ORDER BY position", [url, *statuses]
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def set_resolved(self, url: str, track_id: str, service: str, value) -> None:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT resolved FROM tracks WHERE job = ? AND track_id = ?", (url, track_id)
+            ).fetchone()
+            resolved = json.loads(row["resolved"]) if row else {}
+            resolved[service] = value
+            self.conn.execute(
+                "UPDATE tracks SET resolved = ?, updated = ? WHERE job = ? AND track_id = ?",
+                (json.dumps(resolved), time.time(), url, track_id),
+            )
+            self.conn.commit()
+
+    def record_done(self, url: str, track_id: str, service: str, path: str) -> None:
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        self._write(
+            "UPDATE tracks SET status = 'done', service = ?, path = ?, bytes = ?, error = '', "
+            "attempts = attempts + 1, lease_owner = '', lease_expires = 0, updated = ? WHERE job = ? AND track_id = ?",
+            (service, path, size, time.time(), url, track_id),
+        )
+
+    def record_failed(self, url: str, track_id: str, error: str) -> None:
+        self._write(
+            "UPDATE tracks SET status = 'failed', error = ?, attempts = attempts + 1, lease_owner = '', "
+            "lease_expires = 0, updated = ? WHERE job = ? AND track_id = ?",
+            (error or "", time.time(), url, track_id),
+        )
+
+    # --- leases (worker processes sharing the journal) ---
+
+    def claim_listing(self, url: str, owner: str, ttl: float = LEASE_TTL) -> bool:
+        # True if `owner` is to fetch the job's track list now: it isn't listed (or its last run
+        # finished, so the list may have changed) and no live worker is already listing it
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT INTO jobs (url, updated) VALUES (?, ?) ON CONFLICT(url) DO NOTHING", (url, now))
+            cur = self.conn.execute(
+                "UPDATE jobs SET lease_owner = ?, lease_expires = ? WHERE url = ? AND (listed = 0 OR finished = 1) "
+                "AND (lease_owner IN ('', ?) OR lease_expires < ?)",
+                (owner, now + ttl, url, owner, now),
+            )
+            self.conn.commit()
+        return cur.rowcount == 1
+
+    def release_listing(self, url: str, owner: str) -> None:
+        self._write("UPDATE jobs SET lease_owner = '', lease_expires = 0 WHERE url = ? AND lease_owner = ?",
+                    (url, owner))
+
+    def claim_tracks(self, url: str, owner: str, failed_before: float, pending: bool = True, limit: int = 1,
+                     ttl: float = LEASE_TTL) -> List[Dict]:
+        # Leases up to `limit` tracks that nobody holds (or whose holder stopped renewing), in list
+        # order: pending ones, and ones that failed before `failed_before` (the claiming worker's
+        # start, so each worker gives a failed track one more try instead of looping on it)
+        now = time.time()
+        match = "(status = 'failed' AND updated < ?)"
+        if pending:
+            match = f"(status = 'pending' OR {match})"
+        params = [failed_before]
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.conn.execute(
+                    f"SELECT * FROM tracks WHERE job = ? AND {match} AND (lease_owner = '' OR lease_expires < ?) "
+                    "ORDER BY position LIMIT ?",
+                    [url, *params, now, limit],
+                ).fetchall()
+                self.conn.executemany(
+                    "UPDATE tracks SET lease_owner = ?, lease_expires = ? WHERE job = ? AND track_id = ?",
+                    [(owner, now + ttl, url, row["track_id"]) for row in rows],
+                )
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+        return [dict(row) for row in rows]
+
+    def lease_state(self, url: str, owner: str) -> Dict:
+        # Whether the job is listed, and whether other live workers are listing it or hold tracks of it
+        now = time.time()
+        with self.lock:
+            job = self.conn.execute(
+                "SELECT listed, lease_owner NOT IN ('', ?) AND lease_expires >= ? AS listing FROM jobs WHERE url = ?",
+                (owner, now, url),
+            ).fetchone()
+            held = self.conn.execute(
+                "SELECT COUNT(*) FROM tracks WHERE job = ? AND lease_owner NOT IN ('', ?) AND lease_expires >= ?",
+                (url, owner, now),
+            ).fetchone()[0]
+        return {"listed": bool(job and job["listed"]), "listing": bool(job and job["listing"]), "held": held}
+
+    def renew_leases(self, owner: str, ttl: float = LEASE_TTL) -> int:
+        # Heartbeat: pushes back the expiry of everything `owner` holds; returns the tracks held
+        expires = time.time() + ttl
+        with self.lock:
+            self.conn.execute("UPDATE jobs SET lease_expires = ? WHERE lease_owner = ?", (expires, owner))
+            cur = self.conn.execute("UPDATE tracks SET lease_expires = ? WHERE lease_owner = ?", (expires, owner))
+            self.conn.commit()
+        return cur.rowcount
+
+    def release_leases(self, owner: str) -> None:
+        # Hands whatever `owner` still holds back to the other workers right away
+        with self.lock:
+            self.conn.execute("UPDATE jobs SET lease_owner = '', lease_expires = 0 WHERE lease_owner = ?", (owner,))
+            self.conn.execute("UPDATE tracks SET lease_owner = '', lease_expires = 0 WHERE lease_owner = ?", (owner,))
+            self.conn.commit()
+
+    def close(self) -> None:
+        with self._open_lock:
+            self._open.pop(self.path, None)
+        with self.lock:
+            self.conn.close()
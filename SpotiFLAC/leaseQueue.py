@@ -0,0 +1,59 @@
+import os
+import socket
+import sqlite3
+import threading
+import uuid
+from typing import List
+
+from SpotiFLAC.journal import LEASE_TTL, DownloadJournal
+
+# How often a worker with nothing to claim looks again for new, abandoned or listed tracks
+POLL_INTERVAL = 5.0
+
+
+def worker_id() -> str:
+    # Unique per process, readable enough to tell in the journal which node holds what
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+class Heartbeat:
+    # Renews every lease this worker holds well before it expires. If the process dies (or
+    # hangs) the renewals stop and the other workers pick its tracks up once the leases run out;
+    # stop() hands them back right away.
+    def __init__(self, owner: str = "", ttl: float = LEASE_TTL):
+        self.owner = owner or worker_id()
+        self.ttl = ttl
+        self.journals: List[DownloadJournal] = []
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="lease-heartbeat", daemon=True)
+
+    def watch(self, journal: DownloadJournal) -> None:
+        with self.lock:
+            if journal not in self.journals:
+                self.journals.append(journal)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def _run(self) -> None:
+        while not self.stopping.wait(self.ttl / 4):
+            with self.lock:
+                journals = list(self.journals)
+            for journal in journals:
+                try:
+                    journal.renew_leases(self.owner, self.ttl)
+                except sqlite3.Error as e:
+                    print(f"Warning: could not renew leases in {journal.path} ({e})")
+
+    def stop(self) -> None:
+        self.stopping.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        with self.lock:
+            journals = list(self.journals)
+        for journal in journals:
+            try:
+                journal.release_leases(self.owner)
+            except sqlite3.Error as e:
+                print(f"Warning: could not release leases in {journal.path} ({e})")
@@ -0,0 +1,87 @@
+import os
+import re
+import shutil
+import threading
+from typing import Optional
+
+LINK_MODES = ("hardlink", "symlink", "reflink", "copy")
+# Extensions a stored recording may have, in lookup order
+STORE_EXTENSIONS = (".flac", ".m4a")
+# FICLONE ioctl (Linux btrfs/xfs/...): share the source's extents copy-on-write
+FICLONE = 0x40049409
+
+
+def _reflink(src: str, dst: str) -> None:
+    import fcntl
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+class LibraryStore:
+    # Keeps every recording once, as <root>/<first two ISRC chars>/<ISRC>.<ext>, and makes the
+    # playlist/album/artist folders out of links to it. A track that is already in the store
+    # costs no download and (except in copy mode) no extra disk space in another folder.
+    def __init__(self, root: str, link_mode: str = "hardlink"):
+        if link_mode not in LINK_MODES:
+            raise ValueError(f"link mode must be one of {', '.join(LINK_MODES)}")
+        self.root = os.path.abspath(root)
+        self.link_mode = link_mode
+        self.lock = threading.Lock()
+        self._warned = False
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def _key(isrc: str) -> str:
+        return re.sub(r"[^A-Z0-9]", "", (isrc or "").upper())
+
+    def path_for(self, isrc: str, ext: str = ".flac") -> str:
+        key = self._key(isrc)
+        return os.path.join(self.root, key[:2] or "__", key + ext)
+
+    def find(self, isrc: str) -> Optional[str]:
+        if not self._key(isrc):
+            return None
+        for ext in STORE_EXTENSIONS:
+            path = self.path_for(isrc, ext)
+            if os.path.exists(path) and os.path.getsize(path) > 0:
+                return path
+        return None
+
+    def adopt(self, path: str, isrc: str) -> str:
+        # Moves a freshly downloaded file into the store and leaves a link in its place
+        if not self._key(isrc) or not os.path.exists(path):
+            return path
+        with self.lock:
+            stored = self.find(isrc)
+            if stored is None:
+                stored = self.path_for(isrc, os.path.splitext(path)[1] or ".flac")
+                os.makedirs(os.path.dirname(stored), exist_ok=True)
+                shutil.move(path, stored)
+            elif os.path.samefile(stored, path):
+                return path
+            else:
+                os.remove(path)
+        self.link(stored, path)
+        return path
+
+    def link(self, stored: str, dest: str) -> None:
+        os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+        if os.path.lexists(dest):
+            os.remove(dest)
+        try:
+            if self.link_mode == "hardlink":
+                os.link(stored, dest)
+            elif self.link_mode == "symlink":
+                os.symlink(stored, dest)
+            elif self.link_mode == "reflink":
+                _reflink(stored, dest)
+            else:
+                shutil.copyfile(stored, dest)
+        except (OSError, ImportError) as e:
+            # e.g. store and library on different filesystems, or no reflink support
+            if not self._warned:
+                self._warned = True
+                print(f"Warning: {self.link_mode} into {os.path.dirname(dest)} failed ({e}); copying instead")
+            if os.path.lexists(dest):
+                os.remove(dest)
+            shutil.copyfile(stored, dest)
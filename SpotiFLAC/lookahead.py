@@ -0,0 +1,104 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Hashable, Optional
+from urllib.parse import parse_qs, urlparse
+
+# Upcoming tracks resolved ahead of their transfer
+LOOKAHEAD = 4
+# How long a prefetched stream URL is trusted when it carries no expiry of its own
+URL_TTL = 300.0
+# Signed URLs are dropped this long before their stated expiry
+EXPIRY_MARGIN = 30.0
+# Query parameters CDNs use for an absolute expiry (unix seconds)
+EXPIRY_PARAMS = ("Expires", "expires", "etsp", "exp")
+
+
+def url_expiry(url: str, ttl: float = URL_TTL) -> float:
+    # time.monotonic() deadline after which a prefetched URL must be fetched again
+    now = time.time()
+    deadline = now + ttl
+    try:
+        query = parse_qs(urlparse(url or "").query)
+    except ValueError:
+        query = {}
+    for name in EXPIRY_PARAMS:
+        for value in query.get(name, []):
+            if value.isdigit():
+                deadline = min(deadline, int(value) - EXPIRY_MARGIN)
+    return time.monotonic() + (deadline - now)
+
+
+@dataclass
+class Resolution:
+    # A track resolved ahead of time on one service: its service id, the lookup result and a
+    # stream URL (or whatever the backend needs to start the transfer) valid until `expires`
+    svc: str
+    id: Any = None
+    info: Any = None
+    stream: Any = None
+    expires: float = 0.0
+
+    def fresh_stream(self):
+        if self.stream is not None and time.monotonic() < self.expires:
+            return self.stream
+        return None
+
+
+class Lookahead:
+    # Speculative resolution for the next `window` tracks: the submitter schedules a track's
+    # lookup before queueing the track itself and blocks once `window` results are waiting to
+    # be taken, so lookups stay a bounded distance ahead of the transfers.
+    def __init__(self, window: int = LOOKAHEAD, workers: int = 1):
+        self.window = max(0, window)
+        self.pool = ThreadPoolExecutor(max(1, min(workers, self.window)), thread_name_prefix="lookahead") \
+            if self.window else None
+        self.slots = threading.BoundedSemaphore(self.window) if self.window else None
+        self.pending: Dict[Hashable, Future] = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.expired = 0
+
+    def schedule(self, key: Hashable, fn: Callable[..., Optional[Resolution]], *args) -> None:
+        if self.pool is None:
+            return
+        self.slots.acquire()
+        try:
+            future = self.pool.submit(fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.pending[key] = future
+
+    def take(self, key: Hashable) -> Optional[Resolution]:
+        # The track is about to transfer. A lookup still in flight is waited for rather than
+        # repeated; a failed one just means the track resolves itself as usual.
+        with self.lock:
+            future = self.pending.pop(key, None)
+        if future is None:
+            return None
+        self.slots.release()
+        try:
+            resolution = future.result()
+        except Exception:
+            return None
+        if resolution is not None:
+            with self.lock:
+                self.hits += 1
+                if resolution.stream is not None and resolution.fresh_stream() is None:
+                    self.expired += 1
+        return resolution
+
+    def discard(self, key: Hashable) -> None:
+        # Track finished without transferring (skipped, linked, failed early)
+        with self.lock:
+            future = self.pending.pop(key, None)
+        if future is not None:
+            future.cancel()
+            self.slots.release()
+
+    def shutdown(self) -> None:
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
@@ -0,0 +1,99 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+CACHE_NAME = "unavailable.db"
+DEFAULT_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+                           "spotiflac")
+# First recheck after an hour, doubling with every further miss, up to a month
+MISS_TTL = 3600.0
+MISS_TTL_MAX = 30 * 24 * 3600.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS misses (
+    track TEXT NOT NULL,
+    service TEXT NOT NULL,
+    reason TEXT NOT NULL DEFAULT '',
+    failures INTEGER NOT NULL DEFAULT 0,
+    retry_at REAL NOT NULL DEFAULT 0,
+    updated REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (track, service)
+);
+"""
+
+
+def miss_ttl(failures: int) -> float:
+    return min(MISS_TTL * 2 ** max(failures - 1, 0), MISS_TTL_MAX)
+
+
+class TrackUnavailable(Exception):
+    # Raised by a backend when the service answered and does not have the track. Only these are
+    # remembered: throttling, outages and dropped connections say nothing about availability.
+    pass
+
+
+def track_key(track) -> str:
+    # ISRC when known, so the same recording on another release shares the entry
+    return (track.isrc or "").strip().upper() or f"spotify:{track.id}"
+
+
+class NegativeCache:
+    # Services a track could not be found on, with the reason and when to look again. Every
+    # consecutive miss doubles the wait, so tracks that are simply not on a service cost one
+    # SQLite lookup per run instead of a full round of searches and provider requests.
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+        self.conn.commit()
+
+    @classmethod
+    def open_default(cls, directory: str = DEFAULT_DIR) -> Optional["NegativeCache"]:
+        try:
+            os.makedirs(directory, exist_ok=True)
+            return cls(os.path.join(directory, CACHE_NAME))
+        except (OSError, sqlite3.Error) as e:
+            print(f"Warning: unavailable-track cache disabled ({e})")
+            return None
+
+    def blocked(self, key: str, service: str) -> Optional[Dict]:
+        # The recorded miss while its recheck time hasn't come yet, else None
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT * FROM misses WHERE track = ? AND service = ? AND retry_at > ?",
+                (key, service, time.time()),
+            ).fetchone()
+        return dict(row) if row else None
+
+    def record(self, key: str, service: str, reason: str) -> float:
+        # Returns how long the service is skipped for this track
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT failures FROM misses WHERE track = ? AND service = ?", (key, service)
+            ).fetchone()
+            failures = (row["failures"] if row else 0) + 1
+            ttl = miss_ttl(failures)
+            self.conn.execute(
+                "INSERT INTO misses (track, service, reason, failures, retry_at, updated) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(track, service) DO UPDATE SET reason = excluded.reason, failures = excluded.failures, "
+                "retry_at = excluded.retry_at, updated = excluded.updated",
+                (key, service, (reason or "")[:500], failures, now + ttl, now),
+            )
+            self.conn.commit()
+        return ttl
+
+    def clear(self, key: str, service: str) -> None:
+        with self.lock:
+            self.conn.execute("DELETE FROM misses WHERE track = ? AND service = ?", (key, service))
+            self.conn.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
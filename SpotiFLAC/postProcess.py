@@ -0,0 +1,81 @@
+import os
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+
+def cpu_workers() -> int:
+    try:
+        return max(1, len(os.sched_getaffinity(0)))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class PostProcessor:
+    # CPU stage for ffmpeg conversion/decryption and tagging. Each worker drives one ffmpeg
+    # process at a time, so `workers` (default: one per core) caps how many run at once, and
+    # `queue_size` caps how many finished transfers may wait for a worker before the threads
+    # handing them over block. workers=0 runs everything inline on the calling thread.
+    def __init__(self, workers: Optional[int] = None, queue_size: Optional[int] = None):
+        self.workers = cpu_workers() if workers is None else max(0, workers)
+        self.queue_size = self.workers if queue_size is None else max(0, queue_size)
+        self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix="post") if self.workers else None
+        self.slots = threading.BoundedSemaphore(self.workers + self.queue_size) if self.workers else None
+        # Network slot held by the current download thread, handed back for good once it reaches
+        # the CPU stage: what follows is tagging, a rename and bookkeeping, none of it network
+        self.network: Optional[threading.BoundedSemaphore] = None
+        self._local = threading.local()
+
+    @property
+    def capacity(self) -> int:
+        return self.workers + self.queue_size
+
+    @contextmanager
+    def network_slot(self):
+        if self.network is None:
+            yield
+            return
+        self.network.acquire()
+        self._local.held = True
+        try:
+            yield
+        finally:
+            if getattr(self._local, "held", False):
+                self._local.held = False
+                self.network.release()
+
+    @contextmanager
+    def cpu_slot(self):
+        # For ffmpeg processes fed from the calling thread (e.g. decrypting while downloading),
+        # which can't be handed to the pool but count against the same limit
+        if self.slots is None:
+            yield
+            return
+        with self.slots:
+            yield
+
+    def run(self, fn: Callable, *args, **kwargs):
+        if self.pool is None:
+            return fn(*args, **kwargs)
+        if getattr(self._local, "held", False):
+            self._local.held = False
+            self.network.release()
+        with self.slots:
+            return self.pool.submit(fn, *args, **kwargs).result()
+
+    def ffmpeg(self, cmd: List[str]) -> subprocess.CompletedProcess:
+        si = None
+        if os.name == 'nt':
+            si = subprocess.STARTUPINFO()
+            si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        return self.run(subprocess.run, cmd, capture_output=True, startupinfo=si)
+
+    def shutdown(self) -> None:
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+
+
+# Standalone downloaders (no scheduler) keep the old behaviour: everything on the calling thread
+INLINE = PostProcessor(workers=0)
@@ -6,9 +6,11 @@ import random
 import time
 from typing import Callable, Dict, Optional, Tuple, List
 
-import requests
-from mutagen.flac import FLAC, Picture
-from mutagen.id3 import PictureType
+from SpotiFLAC import tagging, transfer
+from SpotiFLAC.coverCache import COVERS
+from SpotiFLAC.deadline import DeadlineSession
+from SpotiFLAC.negativeCache import TrackUnavailable
+from SpotiFLAC.postProcess import INLINE
 
 def _sanitize_filename(value: str, fallback: str = "Unknown") -> str:
     if not value:
@@ -57,9 +59,10 @@ class QobuzDownloader:
     def __init__(self, timeout: float = 60.0, app_id: str = "798273057"):
         self.timeout = timeout
         self.app_id = app_id
-        self.session = requests.Session()
-        self.session.timeout = timeout
+        self.session = DeadlineSession(timeout)
         self.progress_callback = lambda current, total: None
+        self.post = INLINE
+        self.covers = COVERS
 
     def set_progress_callback(self, callback: Callable[[int, int], None]) -> None:
         self.progress_callback = callback
@@ -81,9 +84,19 @@ class QobuzDownloader:
         data = resp.json()
         items = data.get("tracks", {}).get("items", [])
         if not items:
-            raise Exception(f"track not found for ISRC: {isrc}")
+            raise TrackUnavailable(f"track not found for ISRC: {isrc}")
         return items[0]
 
+    def get_album_tracks(self, album_id: str) -> List[Dict]:
+        url = f"https://www.qobuz.com/api.json/0.2/album/get?album_id={album_id}&app_id={self.app_id}"
+        headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"}
+        resp = self.session.get(url, headers=headers)
+        if resp.status_code != 200:
+            raise Exception(f"API Error: Status {resp.status_code}")
+        tracks = resp.json().get("tracks", {}).get("items", [])
+        print(f"Found {len(tracks)} tracks on Qobuz album {album_id}")
+        return tracks
+
     def _download_from_jumo(self, track_id: int, quality: str) -> str:
         format_id = {"6": 6, "7": 7, "27": 27}.get(quality, 6)
         url = f"https://jumo-dl.pages.dev/get?track_id={track_id}&format_id={format_id}&region=US"
@@ -185,25 +198,8 @@ class QobuzDownloader:
         raise Exception("All APIs and fallbacks failed to provide a download URL")
 
     def _stream_download(self, url: str, filepath: str) -> None:
-        os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
-        temp_path = filepath + ".part"
-        try:
-            with self.session.get(url, stream=True) as resp:
-                resp.raise_for_status()
-                total = int(resp.headers.get("Content-Length") or 0)
-                downloaded = 0
-                with open(temp_path, "wb") as f:
-                    for chunk in resp.iter_content(chunk_size=256 * 1024):
-                        if chunk:
-                            f.write(chunk)
-                            downloaded += len(chunk)
-                            if self.progress_callback:
-                                self.progress_callback(downloaded, total)
-            os.replace(temp_path, filepath)
-        finally:
-            if os.path.exists(temp_path):
-                try: os.remove(temp_path)
-                except: pass
+        stats = transfer.download(self.session, url, filepath, self.progress_callback)
+        print(f"\nDownloaded {stats}")
 
     def download_by_isrc(self, isrc, output_dir, quality, filename_format, include_track_number, position, 
                          spotify_track_name, spotify_artist_name, spotify_album_name, use_album_track_number,
@@ -219,18 +215,27 @@ class QobuzDownloader:
         spotify_publisher = kwargs.get("spotify_publisher", "")
         spotify_url = kwargs.get("spotify_url", "")
         allow_fallback = kwargs.get("allow_fallback", True)
+        qobuz_track = kwargs.get("qobuz_track")
+        qobuz_track_id = kwargs.get("qobuz_track_id")
+        download_url = kwargs.get("download_url")
 
-        print(f"Fetching track info for ISRC: {isrc}")
         os.makedirs(output_dir, exist_ok=True)
 
-        track = self._search_by_isrc(isrc)
+        if qobuz_track:
+            track = qobuz_track
+        elif qobuz_track_id:
+            track = {"id": qobuz_track_id}
+        else:
+            print(f"Fetching track info for ISRC: {isrc}")
+            track = self._search_by_isrc(isrc)
         
         q_track_num = track.get("track_number", 0)
         final_track_num = q_track_num if (use_album_track_number and q_track_num > 0) else position
         if final_track_num == 0 and spotify_track_number > 0:
             final_track_num = spotify_track_number
 
-        print(f"Found track: {track.get('performer', {}).get('name')} - {track.get('title')}")
+        if track.get("title"):
+            print(f"Found track: {track.get('performer', {}).get('name')} - {track.get('title')}")
         
         filename = build_qobuz_filename(
             spotify_track_name, spotify_artist_name, spotify_album_name, spotify_album_artist,
@@ -243,21 +248,18 @@ class QobuzDownloader:
             print(f"File already exists: {filepath}")
             return filepath
 
-        download_url = self.get_download_url(track['id'], quality, allow_fallback)
+        # Cover downloads alongside the audio and is joined before tagging
+        cover = self.covers.prefetch(spotify_cover_url, self.session)
+
+        if not download_url:
+            download_url = self.get_download_url(track['id'], quality, allow_fallback)
         print(f"Download URL obtained")
         
         print(f"Downloading FLAC file to: {filepath}")
         self._stream_download(download_url, filepath)
         print()
 
-        cover_path = ""
-        if spotify_cover_url:
-            cover_path = filepath + ".cover.jpg"
-            try:
-                with open(cover_path, "wb") as f:
-                    f.write(self.session.get(spotify_cover_url).content)
-            except:
-                cover_path = ""
+        cover_data = cover.result()
 
         metadata = {
             "TITLE": spotify_track_name,
@@ -276,28 +278,14 @@ class QobuzDownloader:
             "DESCRIPTION": "https://github.com/afkarxyz/SpotiFLAC"
         }
 
-        self._embed_metadata(filepath, metadata, cover_path)
-        
-        if cover_path and os.path.exists(cover_path):
-            try: os.remove(cover_path)
-            except: pass
+        self.post.run(self._embed_metadata, filepath, metadata, cover_data)
 
         return filepath
 
-    def _embed_metadata(self, filepath, metadata, cover_path):
+    def _embed_metadata(self, filepath, metadata, cover_data):
         try:
-            audio = FLAC(filepath)
-            for key, val in metadata.items():
-                if val: audio[key] = str(val)
-            
-            if cover_path and os.path.exists(cover_path):
-                with open(cover_path, "rb") as img:
-                    pic = Picture()
-                    pic.data = img.read()
-                    pic.type = PictureType.COVER_FRONT
-                    pic.mime = "image/jpeg"
-                    audio.add_picture(pic)
-            audio.save()
+            # Qobuz files come tagged by the provider; ours are merged over them
+            tagging.write_tags(filepath, metadata, cover_data, replace=False)
             print("Metadata embedded successfully!")
         except Exception as e:
             print(f"Metadata error: {e}")
\ No newline at end of file
@@ -0,0 +1,174 @@
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from SpotiFLAC.negativeCache import DEFAULT_DIR
+
+# Attempts a bucket needs before it is trusted over the broader one behind it
+MIN_SAMPLES = 2
+# Smoothing: every bucket starts as if it had PRIOR_WEIGHT attempts at these values
+PRIOR_WEIGHT = 2.0
+PRIOR_SUCCESS = 0.5
+PRIOR_SECONDS = 30.0
+# History from earlier runs counts half as much after this long, so a service that got better
+# (or worse) isn't judged by old runs for ever
+HALF_LIFE = 14 * 24 * 3600.0
+STATS_NAME = "service-stats.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stats (
+    bucket TEXT NOT NULL,
+    service TEXT NOT NULL,
+    attempts REAL NOT NULL DEFAULT 0,
+    successes REAL NOT NULL DEFAULT 0,
+    seconds REAL NOT NULL DEFAULT 0,
+    updated REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, service)
+);
+"""
+
+
+@dataclass
+class ServiceStats:
+    # Counts are floats: history loaded from earlier runs is decayed
+    attempts: float = 0.0
+    successes: float = 0.0
+    seconds: float = 0.0
+
+    def add(self, ok: bool, seconds: float) -> None:
+        self.attempts += 1
+        self.successes += int(ok)
+        self.seconds += seconds
+
+    def decayed(self, age: float) -> "ServiceStats":
+        factor = 0.5 ** (max(age, 0.0) / HALF_LIFE)
+        return ServiceStats(self.attempts * factor, self.successes * factor, self.seconds * factor)
+
+    @property
+    def success_rate(self) -> float:
+        return (self.successes + PRIOR_SUCCESS * PRIOR_WEIGHT) / (self.attempts + PRIOR_WEIGHT)
+
+    @property
+    def mean_seconds(self) -> float:
+        return (self.seconds + PRIOR_SECONDS * PRIOR_WEIGHT) / (self.attempts + PRIOR_WEIGHT)
+
+    @property
+    def expected_cost(self) -> float:
+        # Time spent per successful download if the service is tried first
+        return self.mean_seconds / self.success_rate
+
+
+def buckets(track) -> List[str]:
+    # Most specific first: the album, the ISRC registrant (country + label code), everything
+    keys = []
+    if track.album:
+        keys.append(f"album:{track.album_artist or track.artists}/{track.album}")
+    isrc = (track.isrc or "").strip().upper()
+    if len(isrc) >= 5:
+        keys.append(f"registrant:{isrc[:5]}")
+    keys.append("all")
+    return keys
+
+
+class StatsStore:
+    # The ranker's history across runs, in SQLite next to the negative cache. Rows are decayed
+    # by their age when loaded, and dropped once they're worth less than one attempt.
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+        self.conn.commit()
+
+    @classmethod
+    def open_default(cls, directory: str = DEFAULT_DIR) -> Optional["StatsStore"]:
+        try:
+            os.makedirs(directory, exist_ok=True)
+            return cls(os.path.join(directory, STATS_NAME))
+        except (OSError, sqlite3.Error) as e:
+            print(f"Warning: service ranking history disabled ({e})")
+            return None
+
+    def load(self) -> Dict[Tuple[str, str], ServiceStats]:
+        now = time.time()
+        stats, stale = {}, []
+        for bucket, service, attempts, successes, seconds, updated in self.conn.execute("SELECT * FROM stats"):
+            s = ServiceStats(attempts, successes, seconds).decayed(now - updated)
+            if s.attempts >= 1:
+                stats[(bucket, service)] = s
+            else:
+                stale.append((bucket, service))
+        self.conn.executemany("DELETE FROM stats WHERE bucket = ? AND service = ?", stale)
+        self.conn.commit()
+        return stats
+
+    def save(self, rows: Iterable[Tuple[Tuple[str, str], ServiceStats]]) -> None:
+        now = time.time()
+        self.conn.executemany(
+            "INSERT INTO stats (bucket, service, attempts, successes, seconds, updated) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(bucket, service) DO UPDATE SET attempts = excluded.attempts, "
+            "successes = excluded.successes, seconds = excluded.seconds, updated = excluded.updated",
+            [(bucket, service, s.attempts, s.successes, s.seconds, now) for (bucket, service), s in rows],
+        )
+        self.conn.commit()
+
+
+class ServiceRanker:
+    # Learns per-service success rate and latency as tracks download and orders the services
+    # for the next track by expected time to a successful download. Without enough history
+    # (or in strict mode) the configured order is kept. With a `store`, the history carries
+    # over between runs.
+    def __init__(self, strict: bool = False, store: Optional[StatsStore] = None):
+        self.strict = strict
+        self.store = store
+        self.stats: Dict[Tuple[str, str], ServiceStats] = {}
+        self.lock = threading.Lock()
+        if store:
+            try:
+                self.stats = store.load()
+            except sqlite3.Error as e:
+                print(f"Warning: could not load service ranking history ({e})")
+
+    def record(self, track, service: str, ok: bool, seconds: float) -> None:
+        with self.lock:
+            rows = []
+            for key in buckets(track):
+                stats = self.stats.setdefault((key, service), ServiceStats())
+                stats.add(ok, seconds)
+                rows.append(((key, service), stats))
+            if self.store:
+                try:
+                    self.store.save(rows)
+                except sqlite3.Error as e:
+                    print(f"Warning: could not save service ranking history ({e})")
+
+    def _stats_for(self, keys: List[str], service: str) -> ServiceStats:
+        for key in keys:
+            stats = self.stats.get((key, service))
+            if stats and stats.attempts >= MIN_SAMPLES:
+                return stats
+        return ServiceStats()
+
+    def order(self, track, services: List[str]) -> List[str]:
+        if self.strict or len(services) < 2:
+            return list(services)
+        keys = buckets(track)
+        with self.lock:
+            costs = {svc: self._stats_for(keys, svc).expected_cost for svc in services}
+        # Stable: services without history keep their configured order among themselves
+        return sorted(services, key=lambda svc: costs[svc])
+
+    def summary(self) -> Dict[str, Dict]:
+        with self.lock:
+            return {
+                service: {
+                    "attempts": round(s.attempts, 1),
+                    "successes": round(s.successes, 1),
+                    "mean_seconds": round(s.seconds / s.attempts, 2) if s.attempts else None,
+                }
+                for (key, service), s in self.stats.items() if key == "all"
+            }
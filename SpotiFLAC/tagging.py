@@ -0,0 +1,124 @@
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from mutagen.flac import FLAC, Picture
+from mutagen.id3 import PictureType
+from mutagen.mp4 import MP4, MP4Cover
+
+# Padding reserved whenever the tags no longer fit, so a later retag (bigger cover, more
+# fields) still fits in place instead of moving the whole audio stream
+TAG_PADDING = 128 * 1024
+
+# Vorbis comment names -> MP4 atoms; anything else goes into an iTunes freeform atom
+MP4_ATOMS = {
+    "TITLE": "\xa9nam", "ARTIST": "\xa9ART", "ALBUM": "\xa9alb", "ALBUMARTIST": "aART",
+    "DATE": "\xa9day", "COPYRIGHT": "cprt", "GENRE": "\xa9gen", "COMMENT": "\xa9cmt",
+}
+
+
+@dataclass
+class TagStats:
+    bytes: int = 0
+    seconds: float = 0.0
+    in_place: bool = True
+
+    def __str__(self) -> str:
+        where = "in place" if self.in_place else "file rewritten"
+        return f"{self.bytes / 1024:.1f} KB written in {self.seconds * 1000:.0f} ms ({where})"
+
+
+def _image_mime(data: bytes) -> str:
+    return "image/png" if data[:8] == b"\x89PNG\r\n\x1a\n" else "image/jpeg"
+
+
+class _Padding:
+    # mutagen padding callback: keep the current padding when the new tags fit in it, else
+    # reserve TAG_PADDING. Remembers what it saw so the caller can tell what was rewritten.
+    def __init__(self):
+        self.info = None
+        self.moved = False
+
+    def __call__(self, info) -> int:
+        self.info = info
+        if 0 <= info.padding:
+            return info.padding
+        self.moved = True
+        return TAG_PADDING
+
+
+def _flac(path: str, tags: Dict[str, str], cover: Optional[bytes], replace: bool):
+    audio = FLAC(path)
+    # Everything is changed in memory; one save() below writes it all
+    if replace:
+        audio.clear()
+        audio.clear_pictures()
+    for key, value in tags.items():
+        if value not in (None, ""):
+            audio[key] = str(value)
+    if cover:
+        pic = Picture()
+        pic.data = cover
+        pic.type = PictureType.COVER_FRONT
+        pic.mime = _image_mime(cover)
+        pic.desc = "Cover"
+        audio.add_picture(pic)
+    return audio
+
+
+def _number_pair(tags: Dict[str, str], number: str, total: str):
+    def to_int(v):
+        try:
+            return int(str(v).split("/")[0])
+        except (TypeError, ValueError):
+            return 0
+    return [(to_int(tags.get(number)), to_int(tags.get(total)))]
+
+
+def _mp4(path: str, tags: Dict[str, str], cover: Optional[bytes], replace: bool):
+    audio = MP4(path)
+    if audio.tags is None:
+        audio.add_tags()
+    if replace:
+        audio.tags.clear()
+    for key, value in tags.items():
+        if value in (None, "") or key in ("TRACKNUMBER", "TRACKTOTAL", "DISCNUMBER", "DISCTOTAL"):
+            continue
+        atom = MP4_ATOMS.get(key)
+        if atom:
+            audio.tags[atom] = [str(value)]
+        else:
+            audio.tags[f"----:com.apple.iTunes:{key}"] = [str(value).encode("utf-8")]
+    if tags.get("TRACKNUMBER"):
+        audio.tags["trkn"] = _number_pair(tags, "TRACKNUMBER", "TRACKTOTAL")
+    if tags.get("DISCNUMBER"):
+        audio.tags["disk"] = _number_pair(tags, "DISCNUMBER", "DISCTOTAL")
+    if cover:
+        fmt = MP4Cover.FORMAT_PNG if _image_mime(cover) == "image/png" else MP4Cover.FORMAT_JPEG
+        audio.tags["covr"] = [MP4Cover(cover, imageformat=fmt)]
+    return audio
+
+
+def write_tags(path: str, tags: Dict[str, str], cover: Optional[bytes] = None, quiet: bool = False,
+               replace: bool = True) -> TagStats:
+    # Replaces all tags of a FLAC or M4A file with `tags` (Vorbis comment names) and the cover
+    # image bytes in a single save. replace=False keeps the file's other tags and pictures and
+    # only overwrites the fields given.
+    start = time.perf_counter()
+    tag = _mp4 if path.lower().endswith((".m4a", ".mp4")) else _flac
+    audio = tag(path, tags, cover, replace)
+    padding = _Padding()
+    audio.save(padding=padding)
+
+    stats = TagStats(seconds=time.perf_counter() - start, in_place=not padding.moved)
+    if padding.info is not None:
+        # Tag area after the save, plus the audio behind it when that had to move
+        size = os.path.getsize(path)
+        stats.bytes = size - padding.info.size + (padding.info.size if padding.moved else 0)
+    else:
+        stats.bytes = os.path.getsize(path)
+        stats.in_place = False
+    if not quiet:
+        print(f"Tagged {os.path.basename(path)}: {stats}")
+    return stats
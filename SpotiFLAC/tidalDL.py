@@ -3,15 +3,19 @@ import concurrent.futures
 import json
 import os
 import re
-import subprocess
+import threading
 import time
 import xml.etree.ElementTree as ET
 from typing import Callable, Dict, List, Optional, Tuple
 from urllib.parse import quote, urlparse
 
-import requests
-from mutagen.flac import FLAC, Picture
-from mutagen.id3 import PictureType
+from mutagen.flac import FLAC
+
+from SpotiFLAC import tagging, transfer
+from SpotiFLAC.coverCache import COVERS
+from SpotiFLAC.deadline import DeadlineSession
+from SpotiFLAC.negativeCache import TrackUnavailable
+from SpotiFLAC.postProcess import INLINE
 
 
 def _contains_japanese(text: str) -> bool:
@@ -120,6 +124,14 @@ class TidalDownloader:
         self.progress_callback: Callable[[int, int], None] = ProgressCallback()
         self.client_id = base64.b64decode("NkJEU1JkcEs5aHFFQlRnVQ==").decode()
         self.client_secret = base64.b64decode("eGV1UG1ZN25icFo5SUliTEFjUTkzc2hrYTFWTmhlVUFxTjZJY3N6alRHOD0=").decode()
+        self.session = DeadlineSession(timeout)
+        self._token: Optional[str] = None
+        self._token_expires = 0.0
+        self._token_lock = threading.Lock()
+        # ffmpeg and tagging stage; the scheduler swaps in its shared PostProcessor
+        self.post = INLINE
+        # Album art shared across downloaders, so an album's cover is fetched once
+        self.covers = COVERS
 
         apis = self.get_available_apis()
         if api_url:
@@ -147,10 +159,21 @@ class TidalDownloader:
         ]
 
     def get_access_token(self) -> Optional[str]:
+        # Every search and track lookup needs a token; reuse it until shortly before it expires
+        with self._token_lock:
+            if self._token and time.time() < self._token_expires:
+                return self._token
+            token, expires_in = self._request_access_token()
+            if token:
+                self._token = token
+                self._token_expires = time.time() + expires_in - 60
+            return token
+
+    def _request_access_token(self) -> Tuple[Optional[str], int]:
         data = f"client_id={self.client_id}&grant_type=client_credentials"
         auth_url = base64.b64decode("aHR0cHM6Ly9hdXRoLnRpZGFsLmNvbS92MS9vYXV0aDIvdG9rZW4=").decode()
         try:
-            resp = requests.post(
+            resp = self.session.post(
                 auth_url,
                 data=data,
                 auth=(self.client_id, self.client_secret),
@@ -158,10 +181,11 @@ class TidalDownloader:
                 timeout=self.timeout,
             )
             if resp.status_code != 200:
-                return None
-            return resp.json().get("access_token")
+                return None, 0
+            body = resp.json()
+            return body.get("access_token"), int(body.get("expires_in") or 3600)
         except Exception:
-            return None
+            return None, 0
 
     def search_tracks_with_limit(self, query: str, limit: int = 50) -> Dict:
         token = self.get_access_token()
@@ -172,7 +196,7 @@ class TidalDownloader:
             "aHR0cHM6Ly9hcGkudGlkYWwuY29tL3YxL3NlYXJjaC90cmFja3M/cXVlcnk9"
         ).decode()
         search_url = f"{search_base}{quote(query)}&limit={limit}&offset=0&countryCode=US"
-        resp = requests.get(search_url, headers={"Authorization": f"Bearer {token}"}, timeout=self.timeout)
+        resp = self.session.get(search_url, headers={"Authorization": f"Bearer {token}"}, timeout=self.timeout)
         if resp.status_code != 200:
             raise Exception(f"search failed: HTTP {resp.status_code} - {resp.text}")
         return resp.json()
@@ -214,11 +238,57 @@ class TidalDownloader:
                 seen.add(q)
         return uniq
 
+    def _isrc_matches(self, items: List[Dict], isrc: str) -> Optional[Dict]:
+        matches = [t for t in items if (t.get("isrc") or "").upper() == isrc.upper()]
+        for track in matches:
+            if "HIRES_LOSSLESS" in ((track.get("mediaMetadata") or {}).get("tags") or []):
+                return track
+        return matches[0] if matches else None
+
+    def search_track_by_isrc(self, isrc: str) -> Optional[Dict]:
+        # One targeted request instead of several 100-item text searches: the tracks-by-ISRC
+        # filter, then a small search for the ISRC itself. None when neither finds it.
+        token = self.get_access_token()
+        if not token:
+            raise Exception("Failed to get access token")
+        track_base = base64.b64decode("aHR0cHM6Ly9hcGkudGlkYWwuY29tL3YxL3RyYWNrcy8=").decode().rstrip("/")
+        try:
+            resp = self.session.get(
+                f"{track_base}?isrc={quote(isrc)}&countryCode=US",
+                headers={"Authorization": f"Bearer {token}"},
+                timeout=self.timeout,
+            )
+            if resp.status_code == 200:
+                body = resp.json()
+                items = body.get("items", []) if isinstance(body, dict) else body
+                found = self._isrc_matches(items or [], isrc)
+                if found:
+                    print(f"✓ ISRC lookup: {found.get('artist', {}).get('name','?')} - {found.get('title','?')}")
+                    return found
+        except Exception as exc:
+            print(f"ISRC lookup error: {exc}")
+
+        try:
+            found = self._isrc_matches(self.search_tracks_with_limit(isrc, 10).get("items", []), isrc)
+            if found:
+                print(f"✓ ISRC search: {found.get('artist', {}).get('name','?')} - {found.get('title','?')}")
+                return found
+        except Exception as exc:
+            print(f"ISRC search error: {exc}")
+        return None
+
     def search_track_by_metadata_with_isrc(
         self, track_name: str, artist_name: str, spotify_isrc: str, expected_duration: int
     ) -> Dict:
+        if spotify_isrc:
+            found = self.search_track_by_isrc(spotify_isrc)
+            if found:
+                return found
+            print(f"No direct ISRC hit for {spotify_isrc}, falling back to text search")
+
         queries = self._collect_search_queries(track_name, artist_name)
         all_tracks: List[Dict] = []
+        errors: List[str] = []
         for query in queries:
             print(f"Searching Tidal for: {query}")
             try:
@@ -229,9 +299,14 @@ class TidalDownloader:
                     all_tracks.extend(items)
             except Exception as exc:
                 print(f"Search error for '{query}': {exc}")
+                errors.append(str(exc))
 
+        # Only a search that fully went through shows the track isn't there
+        missing = Exception if errors else TrackUnavailable
         if not all_tracks:
-            raise Exception("no tracks found for any search query")
+            if errors:
+                raise Exception(f"search failed: {errors[0]}")
+            raise TrackUnavailable("no tracks found for any search query")
 
         if spotify_isrc:
             print(f"Looking for ISRC match: {spotify_isrc}")
@@ -242,7 +317,7 @@ class TidalDownloader:
                         f"{track.get('title','?')} (ISRC: {spotify_isrc})"
                     )
                     return track
-            raise Exception(f"ISRC mismatch: no track found with ISRC {spotify_isrc} on Tidal")
+            raise missing(f"ISRC mismatch: no track found with ISRC {spotify_isrc} on Tidal")
 
         best_match: Optional[Dict] = None
         if expected_duration:
@@ -274,7 +349,7 @@ class TidalDownloader:
         spotify_url = f"{spotify_base}{spotify_track_id}"
         api_base = base64.b64decode("aHR0cHM6Ly9hcGkuc29uZy5saW5rL3YxLWFscGhhLjEvbGlua3M/dXJsPQ==").decode()
         api_url = f"{api_base}{quote(spotify_url)}"
-        resp = requests.get(api_url, timeout=self.timeout)
+        resp = self.session.get(api_url, timeout=self.timeout)
         resp.raise_for_status()
         data = resp.json()
         tidal_link = data.get("linksByPlatform", {}).get("tidal", {}).get("url")
@@ -300,16 +375,35 @@ class TidalDownloader:
             raise Exception("failed to get access token")
         track_base = base64.b64decode("aHR0cHM6Ly9hcGkudGlkYWwuY29tL3YxL3RyYWNrcy8=").decode()
         track_url = f"{track_base}{track_id}?countryCode=US"
-        resp = requests.get(track_url, headers={"Authorization": f"Bearer {token}"}, timeout=self.timeout)
+        resp = self.session.get(track_url, headers={"Authorization": f"Bearer {token}"}, timeout=self.timeout)
         if resp.status_code != 200:
             raise Exception(f"failed to get track info: HTTP {resp.status_code} - {resp.text}")
         info = resp.json()
         print(f"Found: {info.get('title','?')} ({info.get('audioQuality','?')})")
         return info
 
+    def get_album_tracks(self, album_id: int) -> List[Dict]:
+        token = self.get_access_token()
+        if not token:
+            raise Exception("failed to get access token")
+        album_base = base64.b64decode("aHR0cHM6Ly9hcGkudGlkYWwuY29tL3YxL2FsYnVtcy8=").decode()
+        tracks: List[Dict] = []
+        while True:
+            url = f"{album_base}{album_id}/tracks?countryCode=US&limit=100&offset={len(tracks)}"
+            resp = self.session.get(url, headers={"Authorization": f"Bearer {token}"}, timeout=self.timeout)
+            if resp.status_code != 200:
+                raise Exception(f"failed to get album tracks: HTTP {resp.status_code} - {resp.text}")
+            page = resp.json()
+            items = page.get("items") or []
+            tracks.extend(items)
+            if not items or len(tracks) >= (page.get("totalNumberOfItems") or 0):
+                break
+        print(f"Found {len(tracks)} tracks on Tidal album {album_id}")
+        return tracks
+
     def _request_download_url(self, api_url: str, track_id: int, quality: str) -> Optional[str]:
         url = f"{api_url}/track/?id={track_id}&quality={quality}"
-        resp = requests.get(url, timeout=self.timeout)
+        resp = self.session.get(url, timeout=self.timeout)
         if resp.status_code != 200:
             return None
         body = resp.text
@@ -358,26 +452,22 @@ class TidalDownloader:
         raise Exception(f"all {len(apis)} APIs failed. Errors: {errors[:3]}")
 
     @staticmethod
-    def download_album_art(album_id: str, size: str = "1280x1280") -> Optional[bytes]:
-        art_url = f"https://resources.tidal.com/images/{album_id.replace('-', '/')}/{size}.jpg"
-        resp = requests.get(art_url, timeout=15)
-        if resp.status_code != 200:
-            return None
-        return resp.content
-
-    def _stream_download(self, url: str, file_obj, show_progress: bool = True) -> None:
-        with requests.get(url, stream=True, timeout=120) as resp:
-            resp.raise_for_status()
-            total = int(resp.headers.get("Content-Length") or 0)
-            downloaded = 0
-            chunk_size = 256 * 1024
-            for chunk in resp.iter_content(chunk_size=chunk_size):
-                if not chunk:
-                    continue
-                file_obj.write(chunk)
-                downloaded += len(chunk)
-                if show_progress and self.progress_callback:
-                    self.progress_callback(downloaded, total)
+    def album_art_url(album_id: str, size: str = "1280x1280") -> str:
+        if not album_id:
+            return ""
+        return f"https://resources.tidal.com/images/{album_id.replace('-', '/')}/{size}.jpg"
+
+    def download_album_art(self, album_id: str, size: str = "1280x1280") -> Optional[bytes]:
+        return self.covers.get(self.album_art_url(album_id, size))
+
+    def prefetch_album_art(self, album_id: str, size: str = "1280x1280") -> concurrent.futures.Future:
+        return self.covers.prefetch(self.album_art_url(album_id, size))
+
+    def _stream_download(self, url: str, file_obj, show_progress: bool = True, buf=None) -> int:
+        with transfer.open_stream(self.session, url) as resp:
+            total = transfer.content_length(resp)
+            progress = self.progress_callback if show_progress else None
+            return transfer.write_chunks(transfer.iter_chunks(resp, buf=buf), file_obj, total, progress)
 
     def download_file(self, url: str, filepath: str) -> None:
         if url.startswith("MANIFEST:"):
@@ -385,19 +475,8 @@ class TidalDownloader:
             self.download_from_manifest(manifest, filepath)
             return
 
-        os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
-        temp_path = filepath + ".part"
-        try:
-            with open(temp_path, "wb") as f:
-                self._stream_download(url, f)
-            os.replace(temp_path, filepath)
-            print("\nDownload complete")
-        finally:
-            if os.path.exists(temp_path):
-                try:
-                    os.remove(temp_path)
-                except Exception:
-                    pass
+        stats = transfer.download(self.session, url, filepath, self.progress_callback)
+        print(f"\nDownload complete: {stats}")
 
     def download_from_manifest(self, manifest_b64: str, output_path: str) -> None:
         direct_url, init_url, media_urls = parse_manifest(manifest_b64)
@@ -405,22 +484,23 @@ class TidalDownloader:
 
         if direct_url:
             print("Downloading file...")
-            with open(output_path, "wb") as f:
-                self._stream_download(direct_url, f)
-            print("\nDownload complete")
+            stats = transfer.download(self.session, direct_url, output_path, self.progress_callback)
+            print(f"\nDownload complete: {stats}")
             return
 
         temp_path = output_path + ".m4a.tmp"
+        buf = bytearray(transfer.BUFFER_SIZE)
+        start = time.perf_counter()
         with open(temp_path, "wb") as f:
             print("Downloading init segment...")
-            self._stream_download(init_url, f, show_progress=False)
+            self._stream_download(init_url, f, show_progress=False, buf=buf)
 
             total_bytes = 0
             last_time = time.time()
             last_bytes = 0
             total_segments = len(media_urls)
             for idx, media_url in enumerate(media_urls, start=1):
-                self._stream_download(media_url, f, show_progress=False)
+                self._stream_download(media_url, f, show_progress=False, buf=buf)
                 total_bytes = f.tell()
                 now = time.time()
                 if now - last_time > 0.1:
@@ -432,11 +512,12 @@ class TidalDownloader:
                 print(f"\rDownloading: {total_bytes / (1024 * 1024):.2f} MB ({idx}/{total_segments})", end="")
 
         print()
+        print(f"Downloaded {transfer.TransferStats(os.path.getsize(temp_path), time.perf_counter() - start)}")
         print("Converting to FLAC...")
         cmd = ["ffmpeg", "-y", "-i", temp_path, "-vn", "-c:a", "flac", output_path]
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        result = self.post.ffmpeg(cmd)
         if result.returncode != 0:
-            raise Exception(f"ffmpeg conversion failed: {result.stderr}")
+            raise Exception(f"ffmpeg conversion failed: {result.stderr.decode(errors='replace')}")
         try:
             os.remove(temp_path)
         except Exception:
@@ -445,37 +526,17 @@ class TidalDownloader:
 
     def embed_metadata(self, filepath: str, metadata: Dict, search_info: Optional[Dict] = None) -> bool:
         try:
-            audio = FLAC(filepath)
-            audio.clear()
-            audio.clear_pictures()
-
-            if metadata.get("Title"):
-                audio["TITLE"] = metadata["Title"]
-            if metadata.get("Artist"):
-                audio["ARTIST"] = metadata["Artist"]
-                audio["ALBUMARTIST"] = metadata["Artist"]
-            if metadata.get("Album"):
-                audio["ALBUM"] = metadata["Album"]
-            if metadata.get("Date"):
-                audio["DATE"] = metadata["Date"]
-            if metadata.get("TrackNumber"):
-                audio["TRACKNUMBER"] = str(metadata["TrackNumber"])
-            if metadata.get("DiscNumber"):
-                audio["DISCNUMBER"] = str(metadata["DiscNumber"])
-            if metadata.get("ISRC"):
-                audio["ISRC"] = metadata["ISRC"]
-
-            cover = metadata.get("CoverPath")
-            if cover and os.path.exists(cover):
-                with open(cover, "rb") as img:
-                    picture = Picture()
-                    picture.data = img.read()
-                    picture.type = PictureType.COVER_FRONT
-                    picture.mime = "image/jpeg"
-                    picture.desc = "Cover"
-                    audio.add_picture(picture)
-
-            audio.save()
+            tags = {
+                "TITLE": metadata.get("Title"),
+                "ARTIST": metadata.get("Artist"),
+                "ALBUMARTIST": metadata.get("Artist"),
+                "ALBUM": metadata.get("Album"),
+                "DATE": metadata.get("Date"),
+                "TRACKNUMBER": metadata.get("TrackNumber") or None,
+                "DISCNUMBER": metadata.get("DiscNumber") or None,
+                "ISRC": metadata.get("ISRC"),
+            }
+            tagging.write_tags(filepath, tags, metadata.get("Cover"))
             return True
         except Exception as exc:
             print(f"Error embedding metadata: {exc}")
@@ -494,13 +555,22 @@ class TidalDownloader:
         include_track_number: bool = False,
         position: int = 0,
         use_album_track_number: bool = False,
+        track_info: Optional[Dict] = None,
+        track_id: Optional[int] = None,
+        download_url: Optional[str] = None,
     ):
         os.makedirs(output_dir, exist_ok=True)
 
-        try:
-            track_info = self.search_track_by_metadata_with_isrc(query, "", isrc or "", 0)
-        except Exception as exc:
-            raise Exception(f"Error getting track info: {exc}")
+        # A caller that already resolved the track passes its info, or just its id (one lookup
+        # instead of the multi-query search)
+        if track_info is None:
+            try:
+                if track_id:
+                    track_info = self.get_track_info_by_id(track_id)
+                else:
+                    track_info = self.search_track_by_metadata_with_isrc(query, "", isrc or "", 0)
+            except Exception as exc:
+                raise Exception(f"Error getting track info: {exc}")
 
         track_id = track_info.get("id")
         if not track_id:
@@ -535,23 +605,23 @@ class TidalDownloader:
             print(f"File with ISRC exists: {existing}")
             return existing
 
-        if auto_fallback and self.api_list:
-            api, download_url = self._get_download_url_parallel(self.api_list, track_id, quality)
-            downloader = TidalDownloader(api_url=api)
-            downloader.set_progress_callback(self.progress_callback)
-            downloader.download_file(download_url, output_filename)
+        # Album art downloads alongside the audio and is joined before tagging
+        album_cover = track_info.get("album", {}).get("cover")
+        cover = self.prefetch_album_art(album_cover)
+
+        if download_url:
+            # Prefetched by the caller while the previous track was transferring
+            self.download_file(download_url, output_filename)
+        elif auto_fallback and self.api_list:
+            # The URL comes from whichever API answered; the transfer itself goes through this
+            # downloader's session. self.api_url stays as is, since jobs share this downloader.
+            _, download_url = self._get_download_url_parallel(self.api_list, track_id, quality)
+            self.download_file(download_url, output_filename)
         else:
             download_url = self.get_download_url(track_id, quality)
             self.download_file(download_url, output_filename)
 
-        cover_path = ""
-        album_cover = track_info.get("album", {}).get("cover")
-        if album_cover:
-            cover_bytes = self.download_album_art(album_cover)
-            if cover_bytes:
-                cover_path = output_filename + ".cover.jpg"
-                with open(cover_path, "wb") as f:
-                    f.write(cover_bytes)
+        cover_bytes = cover.result()
 
         metadata = {
             "Title": track_title,
@@ -561,14 +631,9 @@ class TidalDownloader:
             "TrackNumber": track_info.get("trackNumber", 0),
             "DiscNumber": track_info.get("volumeNumber", 0),
             "ISRC": track_info.get("isrc", ""),
-            "CoverPath": cover_path,
+            "Cover": cover_bytes,
         }
-        self.embed_metadata(output_filename, metadata, track_info)
-        if cover_path and os.path.exists(cover_path):
-            try:
-                os.remove(cover_path)
-            except Exception:
-                pass
+        self.post.run(self.embed_metadata, output_filename, metadata, track_info)
         print("Done")
         return output_filename
 
@@ -0,0 +1,153 @@
+import threading
+from typing import Dict, Iterable, Iterator, Optional
+
+
+def _artist_names(artists) -> str:
+    if isinstance(artists, list):
+        names = [(a.get("name") or "Unknown Artist") if isinstance(a, dict) else str(a) for a in artists]
+        return ", ".join(names) if names else "Unknown Artist"
+    return str(artists) if artists else "Unknown Artist"
+
+
+def _first_image(images) -> str:
+    if isinstance(images, str):
+        return images
+    if isinstance(images, list) and images:
+        first = images[0]
+        if isinstance(first, dict):
+            return first.get("url", "")
+        if isinstance(first, str):
+            return first
+    return ""
+
+
+def _track_id(item: Dict) -> str:
+    track_id = item.get("id")
+    if not track_id and "external_urls" in item:
+        ext = item["external_urls"]
+        if isinstance(ext, dict): track_id = ext.get("spotify", "").split("/")[-1]
+        elif isinstance(ext, str): track_id = ext.split("/")[-1]
+    return track_id or ""
+
+
+class Track:
+    # A 10k-item playlist keeps 10k of these alive, so no per-instance __dict__.
+    __slots__ = (
+        "external_urls", "title", "artists", "album", "album_artist", "track_number",
+        "duration_ms", "id", "isrc", "release_date", "cover_url", "downloaded",
+    )
+
+    def __init__(self, external_urls: str, title: str, artists: str, album: str, album_artist: str,
+                 track_number: int, duration_ms: int, id: str, isrc: str = "", release_date: str = "",
+                 cover_url: str = "", downloaded: bool = False):
+        self.external_urls = external_urls
+        self.title = title
+        self.artists = artists
+        self.album = album
+        self.album_artist = album_artist
+        self.track_number = track_number
+        self.duration_ms = duration_ms
+        self.id = id
+        self.isrc = isrc
+        self.release_date = release_date
+        self.cover_url = cover_url
+        self.downloaded = downloaded
+
+    def __repr__(self) -> str:
+        return f"Track(id={self.id!r}, title={self.title!r}, artists={self.artists!r}, isrc={self.isrc!r})"
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Track):
+            return NotImplemented
+        return all(getattr(self, s) == getattr(other, s) for s in self.__slots__)
+
+    __hash__ = None
+
+    def to_dict(self) -> Dict:
+        return {s: getattr(self, s) for s in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Track":
+        return cls(**{s: data[s] for s in cls.__slots__ if s in data})
+
+    @classmethod
+    def from_api(cls, item: Dict, album: Optional[Dict] = None, fallback_cover: str = "",
+                 position: int = 0) -> Optional["Track"]:
+        # Accepts a full track object, a simplified album track (pass the album) or a playlist item.
+        track = item.get("track", item)
+        if track is True:
+            # Track objects nested in playlist items carry "track": true themselves.
+            track = item
+        if not track or not isinstance(track, dict):
+            return None
+
+        track_id = _track_id(track)
+        if not track_id:
+            return None
+
+        alb = album if album is not None else (track.get("album") or {})
+        artist_names = _artist_names(track.get("artists", []))
+        album_artist = _artist_names(alb.get("artists")) if alb.get("artists") else artist_names
+
+        return cls(
+            external_urls=f"https://open.spotify.com/track/{track_id}",
+            title=track.get("name", "Unknown Title"),
+            artists=artist_names,
+            album=alb.get("name") or track.get("album_name", "Unknown Album"),
+            album_artist=album_artist,
+            track_number=track.get("track_number") or position,
+            duration_ms=track.get("duration_ms", 0),
+            id=track_id,
+            isrc=(track.get("external_ids") or {}).get("isrc", "") or track.get("isrc", ""),
+            release_date=alb.get("release_date", "") or track.get("release_date", ""),
+            cover_url=_first_image(alb.get("images")) or _first_image(track.get("images")) or fallback_cover,
+        )
+
+
+class TrackStore:
+    # Tracks that are queued or downloading, by Spotify ID, so jobs listing the same track share
+    # one object. A finished track is dropped, so memory follows the tracks in flight rather than
+    # every track a batch has listed.
+    __slots__ = ("_tracks", "_lock")
+
+    def __init__(self, tracks: Iterable[Track] = ()):
+        self._tracks: Dict[str, Track] = {}
+        # Filled by the job threads, emptied by the download threads
+        self._lock = threading.Lock()
+        for track in tracks:
+            self.add(track)
+
+    def add(self, track: Track) -> bool:
+        if not track:
+            return False
+        with self._lock:
+            if track.id in self._tracks:
+                return False
+            self._tracks[track.id] = track
+            return True
+
+    def setdefault(self, track: Track) -> Track:
+        # Returns the stored track with this id, adding `track` if there is none yet
+        with self._lock:
+            return self._tracks.setdefault(track.id, track)
+
+    def finish(self, track: Track) -> None:
+        with self._lock:
+            if self._tracks.get(track.id) is track:
+                del self._tracks[track.id]
+
+    def get(self, track_id: str) -> Optional[Track]:
+        return self._tracks.get(track_id)
+
+    def __contains__(self, track_id) -> bool:
+        return track_id in self._tracks
+
+    def __len__(self) -> int:
+        return len(self._tracks)
+
+    def __iter__(self) -> Iterator[Track]:
+        with self._lock:
+            return iter(list(self._tracks.values()))
+
+    def __bool__(self) -> bool:
+        return bool(self._tracks)
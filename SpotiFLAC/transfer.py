@@ -0,0 +1,475 @@
+import http.client
+import json
+import os
+import re
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Iterator, Optional, Tuple
+
+import requests
+import urllib3
+
+from SpotiFLAC import bandwidth, deadline
+from SpotiFLAC.bandwidth import UNLIMITED
+
+# Default read size for every backend; bigger buffers mean fewer syscalls and progress callbacks per MB
+BUFFER_SIZE = 256 * 1024
+# Minimum time between progress callbacks, so the console isn't redrawn for every buffer
+PROGRESS_INTERVAL = 0.1
+# A partial file's sidecar is refreshed this often, so even a hard kill loses at most this much
+CHECKPOINT_BYTES = 8 * 1024 * 1024
+# Times a dropped connection is resumed within one download() call
+RESUME_RETRIES = 3
+# Files at least this big are fetched as SEGMENTS parallel byte ranges, for mirrors that cap
+# throughput per connection
+SEGMENT_THRESHOLD = 24 * 1024 * 1024
+SEGMENTS = 4
+# A partial file nobody has written to for this long is not going to be resumed
+PART_TTL = 7 * 24 * 3600.0
+
+
+class TransferIncomplete(Exception):
+    pass
+
+
+class RangeNotSupported(Exception):
+    pass
+
+
+# Dropped or stalled connections, as raised by requests, urllib3 and (on the readinto path) http.client
+RESUMABLE_ERRORS = (
+    TransferIncomplete, requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+    urllib3.exceptions.ProtocolError, urllib3.exceptions.ReadTimeoutError, http.client.IncompleteRead,
+    ConnectionError, TimeoutError,
+)
+
+ProgressFn = Optional[Callable[[int, int], None]]
+
+
+@dataclass
+class TransferStats:
+    bytes: int = 0
+    seconds: float = 0.0
+
+    @property
+    def mb(self) -> float:
+        return self.bytes / (1024 * 1024)
+
+    @property
+    def speed(self) -> float:
+        # MB/s
+        return self.mb / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self) -> str:
+        return f"{self.mb:.2f} MB in {self.seconds:.1f}s ({self.speed:.2f} MB/s)"
+
+
+def get_stream(session: requests.Session, url: str, timeout: float = 120, headers=None) -> requests.Response:
+    # Streaming GET holding one of its host's connection slots until the response is closed.
+    # The session's `bandwidth` (if any) sets the limits; the response carries it to iter_chunks.
+    limits = getattr(session, "bandwidth", None) or UNLIMITED
+    release = limits.connect(url)
+    try:
+        resp = session.get(url, stream=True, timeout=timeout, headers=headers)
+    except BaseException:
+        release()
+        raise
+    close = resp.close
+
+    def close_and_release():
+        try:
+            close()
+        finally:
+            release()
+    resp.close = close_and_release
+    resp.bandwidth = limits
+    return resp
+
+
+def open_stream(session: requests.Session, url: str, timeout: float = 120, headers=None) -> requests.Response:
+    resp = get_stream(session, url, timeout, headers)
+    try:
+        resp.raise_for_status()
+    except BaseException:
+        resp.close()
+        raise
+    return resp
+
+
+def content_length(resp: requests.Response) -> int:
+    # Size of the decoded body, or 0 when unknown (a compressed body's length says nothing about it)
+    if (resp.headers.get("Content-Encoding") or "identity").lower() != "identity":
+        return 0
+    try:
+        return int(resp.headers.get("Content-Length") or 0)
+    except ValueError:
+        return 0
+
+
+def abort(resp: requests.Response) -> None:
+    # Wakes a read blocked on the response's connection by shutting its socket down
+    raw = resp.raw
+    conn = getattr(raw, "_connection", None) or getattr(raw, "connection", None)
+    sock = getattr(conn, "sock", None)
+    if sock is None:
+        # Connection already detached (server said it closes): the body's file still holds it
+        sock = getattr(getattr(getattr(getattr(raw, "_fp", None), "fp", None), "raw", None), "_sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def iter_chunks(resp: requests.Response, buffer_size: int = BUFFER_SIZE,
+                buf: Optional[bytearray] = None, limit: Optional[int] = None) -> Iterator[memoryview]:
+    # Reads the body into one reused buffer and yields views of it; each view is only valid
+    # until the next one is requested, so consumers must write or copy it right away.
+    # Pass `buf` to share one buffer across many small bodies (e.g. DASH segments), and
+    # `limit` to stop after that many bytes. The current track deadline is checked, and the
+    # bandwidth limits applied, per chunk.
+    raw = resp.raw
+    limits = getattr(resp, "bandwidth", UNLIMITED)
+    encoding = (resp.headers.get("Content-Encoding") or "identity").lower()
+    fp = getattr(raw, "_fp", None)
+    if encoding != "identity" or not hasattr(raw, "release_conn"):
+        # Compressed bodies have to go through urllib3's decoder
+        for chunk in resp.iter_content(chunk_size=buffer_size):
+            deadline.check()
+            if chunk:
+                if limit is not None:
+                    chunk = chunk[:limit]
+                    limit -= len(chunk)
+                limits.consume(len(chunk))
+                yield memoryview(chunk)
+                if limit == 0:
+                    return
+        return
+
+    view = memoryview(buf if buf is not None else bytearray(buffer_size))
+    # http.client's readinto fills our buffer directly; urllib3's own readinto allocates per read
+    direct = fp is not None and hasattr(fp, "readinto")
+    readinto = fp.readinto if direct else raw.readinto
+    # A trickling server never trips the socket timeout and keeps one readinto filling for
+    # as long as it likes, so the deadline also shuts the socket down underneath it
+    with deadline.cancel_on_expiry(lambda: abort(resp)):
+        while True:
+            deadline.check()
+            if limit is not None:
+                if limit <= 0:
+                    # Stopped mid-body: the connection is dropped with the response instead of reused
+                    return
+                n = readinto(view[:limit])
+                limit -= n
+            else:
+                n = readinto(view)
+            if not n:
+                break
+            limits.consume(n)
+            yield view[:n]
+    # An aborted read ends like a short body; report it as the timeout it is
+    deadline.check()
+    if direct:
+        # Body fully read behind urllib3's back: hand the keep-alive connection back to the pool
+        raw.release_conn()
+
+
+def write_chunks(chunks, f, total: int = 0, progress: ProgressFn = None, done: int = 0,
+                 checkpoint: Optional[Callable[[int], None]] = None) -> int:
+    # Writes chunks to an open file, reporting (bytes so far, total); returns the byte count.
+    # `checkpoint(done)` is called every CHECKPOINT_BYTES, after the data so far is flushed.
+    last = 0.0
+    last_checkpoint = done
+    for chunk in chunks:
+        f.write(chunk)
+        done += len(chunk)
+        if progress:
+            now = time.monotonic()
+            if now - last >= PROGRESS_INTERVAL or done == total:
+                last = now
+                progress(done, total)
+        if checkpoint and done - last_checkpoint >= CHECKPOINT_BYTES:
+            f.flush()
+            checkpoint(done)
+            last_checkpoint = done
+    return done
+
+
+def preallocate(f, size: int) -> None:
+    # Reserve the whole file up front so the filesystem can lay it out in one piece
+    if size <= 0:
+        return
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except (AttributeError, OSError):
+        pass
+
+
+class PartialFile:
+    # <path>.part plus a <path>.part.json sidecar recording where the bytes came from
+    # (url, ETag/Last-Modified, full length) and how many of them are on disk.
+    def __init__(self, path: str):
+        self.part = path + ".part"
+        self.sidecar = self.part + ".json"
+
+    def load(self) -> Optional[dict]:
+        if not os.path.exists(self.part) or not os.path.exists(self.sidecar):
+            return None
+        try:
+            with open(self.sidecar, encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if state.get("done", 0) <= 0 or state["done"] > os.path.getsize(self.part):
+            return None
+        return state
+
+    def save(self, state: dict) -> None:
+        tmp = self.sidecar + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.sidecar)
+
+    def discard(self) -> None:
+        for p in (self.part, self.sidecar):
+            if os.path.exists(p):
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+
+
+def discard_partials(directory: str, marker: str = "", ttl: float = PART_TTL) -> None:
+    # Removes partial files that will never be resumed from a folder: those whose name contains
+    # `marker` (a finished track's id, whichever service left them) and any untouched for `ttl`
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    cutoff = time.time() - ttl
+    for name in names:
+        if not name.endswith((".part", ".part.json", ".part.json.tmp")):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if (marker and marker in name) or os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _range_headers(headers, url: str, state: Optional[dict]) -> Tuple[dict, int]:
+    # Range request continuing `state`, guarded by If-Range so a changed file comes back whole
+    headers = dict(headers or {})
+    if not state:
+        return headers, 0
+    validator = state.get("etag") or state.get("last_modified")
+    if validator:
+        headers["If-Range"] = validator
+    elif state.get("url") != url:
+        # Signed URLs change between runs; without a validator there is no proof it's the same file
+        return headers, 0
+    headers["Range"] = f"bytes={state['done']}-"
+    return headers, state["done"]
+
+
+def _resumed_total(resp: requests.Response, offset: int, state: dict) -> Optional[int]:
+    # Full length if resp really continues the partial file at offset, else None
+    match = re.match(r"bytes (\d+)-\d+/(\d+|\*)", resp.headers.get("Content-Range", ""))
+    if not match or int(match.group(1)) != offset:
+        return None
+    total = int(match.group(2)) if match.group(2) != "*" else 0
+    if state.get("length") and total and total != state["length"]:
+        return None
+    return total or state.get("length", 0)
+
+
+def download(session: requests.Session, url: str, path: str, progress: ProgressFn = None,
+             buffer_size: int = BUFFER_SIZE, timeout: float = 120, headers=None,
+             retries: int = RESUME_RETRIES, segments: int = SEGMENTS) -> TransferStats:
+    # Streams url into path.part and renames it over path only once the body is complete.
+    # A failed transfer keeps its .part and sidecar; the next attempt, in this call or a later
+    # run, continues it with a Range request and starts over only if the server can't resume.
+    # Large files on servers that honour ranges are split over `segments` connections.
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    partial = PartialFile(path)
+    stats = TransferStats()
+    start = time.perf_counter()
+    attempt = 0
+    while True:
+        try:
+            _transfer(session, url, partial, partial.load(), progress, buffer_size, timeout, headers, stats, segments)
+            break
+        except RESUMABLE_ERRORS as e:
+            state = partial.load()
+            if attempt >= retries or not state:
+                raise
+            attempt += 1
+            print(f"\nConnection lost at {state['done'] / (1024 * 1024):.2f} MB ({e}), resuming...")
+    os.replace(partial.part, path)
+    partial.discard()
+    stats.seconds = time.perf_counter() - start
+    return stats
+
+
+def _transfer(session, url, partial, state, progress, buffer_size, timeout, headers, stats, segments) -> None:
+    req_headers, offset = _range_headers(headers, url, state)
+    if segments > 1 and "Range" not in req_headers:
+        # Asking for the whole file as a range tells us from the first response whether it can be split
+        req_headers["Range"] = "bytes=0-"
+    with get_stream(session, url, timeout, req_headers) as resp:
+        if offset and resp.status_code == 416 and state.get("length") == offset:
+            # Everything was already on disk, only the rename was missing
+            return
+        resp.raise_for_status()
+        total = _resumed_total(resp, offset, state or {}) if resp.status_code == 206 else None
+        if total is None:
+            if resp.status_code == 206:
+                # A range of something else: ask again for the whole file, as one plain request
+                resp.close()
+                return _transfer(session, url, partial, None, progress, buffer_size, timeout, headers, stats, 1)
+            # Range ignored (200) or validator changed: this response carries the full body
+            offset = 0
+            total = content_length(resp)
+        elif offset:
+            print(f"Resuming download at {offset / (1024 * 1024):.2f} MB")
+
+        meta = {"url": url, "etag": resp.headers.get("ETag", ""),
+                "last_modified": resp.headers.get("Last-Modified", ""), "length": total}
+        if offset:
+            # 206 responses don't always repeat the validators
+            meta["etag"] = meta["etag"] or state.get("etag", "")
+            meta["last_modified"] = meta["last_modified"] or state.get("last_modified", "")
+
+        if resp.status_code == 206 and segments > 1 and total - offset >= SEGMENT_THRESHOLD:
+            try:
+                return _segmented(session, url, resp, partial, meta, offset, total, progress,
+                                  buffer_size, timeout, headers, stats, segments)
+            except RangeNotSupported:
+                # Later ranges were refused: carry on from whatever prefix is complete, one stream
+                print("\nServer refused ranged requests, falling back to a single connection")
+                return _transfer(session, url, partial, partial.load(), progress, buffer_size, timeout,
+                                 headers, stats, 1)
+
+        with open(partial.part, "r+b" if offset else "wb") as f:
+            if offset:
+                f.seek(offset)
+            else:
+                preallocate(f, total)
+            try:
+                done = write_chunks(iter_chunks(resp, buffer_size), f, total, progress, offset,
+                                    checkpoint=lambda n: partial.save({**meta, "done": n}))
+                if total and done < total:
+                    raise TransferIncomplete(f"got {done} of {total} bytes")
+            except BaseException:
+                f.flush()
+                stats.bytes += f.tell() - offset
+                if f.tell():
+                    partial.save({**meta, "done": f.tell()})
+                raise
+            f.truncate(done)
+        stats.bytes += done - offset
+
+
+def _segmented(session, url, first, partial, meta, offset, total, progress, buffer_size, timeout,
+               headers, stats, segments) -> None:
+    # Splits [offset, total) into byte ranges fetched in parallel and written at their offsets.
+    # The first range is read from the response that's already open.
+    size = (total - offset + segments - 1) // segments
+    bounds = [(start, min(start + size, total)) for start in range(offset, total, size)]
+    got = [0] * len(bounds)
+    lock = threading.Lock()
+    stop = threading.Event()
+    last = {"progress": 0.0, "checkpoint": offset}
+
+    with open(partial.part, "r+b" if offset else "wb") as f:
+        if not offset:
+            preallocate(f, total)
+        if os.fstat(f.fileno()).st_size < total:
+            f.truncate(total)
+
+    def prefix() -> int:
+        # Bytes before the first gap; the only part a later single-stream resume may trust
+        done = offset
+        for (start, end), n in zip(bounds, got):
+            done = start + n
+            if done < end:
+                break
+        return done
+
+    def add(i: int, n: int) -> None:
+        with lock:
+            got[i] += n
+            done = offset + sum(got)
+            now = time.monotonic()
+            if progress and (now - last["progress"] >= PROGRESS_INTERVAL or done == total):
+                last["progress"] = now
+                progress(done, total)
+            if done - last["checkpoint"] >= CHECKPOINT_BYTES:
+                last["checkpoint"] = done
+                partial.save({**meta, "done": prefix()})
+
+    def fetch(i: int, resp=None) -> None:
+        start, end = bounds[i]
+        attempts = 0
+        while not stop.is_set() and start + got[i] < end:
+            pos = start + got[i]
+            try:
+                if resp is None:
+                    range_headers = dict(headers or {})
+                    range_headers["Range"] = f"bytes={pos}-{end - 1}"
+                    validator = meta.get("etag") or meta.get("last_modified")
+                    if validator:
+                        range_headers["If-Range"] = validator
+                    resp = get_stream(session, url, timeout, range_headers)
+                    if resp.status_code != 206 or _resumed_total(resp, pos, meta) is None:
+                        resp.close()
+                        resp.raise_for_status()
+                        raise RangeNotSupported()
+                with resp:
+                    # Unbuffered, so the prefix() recorded in a checkpoint is really in the file
+                    with open(partial.part, "r+b", buffering=0) as sf:
+                        sf.seek(pos)
+                        for chunk in iter_chunks(resp, buffer_size, limit=end - pos):
+                            if stop.is_set():
+                                return
+                            sf.write(chunk)
+                            add(i, len(chunk))
+                resp = None
+                if start + got[i] < end:
+                    raise TransferIncomplete(f"range {start}-{end - 1} ended early")
+            except RESUMABLE_ERRORS:
+                resp = None
+                attempts += 1
+                if attempts > RESUME_RETRIES:
+                    raise
+        if resp is not None:
+            # Stopped before reading it; its connection slot must not outlive this segment
+            resp.close()
+
+    print(f"Downloading in {len(bounds)} segments...")
+    with ThreadPoolExecutor(len(bounds) - 1 or 1, thread_name_prefix="segment") as pool:
+        futures = [pool.submit(bandwidth.bind(deadline.bind(fetch)), i) for i in range(1, len(bounds))]
+        errors = []
+        try:
+            fetch(0, first)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        for future in futures:
+            try:
+                future.result()
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+
+    stats.bytes += sum(got)
+    if errors:
+        partial.save({**meta, "done": prefix()})
+        for error in errors:
+            if isinstance(error, RangeNotSupported):
+                raise error
+        raise errors[0]
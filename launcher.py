@@ -13,16 +13,15 @@ else:
 sys.path.insert(0, application_path)
 
 def parse_args():
+    from SpotiFLAC.SpotiFLAC import add_download_arguments
+    from SpotiFLAC.daemon import add_daemon_arguments
+
     parser = argparse.ArgumentParser()
-    parser.add_argument("url", help="Spotify URL")
+    parser.add_argument("url", nargs="*", help="One or more Spotify URLs, or - to read them from stdin")
     parser.add_argument("output_dir", help="Output directory")
-    parser.add_argument(
-        "--service",
-        choices=["tidal", "deezer", "qobuz", "amazon"],
-        nargs="+",
-        default=["tidal","amazon"],
-        help="One or more services to try in order",
-    )
+    parser.add_argument("--urls-file", help="File with one Spotify URL per line (- for stdin)")
+    add_download_arguments(parser)
+    parser.set_defaults(service=["tidal","amazon"])
     parser.add_argument(
         "--filename-format",
         default="{title} - {artist}",
@@ -32,10 +31,22 @@ def parse_args():
     parser.add_argument("--use-artist-subfolders", action="store_true")
     parser.add_argument("--use-album-subfolders", action="store_true")
     parser.add_argument("--loop", type=int, help="Loop delay in minutes")
-    return parser.parse_args()
+    parser.add_argument("--retry-failed", action="store_true", help="Only retry the tracks that failed in the journaled run of each URL")
+    parser.add_argument("--worker", action="store_true", help="Share the work with other SpotiFLAC workers using the same output directory (e.g. on a shared filesystem); without URLs, work on the unfinished jobs already there")
+    parser.add_argument("--daemon", action="store_true", help="Stay up and take jobs over a local HTTP API instead of downloading URLs")
+    add_daemon_arguments(parser)
+    args = parser.parse_args()
+    if not args.url and not args.urls_file and not args.daemon and not args.worker:
+        parser.error("no Spotify URL given")
+    return args
 
 if __name__ == '__main__':
-    from SpotiFLAC.SpotiFLAC import SpotiFLAC
+    from SpotiFLAC.SpotiFLAC import SpotiFLAC, read_urls
 
     args = parse_args()
-    SpotiFLAC(args.url, args.output_dir, args.service, args.filename_format, args.use_track_numbers, args.use_artist_subfolders, args.use_album_subfolders, args.loop)
+    if args.daemon:
+        from SpotiFLAC.daemon import run_daemon
+        run_daemon(args)
+        sys.exit(0)
+    args.url = read_urls(args.url, args.urls_file)
+    SpotiFLAC(args.url, args.output_dir, args.service, args.filename_format, args.use_track_numbers, args.use_artist_subfolders, args.use_album_subfolders, args.loop, args.concurrency, args.retry_failed, args.amazon_stream_decrypt, args.store, args.link_mode, args.cache_dir, args.lookahead, args.strict_order, args.track_timeout, args.max_concurrency, args.rate_limit, dict(args.service_rate or []), args.max_host_connections, args.worker)
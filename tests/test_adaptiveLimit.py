@@ -0,0 +1,130 @@
+import threading
+
+import pytest
+import requests
+
+from SpotiFLAC import adaptiveLimit
+from SpotiFLAC.adaptiveLimit import AIMDLimit, LimitGroup, SlotTimeout, is_overload
+
+
+def fill(limit):
+    # Takes every slot of `limit`; the last permit is the one that saw it saturated
+    return [limit.acquire(0) for _ in range(int(limit.limit))]
+
+
+def test_limit_grows_by_one_after_a_round_of_saturated_successes():
+    limit = AIMDLimit(2, 4)
+    for permit in fill(limit):
+        limit.release(permit, True)
+    # Only the permit that took the last slot counts; one success per slot is needed
+    assert limit.limit == 2
+    for permit in fill(limit):
+        limit.release(permit, True)
+    assert limit.limit == 3
+
+
+def test_limit_never_grows_past_the_ceiling():
+    limit = AIMDLimit(2, 2)
+    for _ in range(10):
+        for permit in fill(limit):
+            limit.release(permit, True)
+    assert limit.limit == 2
+
+
+def test_burst_of_failures_halves_once():
+    limit = AIMDLimit(8, 8)
+    permits = fill(limit)
+    for permit in permits:
+        limit.release(permit, False)
+    assert limit.limit == 4
+    assert limit.cuts == 1
+    # A request started after the cut can cut again
+    limit.release(limit.acquire(0), False)
+    assert limit.limit == 2
+
+
+def test_not_found_leaves_the_limit_alone():
+    limit = AIMDLimit(2, 4)
+    for permit in fill(limit):
+        limit.release(permit, None)
+    assert limit.limit == 2
+    assert limit.cuts == 0
+
+
+def test_throttling_status_cuts_even_without_an_exception():
+    limit = AIMDLimit(4, 4)
+    permit = limit.acquire(0)
+    permit.response(429)
+    limit.release(permit, True)
+    assert limit.limit == 2
+
+
+def test_latency_spike_cuts_a_latency_tracking_limit():
+    limit = AIMDLimit(4, 4, track_latency=True)
+
+    def respond(latency):
+        permit = limit.acquire(0)
+        permit.response(200, latency)
+        limit.release(permit, True)
+
+    for _ in range(5):
+        respond(0.1)
+    assert limit.cuts == 0
+    respond(5.0)
+    assert limit.cuts == 1
+    assert limit.limit == 2
+
+
+def test_slot_times_out_when_the_limit_is_full():
+    group = LimitGroup(1, 1)
+    with group.slot("tidal"):
+        with pytest.raises(SlotTimeout):
+            with group.slot("tidal", timeout=0.05):
+                pass
+        # Other keys have their own limit
+        with group.slot("qobuz", timeout=0.05):
+            pass
+    assert group.summary()["tidal"]["in_flight"] == 0
+
+
+def test_slot_wakes_a_waiter_when_released():
+    group = LimitGroup(1, 1)
+    entered = []
+
+    def wait():
+        with group.slot("deezer", timeout=5):
+            entered.append(1)
+
+    with group.slot("deezer"):
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+    waiter.join(5)
+    assert entered == [1]
+
+
+def test_slot_cuts_only_on_congestion():
+    group = LimitGroup(4, 4)
+    with pytest.raises(LookupError):
+        with group.slot("amazon"):
+            raise LookupError("track not found")
+    assert group.summary()["amazon"]["cuts"] == 0
+    with pytest.raises(requests.ConnectionError):
+        with group.slot("amazon"):
+            raise requests.ConnectionError("reset")
+    assert group.summary()["amazon"] == {"limit": 2, "ceiling": 4, "in_flight": 0, "cuts": 1}
+
+
+def test_is_overload():
+    response = requests.Response()
+    response.status_code = 503
+    assert is_overload(requests.HTTPError(response=response))
+    assert is_overload(Exception("Jumo HTTP 429"))
+    assert is_overload(requests.Timeout())
+    assert not is_overload(Exception("Status 404"))
+    assert not is_overload(Exception("Track not found"))
+    # Waiting for one of our own slots says nothing about the server
+    assert not is_overload(SlotTimeout("no free slot"))
+
+
+def test_hosts_share_one_group():
+    assert adaptiveLimit.HOSTS.get("example.org") is adaptiveLimit.HOSTS.get("example.org")
@@ -0,0 +1,92 @@
+import threading
+import time
+
+import pytest
+
+from SpotiFLAC import bandwidth
+from SpotiFLAC.bandwidth import Bandwidth, TokenBucket, parse_rate, parse_service_rate
+
+
+def test_parse_rate():
+    assert parse_rate("500K") == 500 * 1024
+    assert parse_rate("2.5M") == 2.5 * 1024 ** 2
+    assert parse_rate("10MB/s") == 10 * 1024 ** 2
+    assert parse_rate(2000) == 2000.0
+    assert parse_rate(None) is None
+    assert parse_rate("0") is None
+    with pytest.raises(ValueError):
+        parse_rate("fast")
+
+
+def test_parse_service_rate():
+    assert parse_service_rate("Tidal=1K") == ("tidal", 1024.0)
+    with pytest.raises(ValueError):
+        parse_service_rate("tidal")
+
+
+def test_bucket_lets_a_burst_through_then_charges_debt():
+    bucket = TokenBucket(1000)
+    assert bucket.reserve(1000) == 0.0
+    # The next caller waits for what it takes, and the one after it queues behind that
+    assert bucket.reserve(500) == pytest.approx(0.5, abs=0.05)
+    assert bucket.reserve(500) == pytest.approx(1.0, abs=0.05)
+
+
+def test_unconfigured_bandwidth_never_waits():
+    limits = Bandwidth()
+    start = time.monotonic()
+    for _ in range(100):
+        limits.consume(10 * 1024 ** 2)
+    assert time.monotonic() - start < 0.1
+
+
+def test_service_rate_applies_to_its_service_only():
+    limits = Bandwidth()
+    limits.configure(service_rates={"qobuz": 1000})
+    with bandwidth.service("tidal"):
+        start = time.monotonic()
+        limits.consume(3000)
+        assert time.monotonic() - start < 0.1
+    with bandwidth.service("qobuz") as throttle:
+        start = time.monotonic()
+        limits.consume(1000)
+        limits.consume(300)
+        assert time.monotonic() - start == pytest.approx(0.3, abs=0.15)
+    # The wait is put down to the limits, not to the service
+    assert throttle.seconds == pytest.approx(0.3, abs=0.15)
+
+
+def test_bound_function_shares_the_callers_throttle():
+    limits = Bandwidth()
+    limits.configure(1000)
+    # Uses up the burst, so the next 200 bytes wait 0.2s
+    limits.consume(1000)
+    with bandwidth.service("tidal") as throttle:
+        worker = threading.Thread(target=bandwidth.bind(lambda: limits.consume(200)))
+        worker.start()
+        worker.join(5)
+    assert throttle.seconds == pytest.approx(0.2, abs=0.15)
+
+
+def test_host_connections_are_capped():
+    limits = Bandwidth()
+    limits.configure(host_connections=1)
+    release = limits.connect("https://a.example/1")
+    # Another host has its own count
+    limits.connect("https://b.example/1")()
+    entered = threading.Event()
+
+    def second():
+        limits.connect("https://a.example/2")()
+        entered.set()
+
+    waiter = threading.Thread(target=second)
+    waiter.start()
+    assert not entered.wait(0.2)
+    assert limits.summary()["open_connections"] == {"a.example": 1}
+    release()
+    # Giving a slot back twice doesn't free a second one
+    release()
+    assert entered.wait(5)
+    waiter.join(5)
+    assert limits.summary()["open_connections"] == {}
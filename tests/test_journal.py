@@ -0,0 +1,98 @@
+import time
+
+import pytest
+
+from SpotiFLAC.journal import JOURNAL_NAME, DownloadJournal
+from SpotiFLAC.leaseQueue import Heartbeat
+from SpotiFLAC.trackStore import Track
+
+URL = "https://open.spotify.com/album/xyz"
+
+
+def track(n):
+    return Track("", f"Title {n}", "Artist", "Album", "Artist", n, 1000, f"t{n}")
+
+
+@pytest.fixture
+def workers(tmp_path):
+    # Two connections to one journal, like two worker processes sharing an output directory
+    path = str(tmp_path / JOURNAL_NAME)
+    first, second = DownloadJournal(path, shared=True), DownloadJournal(path, shared=True)
+    first.start_job(URL, "Album", "album", 3)
+    first.add_tracks(URL, [(n, track(n)) for n in range(3)])
+    first.mark_listed(URL)
+    yield first, second
+    first.close()
+    second.close()
+
+
+def ids(entries):
+    return [entry["track_id"] for entry in entries]
+
+
+def test_each_track_is_claimed_by_one_worker(workers):
+    first, second = workers
+    start = time.time()
+    assert ids(first.claim_tracks(URL, "a", start)) == ["t0"]
+    assert ids(second.claim_tracks(URL, "b", start, limit=5)) == ["t1", "t2"]
+    assert first.claim_tracks(URL, "a", start) == []
+    assert second.lease_state(URL, "b") == {"listed": True, "listing": False, "held": 1}
+
+
+def test_expired_lease_is_taken_over(workers):
+    first, second = workers
+    start = time.time()
+    assert ids(first.claim_tracks(URL, "a", start, ttl=0.05)) == ["t0"]
+    time.sleep(0.1)
+    # The holder stopped renewing: its track goes to the next worker that asks
+    assert ids(second.claim_tracks(URL, "b", start)) == ["t0"]
+
+
+def test_finished_track_is_not_claimed_again(workers):
+    first, second = workers
+    start = time.time()
+    first.claim_tracks(URL, "a", start)
+    first.record_done(URL, "t0", "tidal", "/music/t0.flac")
+    assert ids(second.claim_tracks(URL, "b", start, limit=5)) == ["t1", "t2"]
+    assert second.get(URL, "t0")["lease_owner"] == ""
+
+
+def test_failed_track_gets_one_more_try_per_worker(workers):
+    first, second = workers
+    start = time.time()
+    first.claim_tracks(URL, "a", start)
+    first.record_failed(URL, "t0", "not found")
+    # Failed after this worker started: it doesn't loop on it, a worker started later does
+    assert ids(first.claim_tracks(URL, "a", start, pending=False)) == []
+    assert ids(second.claim_tracks(URL, "b", time.time() + 1, pending=False)) == ["t0"]
+
+
+def test_only_one_worker_lists_a_job(tmp_path):
+    path = str(tmp_path / JOURNAL_NAME)
+    first, second = DownloadJournal(path, shared=True), DownloadJournal(path, shared=True)
+    try:
+        assert first.claim_listing(URL, "a")
+        assert not second.claim_listing(URL, "b")
+        assert second.lease_state(URL, "b")["listing"]
+        first.release_listing(URL, "a")
+        assert second.claim_listing(URL, "b")
+    finally:
+        first.close()
+        second.close()
+
+
+def test_heartbeat_renews_and_hands_back_leases(workers):
+    first, second = workers
+    start = time.time()
+    heartbeat = Heartbeat("a", ttl=0.2)
+    heartbeat.watch(first)
+    first.claim_tracks(URL, "a", start, limit=3, ttl=0.2)
+    heartbeat.start()
+    try:
+        # Well past the first expiry the renewed leases still hold
+        time.sleep(0.4)
+        assert second.claim_tracks(URL, "b", start) == []
+    finally:
+        heartbeat.stop()
+    # Stopping gives the tracks back right away
+    assert ids(second.claim_tracks(URL, "b", start, limit=3)) == ["t0", "t1", "t2"]
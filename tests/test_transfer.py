@@ -0,0 +1,179 @@
+import gzip
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from SpotiFLAC import transfer
+
+DATA = os.urandom(600 * 1024 + 17)
+ETAG = '"v1"'
+
+
+class Handler(BaseHTTPRequestHandler):
+    # /file honours Range, /norange ignores it, /short always breaks off halfway and /flaky?<id>
+    # breaks off halfway the first time each <id> is asked for
+    protocol_version = "HTTP/1.1"
+    ranges = []
+    broken = set()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/gzip":
+            body = gzip.compress(DATA)
+            self.send_response(200)
+            self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        start, end = 0, len(DATA)
+        requested = self.headers.get("Range")
+        Handler.ranges.append(requested)
+        if requested and path != "/norange" and self.headers.get("If-Range") in (None, ETAG):
+            first, last = re.match(r"bytes=(\d+)-(\d*)", requested).groups()
+            start, end = int(first), int(last) + 1 if last else len(DATA)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(DATA)}")
+        else:
+            self.send_response(200)
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Length", str(end - start))
+        if path == "/short" or (path == "/flaky" and self.path not in Handler.broken):
+            Handler.broken.add(self.path)
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.wfile.write(DATA[start:start + (end - start) // 2])
+            return
+        self.end_headers()
+        self.wfile.write(DATA[start:end])
+
+
+@pytest.fixture(scope="module")
+def server():
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{srv.server_port}"
+    srv.shutdown()
+    srv.server_close()
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_download_writes_body_and_stats(server, tmp_path):
+    path = str(tmp_path / "track.flac")
+    seen = []
+    stats = transfer.download(requests.Session(), server + "/file", path, lambda done, total: seen.append((done, total)))
+    assert read(path) == DATA
+    assert stats.bytes == len(DATA)
+    assert seen[-1] == (len(DATA), len(DATA))
+    assert os.listdir(tmp_path) == ["track.flac"]
+
+
+def test_download_decodes_compressed_body(server, tmp_path):
+    path = str(tmp_path / "track.flac")
+    transfer.download(requests.Session(), server + "/gzip", path)
+    assert read(path) == DATA
+
+
+def test_dropped_connection_resumes_in_the_same_call(server, tmp_path):
+    path = str(tmp_path / "track.flac")
+    del Handler.ranges[:]
+    transfer.download(requests.Session(), server + "/flaky?same-call", path)
+    assert read(path) == DATA
+    # The first request asks for bytes=0- to learn whether the file could be split
+    assert Handler.ranges == ["bytes=0-", f"bytes={len(DATA) // 2}-"]
+    assert os.listdir(tmp_path) == ["track.flac"]
+
+
+def test_short_body_keeps_partial_for_a_later_run(server, tmp_path):
+    path = str(tmp_path / "track.flac")
+    with pytest.raises(transfer.TransferIncomplete):
+        transfer.download(requests.Session(), server + "/short", path, retries=0)
+    assert sorted(os.listdir(tmp_path)) == ["track.flac.part", "track.flac.part.json"]
+
+    # A new URL for the same file (same ETag) continues where the last run stopped
+    del Handler.ranges[:]
+    stats = transfer.download(requests.Session(), server + "/file", path)
+    assert read(path) == DATA
+    assert Handler.ranges == [f"bytes={len(DATA) // 2}-"]
+    assert stats.bytes == len(DATA) - len(DATA) // 2
+    assert os.listdir(tmp_path) == ["track.flac"]
+
+
+def test_server_ignoring_range_starts_over(server, tmp_path):
+    path = str(tmp_path / "track.flac")
+    with pytest.raises(transfer.TransferIncomplete):
+        transfer.download(requests.Session(), server + "/short", path, retries=0)
+    transfer.download(requests.Session(), server + "/norange", path)
+    assert read(path) == DATA
+    assert os.listdir(tmp_path) == ["track.flac"]
+
+
+def test_large_file_is_fetched_in_segments(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(transfer, "SEGMENT_THRESHOLD", 64 * 1024)
+    path = str(tmp_path / "track.flac")
+    del Handler.ranges[:]
+    stats = transfer.download(requests.Session(), server + "/file", path, segments=4)
+    assert read(path) == DATA
+    assert stats.bytes == len(DATA)
+    size = (len(DATA) + 3) // 4
+    assert sorted(Handler.ranges) == sorted(["bytes=0-"] + [f"bytes={n * size}-{min((n + 1) * size, len(DATA)) - 1}"
+                                                           for n in range(1, 4)])
+    assert os.listdir(tmp_path) == ["track.flac"]
+
+
+def test_segmented_download_survives_a_dropped_range(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(transfer, "SEGMENT_THRESHOLD", 64 * 1024)
+    path = str(tmp_path / "track.flac")
+    transfer.download(requests.Session(), server + "/flaky?segmented", path, segments=4)
+    assert read(path) == DATA
+
+
+def test_server_without_ranges_gets_one_stream(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(transfer, "SEGMENT_THRESHOLD", 64 * 1024)
+    path = str(tmp_path / "track.flac")
+    del Handler.ranges[:]
+    transfer.download(requests.Session(), server + "/norange", path, segments=4)
+    assert read(path) == DATA
+    assert Handler.ranges == ["bytes=0-"]
+
+
+def test_discard_partials(tmp_path):
+    names = ["a [tidal t1].flac.part", "a [tidal t1].flac.part.json", "b [qobuz t2].flac.part",
+             "old.flac.part", "done.flac"]
+    for name in names:
+        (tmp_path / name).write_bytes(b"x")
+    old = time.time() - transfer.PART_TTL - 60
+    os.utime(tmp_path / "old.flac.part", (old, old))
+    transfer.discard_partials(str(tmp_path), "t1")
+    assert sorted(os.listdir(tmp_path)) == ["b [qobuz t2].flac.part", "done.flac"]
+
+
+def test_iter_chunks_reuses_one_buffer(server):
+    buf = bytearray(64 * 1024)
+    data = bytearray()
+    with transfer.open_stream(requests.Session(), server + "/file") as resp:
+        for chunk in transfer.iter_chunks(resp, buf=buf):
+            assert chunk.obj is buf
+            data += chunk
+    assert data == DATA
+
+
+def test_content_length_ignores_compressed_bodies():
+    resp = requests.Response()
+    resp.headers["Content-Length"] = "10"
+    assert transfer.content_length(resp) == 10
+    resp.headers["Content-Encoding"] = "gzip"
+    assert transfer.content_length(resp) == 0